@@ -1,27 +1,17 @@
-import os
-import json
 import functools
 import traceback
 import time
 from datetime import datetime
 from enum import Enum, auto
 
+from engine.journal import get_journal
+
 
 def save_workflow_result(workflow_result):
-    results_dir = "workflow_results"
-    os.makedirs(results_dir, exist_ok=True)
-    
-    file_path = os.path.join(results_dir, f"{workflow_result.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
-    with open(file_path, "w") as file:
-        json.dump(workflow_result.to_dict(), file, indent=4)
+    get_journal().append_record("workflow_result", workflow_result.to_dict())
 
 def save_task_result(task_result):
-    results_dir = "task_results"
-    os.makedirs(results_dir, exist_ok=True)
-    
-    file_path = os.path.join(results_dir, f"{task_result.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
-    with open(file_path, "w") as file:
-        json.dump(task_result.to_dict(), file, indent=4)
+    get_journal().append_record("task_result", task_result.to_dict())
 
 class TaskState(Enum):
     PENDING = auto()
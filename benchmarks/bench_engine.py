@@ -0,0 +1,324 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+# Per-workflow INFO lines would dominate the timings.
+os.environ.setdefault("ENGINE_LOG_LEVEL", "WARNING")
+
+from engine import db, writer
+from engine.blobstore import configure_blobstore
+from engine.task import TaskResult, task
+from engine.workflow import Workflow
+
+from benchmarks.fakes import FakeSurreal, MemoryBackend
+
+
+@task(max_retries=0)
+async def noop(value=None):
+    return value
+
+
+@task(max_retries=0)
+async def sleep(value=None, seconds=0.001):
+    await asyncio.sleep(seconds)
+    return value
+
+
+async def raw_noop(value=None):
+    return value
+
+
+def chain(length, task_func=noop, **kwargs):
+    wf = Workflow("bench", str(uuid.uuid4()))
+    wf.add_task(task_func, 0, **kwargs)
+    for _ in range(length - 1):
+        wf.add_task(task_func, **kwargs)
+    return wf
+
+
+def best_of(repeat, func):
+    # func() runs one measurement in a fresh event loop and returns seconds;
+    # the engine's singletons rebind to each loop.
+    return min(asyncio.run(func()) for _ in range(repeat))
+
+
+def result(case, params, metric, value, unit, lower_is_better=True):
+    return {"case": case, "params": params, "metric": metric, "value": value, "unit": unit,
+            "lower_is_better": lower_is_better}
+
+
+async def _use_memory_backend():
+    db.set_backend(MemoryBackend())
+    writer.configure_writer(spill_path=None)
+
+
+def bench_task_overhead(calls, repeat):
+    async def timed(func):
+        await _use_memory_backend()
+        started = time.perf_counter()
+        for i in range(calls):
+            await func(i)
+        elapsed = time.perf_counter() - started
+        await writer.shutdown()
+        return elapsed
+
+    raw = best_of(repeat, lambda: timed(raw_noop))
+    wrapped = best_of(repeat, lambda: timed(noop))
+
+    async def single_task_workflows():
+        await _use_memory_backend()
+        started = time.perf_counter()
+        for _ in range(calls // 10):
+            await chain(1).run()
+        elapsed = time.perf_counter() - started
+        await writer.shutdown()
+        return elapsed
+
+    workflow = best_of(repeat, single_task_workflows)
+    return [
+        result("task_overhead", {"body": "noop"}, "task_call", (wrapped - raw) / calls * 1e9, "ns"),
+        result("task_overhead", {"body": "noop"}, "workflow_1_task", workflow / (calls // 10) * 1e9, "ns"),
+    ]
+
+
+def bench_workflow_scaling(lengths, repeat):
+    results = []
+    for length in lengths:
+        async def run_chain():
+            await _use_memory_backend()
+            wf = chain(length)
+            started = time.perf_counter()
+            await wf.run()
+            elapsed = time.perf_counter() - started
+            await writer.shutdown()
+            return elapsed
+
+        elapsed = best_of(repeat, run_chain)
+        results.append(result("workflow_scaling", {"tasks": length}, "per_task", elapsed / length * 1e9, "ns"))
+    return results
+
+
+def bench_throughput(concurrencies, workflows, tasks, sleep_ms, repeat):
+    results = []
+    for concurrency in concurrencies:
+        async def run_many():
+            await _use_memory_backend()
+            limit = asyncio.Semaphore(concurrency)
+
+            async def one():
+                async with limit:
+                    await chain(tasks, sleep, seconds=sleep_ms / 1000).run()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one() for _ in range(workflows)))
+            elapsed = time.perf_counter() - started
+            await writer.shutdown()
+            return elapsed
+
+        elapsed = best_of(repeat, run_many)
+        # Ideal: every slot busy sleeping, no engine time at all.
+        ideal = workflows * tasks * sleep_ms / 1000 / concurrency
+        results.append(result("throughput", {"concurrency": concurrency, "tasks": tasks, "sleep_ms": sleep_ms},
+                              "workflows_per_second", workflows / elapsed, "1/s", lower_is_better=False))
+        results.append(result("throughput", {"concurrency": concurrency, "tasks": tasks, "sleep_ms": sleep_ms},
+                              "efficiency", ideal / elapsed, "ratio", lower_is_better=False))
+    return results
+
+
+def _backends(directory):
+    return {
+        "memory": lambda: MemoryBackend(),
+        "surreal": lambda: db.SurrealBackend(db.SurrealPool(client_factory=FakeSurreal)),
+        "sqlite": lambda: db.create_backend("sqlite", path=os.path.join(directory, "bench.db")),
+        "journal": lambda: db.create_backend("journal", directory=os.path.join(directory, "journal")),
+        "journal_binary": lambda: db.create_backend("journal", directory=os.path.join(directory, "journal"),
+                                                    serializer="binary"),
+    }
+
+
+def bench_persistence(backends, records, repeat):
+    # Cost per task record from the write-behind queue to the backend,
+    # to_dict() or the backend's own record encoding included.
+    results = []
+    for name in backends:
+        async def write_records():
+            directory = tempfile.mkdtemp(prefix="engine-bench-")
+            backend = db.set_backend(_backends(directory)[name]())
+            queue = writer.WriteBehindQueue(max_batch=records + 1, spill_path=None)
+            try:
+                task_results = []
+                for i in range(records):
+                    task_result = TaskResult("bench", str(uuid.uuid4()))
+                    task_result.start((i,))
+                    task_result.complete({"response": f"output {i}"})
+                    task_results.append(task_result)
+                await queue.flush()
+                started = time.perf_counter()
+                for task_result in task_results:
+                    queue.put_task_result(task_result)
+                await queue.flush()
+                return time.perf_counter() - started
+            finally:
+                await queue.close()
+                await backend.close()
+                shutil.rmtree(directory, ignore_errors=True)
+
+        elapsed = best_of(repeat, write_records)
+        results.append(result("persistence", {"backend": name, "batch": records}, "per_record",
+                              elapsed / records * 1e9, "ns"))
+    return results
+
+
+def bench_memory(in_flight, tasks):
+    # Bytes held per workflow while all of them wait inside a task.
+    async def measure():
+        await _use_memory_backend()
+        gate = asyncio.Event()
+        entered = 0
+
+        @task(max_retries=0)
+        async def wait(value=None):
+            nonlocal entered
+            entered += 1
+            await gate.wait()
+            return value
+
+        # Warm up so one-off allocations (writer, loggers) are not counted.
+        await chain(tasks).run()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        workflows = [chain(tasks, wait) for _ in range(in_flight)]
+        running = [asyncio.ensure_future(wf.run()) for wf in workflows]
+        while entered < in_flight:
+            await asyncio.sleep(0.001)
+        held = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        gate.set()
+        await asyncio.gather(*running)
+        await writer.shutdown()
+        return held
+
+    held = asyncio.run(measure())
+    return [result("memory", {"in_flight": in_flight, "tasks": tasks}, "per_workflow", held / in_flight, "bytes")]
+
+
+CASES = ("task_overhead", "workflow_scaling", "throughput", "persistence", "memory")
+
+
+def run(cases=CASES, quick=False):
+    scale = 10 if quick else 1
+    repeat = 2 if quick else 5
+    configure_blobstore(threshold=None)
+    results = []
+    if "task_overhead" in cases:
+        results += bench_task_overhead(20000 // scale, repeat)
+    if "workflow_scaling" in cases:
+        results += bench_workflow_scaling((1, 10, 100, 1000) if not quick else (1, 10, 100), repeat)
+    if "throughput" in cases:
+        results += bench_throughput((1, 10, 100), 1000 // scale, 5, 1.0, repeat)
+    if "persistence" in cases:
+        results += bench_persistence(("memory", "surreal", "sqlite", "journal", "journal_binary"), 5000 // scale,
+                                     repeat)
+    if "memory" in cases:
+        results += bench_memory(1000 // scale, 3)
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _key(row):
+    return row["case"], json.dumps(row["params"], sort_keys=True), row["metric"]
+
+
+def compare(baseline, current, threshold):
+    # Rows whose value got worse by more than `threshold` (a fraction) are
+    # regressions; rows missing on either side are reported as such.
+    before = {_key(row): row for row in baseline["results"]}
+    rows = []
+    for row in current["results"]:
+        old = before.pop(_key(row), None)
+        if old is None or not old["value"]:
+            rows.append({**row, "baseline": None, "change": None, "status": "new"})
+            continue
+        change = (row["value"] - old["value"]) / old["value"]
+        worse = change if row["lower_is_better"] else -change
+        status = "regression" if worse > threshold else "improvement" if worse < -threshold else "same"
+        rows.append({**row, "baseline": old["value"], "change": change, "status": status})
+    for old in before.values():
+        rows.append({**old, "baseline": old["value"], "value": None, "change": None, "status": "missing"})
+    return rows
+
+
+def _label(row):
+    params = ",".join(f"{k}={v}" for k, v in row["params"].items())
+    return f"{row['case']}[{params}].{row['metric']}"
+
+
+def _format(value, unit):
+    if value is None:
+        return "-"
+    return f"{value:,.0f} {unit}" if unit in ("ns", "bytes") else f"{value:,.2f} {unit}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Engine overhead and throughput benchmarks")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES)
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, for a smoke run")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative change that counts as a regression (default 0.10)")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as file:
+            baseline = json.load(file)
+        with open(args.compare[1]) as file:
+            current = json.load(file)
+        rows = compare(baseline, current, args.threshold)
+        if args.json:
+            print(json.dumps(rows, indent=2))
+        else:
+            for row in rows:
+                change = f"{row['change']:+.1%}" if row["change"] is not None else ""
+                print(f"{row['status']:<11} {_label(row):<70} {_format(row['baseline'], row['unit']):>16} -> "
+                      f"{_format(row['value'], row['unit']):>16} {change}")
+        sys.exit(1 if any(row["status"] == "regression" for row in rows) else 0)
+
+    started = time.perf_counter()
+    report = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(),
+                 "revision": _git_revision(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "quick": args.quick},
+        "results": run(args.cases, args.quick),
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for row in report["results"]:
+        print(f"{_label(row):<70} {_format(row['value'], row['unit']):>16}")
+    print(f"({time.perf_counter() - started:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
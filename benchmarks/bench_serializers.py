@@ -0,0 +1,111 @@
+import argparse
+import json
+import os
+import time
+import uuid
+
+os.environ.setdefault("ENGINE_LOG_LEVEL", "WARNING")
+
+from engine.blobstore import configure_blobstore
+from engine.serializers import SERIALIZERS, decode, get_serializer
+from engine.task import TaskResult
+from engine.workflow import WorkflowResult
+
+from benchmarks.bench_engine import _format, _label, result
+
+
+def _task(input_data, output_data):
+    task_result = TaskResult("bench", str(uuid.uuid4()))
+    task_result.start(input_data)
+    task_result.complete(output_data)
+    task_result.queue_wait = 0.0001
+    task_result.run_time = 0.001
+    return task_result
+
+
+def _workflow(tasks):
+    workflow_result = WorkflowResult("bench", str(uuid.uuid4()))
+    workflow_result.start()
+    workflow_result.tasks = [_task((i,), {"response": f"output {i}"}) for i in range(tasks)]
+    workflow_result.complete()
+    return workflow_result
+
+
+def records():
+    return {
+        "task_small": _task((1,), {"response": "output 1"}),
+        "task_text_4k": _task(("prompt " * 100,), {"response": "x" * 4096}),
+        "task_bytes_32k": _task((b"\x00" * 1024,), b"\x01" * 32 * 1024),
+        "workflow_100": _workflow(100),
+    }
+
+
+def available():
+    names = []
+    for name in SERIALIZERS:
+        try:
+            get_serializer(name)
+        except RuntimeError:
+            continue
+        names.append(name)
+    return names
+
+
+def timed(repeat, count, func, *args):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        for _ in range(count):
+            func(*args)
+        elapsed = (time.perf_counter_ns() - started) / count
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_serializers(count, repeat):
+    # "json" is the existing path: to_dict() (ISO timestamps) then compact
+    # json.dumps with default=str. Record objects go to each serializer as
+    # they would from the write-behind queue.
+    results = []
+    for record_name, record in records().items():
+        for name in available():
+            serializer = get_serializer(name)
+            data = serializer.dumps(record)
+            params = {"record": record_name, "serializer": name}
+            results.append(result("serialize", params, "encode", timed(repeat, count, serializer.dumps, record), "ns"))
+            results.append(result("serialize", params, "decode", timed(repeat, count, decode, data), "ns"))
+            if name == "binary":
+                results.append(result("serialize", params, "decode_zero_copy",
+                                      timed(repeat, count, decode, data, True), "ns"))
+            results.append(result("serialize", params, "size", len(data), "bytes"))
+    return results
+
+
+def run(quick=False):
+    # Payloads stay inline so every serializer sees the same bytes.
+    configure_blobstore(threshold=None)
+    return bench_serializers(200 if quick else 2000, 2 if quick else 5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Result record serializer benchmarks")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, for a smoke run")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    report = {"meta": {"serializers": available(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "quick": args.quick},
+              "results": run(args.quick)}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for row in report["results"]:
+        print(f"{_label(row):<70} {_format(row['value'], row['unit']):>16}")
+
+
+if __name__ == "__main__":
+    main()
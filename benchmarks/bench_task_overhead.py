@@ -0,0 +1,120 @@
+import argparse
+import contextlib
+import json
+import os
+import time
+import timeit
+from datetime import datetime
+
+from engine.task import TaskResult
+from engine.workflow import WorkflowResult
+
+
+class LegacyTaskResult:
+    # TaskResult as it was before the slots/perf_counter_ns rewrite, kept
+    # here as the "before" side of the comparison.
+    def __init__(self, name, id=None):
+        self.name = name
+        self.id = id
+        self.state = "PENDING"
+        self.start_time = None
+        self.end_time = None
+        self.duration = None
+        self.input_data = None
+        self.output_data = None
+        self.error_message = None
+        self.retries = 0
+
+    def start(self, input_data):
+        self.state = "RUNNING"
+        self.start_time = datetime.now()
+        self.input_data = input_data
+        print(f"{self.name} state: {self.state}, Input: {self.input_data}")
+
+    def complete(self, output_data):
+        self.state = "SUCCESS"
+        self.end_time = datetime.now()
+        self.duration = self.end_time - self.start_time
+        self.output_data = output_data
+        print(f"{self.name} state: {self.state}, Duration: {self.duration}, Output: {self.output_data}")
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "id": self.id,
+            "state": self.state,
+            "start_time": self.start_time.isoformat() if self.start_time else None,
+            "end_time": self.end_time.isoformat() if self.end_time else None,
+            "duration": self.duration.total_seconds() if self.duration else None,
+            "input_data": self.input_data,
+            "output_data": self.output_data,
+            "error_message": self.error_message,
+            "retries": self.retries
+        }
+
+
+class LegacyWorkflowResult:
+    def __init__(self):
+        self.tasks = []
+
+    def add_task_result(self, task_result):
+        self.tasks.append(task_result.to_dict())
+
+
+def legacy_lifecycle(payload, workflow_result):
+    task_result = LegacyTaskResult("bench", "id")
+    task_result.start((payload,))
+    task_result.complete({"response": payload})
+    workflow_result.add_task_result(task_result)
+
+
+def current_lifecycle(payload, workflow_result):
+    task_result = TaskResult("bench", "id")
+    task_result.start((payload,))
+    task_result.complete({"response": payload})
+    workflow_result.add_task_result(task_result)
+
+
+def measure(lifecycle, workflow_result, payload, number, repeat):
+    # The legacy path prints on every state change; send it nowhere so the
+    # terminal is not part of the measurement.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        timer = timeit.Timer(lambda: lifecycle(payload, workflow_result))
+        best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e9
+
+
+def run(payload_sizes=(16, 16 * 1024), number=20000, repeat=5):
+    results = []
+    for size in payload_sizes:
+        payload = "x" * size
+        legacy = measure(legacy_lifecycle, LegacyWorkflowResult(), payload, number, repeat)
+        current = measure(current_lifecycle, WorkflowResult("bench", "job"), payload, number, repeat)
+        results.append({
+            "payload_bytes": size,
+            "legacy_ns_per_task": round(legacy),
+            "current_ns_per_task": round(current),
+            "speedup": round(legacy / current, 2),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-task record/logging overhead, before and after")
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    results = run(number=args.number, repeat=args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for row in results:
+        print(f"payload={row['payload_bytes']:>6}B  legacy={row['legacy_ns_per_task']:>8} ns/task  "
+              f"current={row['current_ns_per_task']:>6} ns/task  speedup={row['speedup']}x")
+    print(f"({time.perf_counter() - started:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+import asyncio
+import json
+
+from engine.db import StorageBackend
+from engine.rollups import Rollup
+
+
+class MemoryBackend(StorageBackend):
+    # Keeps everything in dicts. latency (seconds per write_batch) stands in
+    # for a database round-trip.
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.task_results = {}
+        self.statuses = {}
+        self.workflow_results = {}
+        self.checkpoints = {}
+        self.rollups = {}
+        self.batches = 0
+        self.records = 0
+
+    async def write_batch(self, task_results=(), statuses=None, workflow_results=(), checkpoints=(),
+                          rollups=(), batch_id=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        statuses = statuses or {}
+        for record in task_results:
+            self.task_results[record["id"]] = record
+        self.statuses.update(statuses)
+        for record in workflow_results:
+            self.workflow_results[record["job_id"]] = record
+        for record in checkpoints:
+            self.checkpoints[(record["job_id"], record["step"])] = record
+        for record in rollups:
+            rollup = Rollup.from_dict(record)
+            key = (rollup.task, rollup.window_start)
+            self.rollups[key] = self.rollups[key].merge(rollup) if key in self.rollups else rollup
+        self.batches += 1
+        self.records += len(task_results) + len(statuses) + len(workflow_results) + len(checkpoints) + len(rollups)
+
+    async def load_checkpoints(self, job_id):
+        return [record for (job, _), record in sorted(self.checkpoints.items()) if job == job_id]
+
+    async def list_runs(self, name=None, state=None, since=None, until=None, limit=100):
+        runs = [{k: v for k, v in run.items() if k != "tasks"} for run in self.workflow_results.values()
+                if (name is None or run["name"] == name) and (state is None or run["state"] == state)
+                and (since is None or (run["start_time"] or "") >= since)
+                and (until is None or (run["start_time"] or "") < until)]
+        runs.sort(key=lambda run: run["start_time"] or "", reverse=True)
+        return runs[:limit]
+
+    async def get_run(self, job_id):
+        run = self.workflow_results.get(job_id)
+        return dict(run, status=self.statuses.get(job_id)) if run is not None else None
+
+    async def load_rollups(self, task=None, since=None, until=None):
+        return [rollup.to_dict() for rollup in self.rollups.values()
+                if (task is None or rollup.task == task)
+                and (since is None or rollup.window_start >= since)
+                and (until is None or rollup.window_start < until)]
+
+
+class FakeSurreal:
+    # Enough of the surrealdb client for SurrealPool and SurrealBackend:
+    # queries are JSON-encoded like they would be on the websocket and then
+    # dropped. Use as configure_pool(client_factory=FakeSurreal).
+    latency = 0.0
+
+    def __init__(self, url):
+        self.url = url
+        self.queries = 0
+        self.bytes_sent = 0
+
+    async def connect(self):
+        pass
+
+    async def signin(self, credentials):
+        pass
+
+    async def use(self, namespace, database):
+        pass
+
+    async def _send(self, *payload):
+        self.queries += 1
+        self.bytes_sent += len(json.dumps(payload, default=str))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def query(self, query, params=None):
+        await self._send(query, params)
+        return [{"status": "OK", "result": []}]
+
+    async def create(self, thing, data):
+        await self._send(thing, data)
+        return [data]
+
+    async def update(self, thing, data):
+        await self._send(thing, data)
+        return [data]
+
+    async def close(self):
+        pass
+
+
+class FakeSurrealServer:
+    # A stand-in SurrealDB server on a local socket, for testing SurrealPool
+    # against connections that really open, drop and close. It speaks
+    # newline-delimited JSON-RPC to FakeSurrealClient, records every query,
+    # and adds up the rollup counts of write batches, once per batch id.
+    def __init__(self):
+        self.queries = []
+        self.rollups = {}
+        self.batches = set()
+        self.connections = 0
+        self.open = 0
+        self.peak_open = 0
+        # Queries that are applied and then answered by dropping the connection.
+        self.drop_after = 0
+        self.latency = 0.0
+        self._server = None
+        self._writers = set()
+
+    @property
+    def url(self):
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"tcp://{host}:{port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def close(self):
+        self.disconnect()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def disconnect(self):
+        # Drops every open connection, as a server restart would.
+        for writer in list(self._writers):
+            writer.close()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self.open += 1
+        self.peak_open = max(self.peak_open, self.open)
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                result = await self._call(request["method"], request["params"])
+                if self.drop_after and request["method"] == "query":
+                    self.drop_after -= 1
+                    break
+                writer.write(json.dumps({"id": request["id"], "result": result}).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.open -= 1
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _call(self, method, params):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method != "query":
+            return params[-1] if method in ("create", "update") else None
+        query, variables = params[0], params[1] or {}
+        self.queries.append(query)
+        batch = variables.get("batch")
+        if batch not in self.batches:
+            if batch is not None:
+                self.batches.add(batch)
+            for name, rollup in variables.items():
+                if name.startswith("rollup"):
+                    key = (rollup["task"], rollup["window_start"])
+                    self.rollups[key] = self.rollups.get(key, 0) + rollup["count"]
+        return [{"status": "OK", "result": []}]
+
+
+class FakeSurrealClient:
+    # The client side of FakeSurrealServer, with the surrealdb client's
+    # methods. A dropped connection raises ConnectionError like the real one.
+    def __init__(self, url):
+        self.url = url
+        self._reader = None
+        self._writer = None
+        self._ids = 0
+
+    async def connect(self):
+        host, port = self.url[len("tcp://"):].rsplit(":", 1)
+        self._reader, self._writer = await asyncio.open_connection(host, int(port))
+
+    async def _rpc(self, method, *params):
+        self._ids += 1
+        self._writer.write(json.dumps({"id": self._ids, "method": method, "params": params}, default=str).encode()
+                           + b"\n")
+        await self._writer.drain()
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by the server")
+        return json.loads(line)["result"]
+
+    async def signin(self, credentials):
+        return await self._rpc("signin", credentials)
+
+    async def use(self, namespace, database):
+        return await self._rpc("use", namespace, database)
+
+    async def query(self, query, params=None):
+        return await self._rpc("query", query, params)
+
+    async def create(self, thing, data):
+        return await self._rpc("create", thing, data)
+
+    async def update(self, thing, data):
+        return await self._rpc("update", thing, data)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class FakeOpenAIServer:
+    # The chat and completions endpoints of the OpenAI API on a local port,
+    # for chat.llm: configure_client(base_url=server.base_url). Replies echo
+    # the prompt, usage counts words, batch choices come back in reverse
+    # order. overload=N answers the next N requests with 429.
+    def __init__(self, latency=0.0, overload=0, retry_after=None):
+        self.latency = latency
+        self.overload = overload
+        self.retry_after = retry_after
+        self.requests = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/v1"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    @staticmethod
+    def reply(prompt):
+        return f"echo: {prompt}"
+
+    @staticmethod
+    def usage(prompts, texts):
+        prompt_tokens = sum(len(prompt.split()) for prompt in prompts)
+        completion_tokens = sum(len(text.split()) for text in texts)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = request_line.decode("latin-1").split()[1]
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                try:
+                    await self._respond(writer, path, json.loads(body) if body else {})
+                finally:
+                    self.in_flight -= 1
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, path, body):
+        self.requests.append((path, body))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.overload:
+            self.overload -= 1
+            headers = {"retry-after": str(self.retry_after)} if self.retry_after is not None else {}
+            self._send_json(writer, 429, {"error": {"message": "Rate limit reached", "type": "requests"}}, headers)
+        elif path.endswith("/chat/completions"):
+            prompt = body["messages"][-1]["content"]
+            text = self.reply(prompt)
+            usage = self.usage([prompt], [text])
+            if body.get("stream"):
+                chunks = [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}
+                          for word in text.split()]
+                events = [self._chunk(body, [choice], None) for choice in chunks]
+                events.append(self._chunk(body, [], usage))
+                payload = "".join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n"
+                self._send(writer, 200, "text/event-stream", payload.encode())
+            else:
+                self._send_json(writer, 200, {
+                    "id": "chatcmpl-fake", "object": "chat.completion", "created": 0, "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                 "finish_reason": "stop"}],
+                    "usage": usage})
+        elif path.endswith("/completions"):
+            prompts = body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+            texts = [self.reply(prompt) for prompt in prompts]
+            choices = [{"index": index, "text": text, "finish_reason": "stop", "logprobs": None}
+                       for index, text in enumerate(texts)]
+            self._send_json(writer, 200, {
+                "id": "cmpl-fake", "object": "text_completion", "created": 0, "model": body["model"],
+                "choices": choices[::-1], "usage": self.usage(prompts, texts)})
+        else:
+            self._send_json(writer, 404, {"error": {"message": f"no such path {path}"}})
+        await writer.drain()
+
+    @staticmethod
+    def _chunk(body, choices, usage):
+        return {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                "choices": choices, "usage": usage}
+
+    def _send_json(self, writer, status, body, headers=None):
+        self._send(writer, status, "application/json", json.dumps(body).encode(), headers)
+
+    @staticmethod
+    def _send(writer, status, content_type, data, headers=None):
+        extra = "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(data)}\r\n{extra}\r\n".encode() + data)
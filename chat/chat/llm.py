@@ -0,0 +1,225 @@
+import asyncio
+import os
+import time
+
+import httpx
+import openai
+from engine.ratelimit import configure_limit, get_limit
+from engine.retry import RetryPolicy
+from engine.task import current_task, task
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_MODEL = os.environ.get("LLM_MODEL", "gpt-3.5-turbo")
+BATCH_MODEL = os.environ.get("LLM_BATCH_MODEL", "gpt-3.5-turbo-instruct")
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# Shared by every workflow in the process.
+configure_limit("openai",
+                requests_per_minute=int(os.environ.get("OPENAI_RPM", 500)),
+                tokens_per_minute=int(os.environ.get("OPENAI_TPM", 200000)),
+                max_concurrency=int(os.environ.get("OPENAI_MAX_CONCURRENCY", 32)),
+                target_latency=30.0)
+
+# Retries are left to the task's policy, not the SDK.
+LLM_RETRY = RetryPolicy(max_attempts=5, base_delay=1, max_delay=30, max_total_time=120,
+                        no_retry_on=(openai.AuthenticationError, openai.BadRequestError))
+
+_client_options = {}
+# Event loop -> its client.
+_clients = {}
+
+
+def configure_client(**options):
+    # base_url, api_key, timeout, max_connections. LLM_BASE_URL (or the
+    # SDK's OPENAI_BASE_URL) points the client at a local stub server.
+    _client_options.clear()
+    _client_options.update(options)
+    _clients.clear()
+
+
+def _new_client():
+    options = dict(_client_options)
+    max_connections = options.pop("max_connections", 100)
+    base_url = options.pop("base_url", os.environ.get("LLM_BASE_URL"))
+    if base_url and not os.environ.get("OPENAI_API_KEY"):
+        options.setdefault("api_key", "local")
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        timeout=options.pop("timeout", 60.0))
+    return openai.AsyncOpenAI(base_url=base_url, max_retries=0, http_client=http_client, **options)
+
+
+def get_client():
+    # One client, and so one keep-alive connection pool, per event loop.
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        # A closed loop's client can no longer be closed; dropping it lets
+        # its connections be collected instead of piling up.
+        for stale in [other for other in _clients if other.is_closed()]:
+            del _clients[stale]
+        client = _clients[loop] = _new_client()
+    return client
+
+
+async def close_client():
+    # Closes the running loop's client.
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+def estimate_tokens(prompt, *args, **kwargs):
+    return len(prompt) // 4 + 512
+
+
+def _split_usage(usage, count):
+    # Whole-token shares of one request's usage. The first prompt takes the
+    # remainder, so the shares add up to what the provider billed.
+    shares = [{} for _ in range(count)]
+    for name, value in usage.items():
+        if name == "total_tokens":
+            continue
+        each, remainder = divmod(value, count)
+        for i, share in enumerate(shares):
+            share[name] = each + (remainder if i == 0 else 0)
+    if "total_tokens" in usage:
+        for share in shares[1:]:
+            share["total_tokens"] = share.get("prompt_tokens", 0) + share.get("completion_tokens", 0)
+        shares[0]["total_tokens"] = usage["total_tokens"] - sum(share["total_tokens"] for share in shares[1:])
+    return shares
+
+
+def _messages(prompt, system):
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def _usage(usage):
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens,
+    }
+
+
+async def complete(prompt, model=DEFAULT_MODEL, system=SYSTEM_PROMPT, **params):
+    started = time.perf_counter()
+    response = await get_client().chat.completions.create(
+        model=model, messages=_messages(prompt, system), **params)
+    return {
+        "response": response.choices[0].message.content,
+        "usage": _usage(response.usage),
+        "latency": time.perf_counter() - started,
+    }
+
+
+async def stream(prompt, model=DEFAULT_MODEL, system=SYSTEM_PROMPT, **params):
+    # Yields text deltas. Usage arrives in the final chunk and is recorded
+    # on the calling task's TaskResult.
+    response = await get_client().chat.completions.create(
+        model=model, messages=_messages(prompt, system), stream=True,
+        stream_options={"include_usage": True}, **params)
+    async for chunk in response:
+        if chunk.usage is not None and current_task() is not None:
+            current_task().usage = _usage(chunk.usage)
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+class PromptBatcher:
+    # Prompts submitted within max_wait of each other go out as one
+    # completions request with a list of prompts. Chat models do not accept
+    # batches, so this needs a completions model.
+    def __init__(self, model=BATCH_MODEL, max_batch=20, max_wait=0.01, limit="openai", **params):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.limit = limit
+        self.params = params
+        self._pending = []
+        self._timer = None
+        self._sending = set()
+
+    async def submit(self, prompt):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((prompt, future))
+        if len(self._pending) >= self.max_batch:
+            self._send_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._send_pending)
+        return await future
+
+    def _send_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = [(prompt, future) for prompt, future in self._pending if not future.done()]
+        self._pending = []
+        if batch:
+            sending = asyncio.ensure_future(self._send(batch))
+            self._sending.add(sending)
+            sending.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch):
+        prompts = [prompt for prompt, _ in batch]
+        started = time.perf_counter()
+        try:
+            if self.limit is not None:
+                tokens = sum(estimate_tokens(prompt) for prompt in prompts)
+                async with get_limit(self.limit).slot(tokens) as lease:
+                    response = await get_client().completions.create(model=self.model, prompt=prompts, **self.params)
+                    lease.report_tokens(response.usage.total_tokens if response.usage else None)
+            else:
+                response = await get_client().completions.create(model=self.model, prompt=prompts, **self.params)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        latency = time.perf_counter() - started
+        texts = [None] * len(batch)
+        for choice in response.choices:
+            texts[choice.index] = choice.text
+        # The provider reports usage for the whole request; split it evenly.
+        usage = _usage(response.usage)
+        shares = _split_usage(usage, len(batch)) if usage is not None else [None] * len(batch)
+        logger.debug(f"Sent batch of {len(batch)} prompts in {latency:.3f}s")
+        for (_, future), text, share in zip(batch, texts, shares):
+            if not future.done():
+                future.set_result({"response": text, "usage": share, "latency": latency,
+                                   "batch_size": len(batch)})
+
+
+_batchers = {}
+
+
+def get_batcher(model=BATCH_MODEL):
+    batcher = _batchers.get(model)
+    if batcher is None:
+        batcher = _batchers[model] = PromptBatcher(model)
+    return batcher
+
+
+@task(limit="openai", limit_tokens=estimate_tokens, single_flight=True, retry=LLM_RETRY)
+async def chat(prompt, model=DEFAULT_MODEL, system=SYSTEM_PROMPT, temperature=0.0):
+    return await complete(prompt, model, system, temperature=temperature)
+
+
+@task(limit="openai", limit_tokens=estimate_tokens, retry=LLM_RETRY)
+async def chat_stream(prompt, model=DEFAULT_MODEL, system=SYSTEM_PROMPT, temperature=0.0):
+    async for text in stream(prompt, model, system, temperature=temperature):
+        yield text
+
+
+# The batcher applies the rate limit per request it sends, not per prompt.
+@task(single_flight=True, retry=LLM_RETRY)
+async def complete_batched(prompt, model=BATCH_MODEL):
+    return await get_batcher(model).submit(prompt)
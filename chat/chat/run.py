@@ -1,24 +1,10 @@
-import openai
+from chat.llm import LLM_RETRY, complete, estimate_tokens
 from engine.task import task
 from engine.utils import get_logger
 
 logger = get_logger()
 
-@task()
+@task(limit="openai", limit_tokens=estimate_tokens, single_flight=True, retry=LLM_RETRY)
 async def run(prompt):
-    client = openai.OpenAI()
-    messages = [
-        {"role": "system", "content": "You are a helpful assistant."},
-        {"role": "user", "content": prompt},
-    ]
-    logger.info(messages)
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=messages,
-        temperature=0.0,
-    )
-    response_content = response.choices[0].message.content
-
-    return {
-        "response": response_content,
-    }
+    logger.info(prompt)
+    return await complete(prompt, temperature=0.0)
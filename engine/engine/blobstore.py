@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import json
+import os
+
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+BLOB_KEY = "$blob"
+SCALARS = (type(None), bool, int, float)
+
+
+class BlobStore:
+    # Content-addressed: put() returns the sha256 hex digest of the data, and
+    # storing the same bytes twice is a no-op.
+    def put(self, data):
+        raise NotImplementedError
+
+    async def put_async(self, data):
+        # put() from the event loop: hashing and I/O run on a thread.
+        return await asyncio.get_running_loop().run_in_executor(None, self.put, data)
+
+    def get(self, digest):
+        raise NotImplementedError
+
+    async def get_async(self, digest):
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, digest)
+
+    def exists(self, digest):
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, directory="blobs"):
+        self.directory = directory
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as file:
+                file.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    def get(self, digest):
+        with open(self._path(digest), "rb") as file:
+            return file.read()
+
+    def exists(self, digest):
+        return os.path.exists(self._path(digest))
+
+
+_store = None
+_threshold = int(os.environ.get("ENGINE_BLOB_THRESHOLD", 64 * 1024))
+_preview_chars = 200
+
+
+def configure_blobstore(store=None, threshold=64 * 1024, preview_chars=200):
+    # threshold=None keeps every payload inline.
+    global _store, _threshold, _preview_chars
+    _store = store
+    _threshold = threshold
+    _preview_chars = preview_chars
+
+
+def get_blobstore():
+    global _store
+    if _store is None:
+        _store = LocalBlobStore(os.environ.get("ENGINE_BLOB_DIR", "blobs"))
+    return _store
+
+
+def is_ref(value):
+    return isinstance(value, dict) and BLOB_KEY in value
+
+
+def _payload(value):
+    # (serialized bytes, encoding) of a value too large to keep inline, or None.
+    if _threshold is None or isinstance(value, SCALARS) or is_ref(value):
+        return None
+    if isinstance(value, str):
+        if len(value) <= _threshold // 4:
+            return None
+        data, encoding = value.encode(), "text"
+    elif isinstance(value, bytes):
+        data, encoding = value, "bytes"
+    else:
+        data, encoding = json.dumps(value, separators=(",", ":"), default=str).encode(), "json"
+    return (data, encoding) if len(data) > _threshold else None
+
+
+def _reference(digest, data, encoding):
+    ref = {BLOB_KEY: digest, "size": len(data), "encoding": encoding}
+    if _preview_chars and encoding != "bytes":
+        ref["preview"] = data[:_preview_chars].decode(errors="ignore")
+    return ref
+
+
+def offload(value):
+    # Returns the value itself, or a reference dict when its serialized
+    # form is larger than the threshold.
+    payload = _payload(value)
+    if payload is None:
+        return value
+    return _reference(get_blobstore().put(payload[0]), *payload)
+
+
+async def offload_async(value):
+    # offload() for the event loop: the blob is hashed and written on a thread.
+    payload = _payload(value)
+    if payload is None:
+        return value
+    return _reference(await get_blobstore().put_async(payload[0]), *payload)
+
+
+def load(value):
+    # Inverse of offload(); anything that is not a reference passes through.
+    if not is_ref(value):
+        return value
+    return _decode(value, get_blobstore().get(value[BLOB_KEY]))
+
+
+async def load_async(value):
+    # load() for the event loop: the blob is read on a thread.
+    if not is_ref(value):
+        return value
+    return _decode(value, await get_blobstore().get_async(value[BLOB_KEY]))
+
+
+def _decode(value, data):
+    if value.get("encoding") == "bytes":
+        return data
+    if value.get("encoding") == "text":
+        return data.decode()
+    return json.loads(data)
+
+
+def load_payloads(record):
+    # Resolves input_data/output_data of a task or workflow record in place.
+    for field in ("input_data", "output_data", "output"):
+        if field in record:
+            value = record[field]
+            record[field] = [load(arg) for arg in value] if isinstance(value, list) else load(value)
+    for task in record.get("tasks") or ():
+        load_payloads(task)
+    return record
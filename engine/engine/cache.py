@@ -0,0 +1,221 @@
+import asyncio
+import hashlib
+import json
+import os
+import pickle
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+def _canonical_default(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    if isinstance(value, bytes):
+        return value.hex()
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    return repr(value)
+
+
+def canonical(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=_canonical_default)
+
+
+def cache_key(func, args=(), kwargs=None, key_func=None):
+    if key_func is not None:
+        payload = canonical(key_func(*args, **(kwargs or {})))
+    else:
+        payload = canonical([list(args), kwargs or {}])
+    name = f"{func.__module__}.{func.__qualname__}"
+    return hashlib.sha256(f"{name}\0{payload}".encode()).hexdigest()
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+    def to_dict(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "evictions": self.evictions,
+        }
+
+
+class TaskCache:
+    def __init__(self, max_entries=1024, max_memory_bytes=64 * 1024 * 1024, ttl=None,
+                 directory="task_cache", max_disk_bytes=1024 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = CacheStats()
+        # key -> (expires_at, value, size), least recently used first
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._executor = None
+
+    async def _submit(self, func, *args):
+        # The disk tier (pickling, file I/O, eviction scans) runs on one
+        # thread of its own, so it never blocks the event loop and its
+        # bookkeeping is only touched there.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="engine-cache")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, key):
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[0] is None or entry[0] > now:
+                self._memory.move_to_end(key)
+                self.stats.hits += 1
+                self.stats.memory_hits += 1
+                return True, entry[1]
+            self._forget(key)
+        if self.directory:
+            found, expires_at, value, size = await self._submit(self._disk_get, key, now)
+            if found:
+                self._remember(key, expires_at, value, size)
+                self.stats.hits += 1
+                self.stats.disk_hits += 1
+                return True, value
+        self.stats.misses += 1
+        return False, None
+
+    async def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        size = await self._submit(self._store, key, expires_at, value)
+        if size is not None:
+            self._remember(key, expires_at, value, size)
+
+    def _store(self, key, expires_at, value):
+        # Returns the pickled size, or None when the value cannot be cached.
+        try:
+            data = pickle.dumps((expires_at, value), pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning(f"Not caching unpicklable result: {e}")
+            return None
+        if self.directory:
+            self._disk_set(key, data)
+        return len(data)
+
+    def _remember(self, key, expires_at, value, size):
+        if size > self.max_memory_bytes:
+            return
+        self._forget(key)
+        self._memory[key] = (expires_at, value, size)
+        self._memory_bytes += size
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_memory_bytes:
+            oldest = next(iter(self._memory))
+            self._forget(oldest)
+            self.stats.evictions += 1
+
+    def _forget(self, key):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= entry[2]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _disk_get(self, key, now):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            expires_at, value = pickle.loads(data)
+        except FileNotFoundError:
+            return False, None, None, 0
+        except Exception as e:
+            logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+            self._disk_remove(path)
+            return False, None, None, 0
+        if expires_at is not None and expires_at <= now:
+            self._disk_remove(path)
+            return False, None, None, 0
+        os.utime(path)
+        return True, expires_at, value, len(data)
+
+    def _disk_set(self, key, data):
+        if len(data) > self.max_disk_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        usage = self._disk_usage()
+        previous = os.path.getsize(path) if os.path.exists(path) else 0
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        self._disk_bytes = usage - previous + len(data)
+        if self._disk_bytes > self.max_disk_bytes:
+            self._disk_evict()
+
+    def _disk_remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        if self._disk_bytes is not None:
+            self._disk_bytes -= size
+
+    def _entries(self):
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if not entry.name.endswith(".tmp"):
+                        yield entry
+
+    def _disk_usage(self):
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(entry.stat().st_size for entry in self._entries())
+        return self._disk_bytes
+
+    def _disk_evict(self):
+        # Oldest access first; disk hits touch the file's mtime.
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            self._disk_remove(entry.path)
+            self.stats.evictions += 1
+
+    def clear(self):
+        self._memory.clear()
+        self._memory_bytes = 0
+        if self.directory and os.path.isdir(self.directory):
+            for entry in list(self._entries()):
+                self._disk_remove(entry.path)
+        self._disk_bytes = 0
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = TaskCache(directory=os.environ.get("ENGINE_CACHE_DIR", "task_cache"))
+    return _cache
+
+
+def configure_cache(**kwargs):
+    global _cache
+    _cache = TaskCache(**kwargs)
+    return _cache
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import time
+import uuid
+
+from engine import db
+from engine.blobstore import load_async
+from engine.cache import canonical
+from engine.task import TaskState
+from engine.utils import get_logger
+from engine.writer import persist_checkpoint
+
+logger = get_logger(__name__)
+
+
+def task_name(task_func):
+    return f"{task_func.__module__}.{task_func.__qualname__}"
+
+
+def workflow_version(name, nodes):
+    # Any change to the tasks, their order, arguments or wiring gives a new
+    # version, and checkpoints written under an older one are ignored.
+    definition = [name] + [
+        [str(node.key), task_name(node.task_func), list(node.args), node.kwargs, [str(key) for key in node.upstream]]
+        for node in nodes
+    ]
+    return hashlib.sha256(canonical(definition).encode()).hexdigest()[:16]
+
+
+class RestoredTaskResult:
+    # Stands in for the TaskResult of a step skipped on resume: the record
+    # saved when it ran, marked restored, so the rerun's workflow record
+    # still lists it. output_data is the checkpoint's output with any blob
+    # reference already loaded.
+    __slots__ = ("name", "id", "state", "error_message", "output_data", "record")
+
+    def __init__(self, checkpoint, output_data):
+        record = checkpoint.get("task_result") or {"name": checkpoint["task"].rsplit(".", 1)[-1],
+                                                   "id": str(uuid.uuid4()), "state": TaskState.SUCCESS.name}
+        self.record = dict(record, output_data=checkpoint.get("output"), restored=True)
+        self.name = self.record["name"]
+        self.id = self.record["id"]
+        self.state = TaskState.SUCCESS
+        self.error_message = None
+        self.output_data = output_data
+
+    def to_dict(self):
+        return self.record
+
+
+async def load_checkpoints(job_id, version, nodes):
+    # Returns {node key: RestoredTaskResult} for the steps that can be skipped.
+    try:
+        records = await db.load_checkpoints(job_id)
+    except Exception as e:
+        logger.error(f"Could not load checkpoints for job {job_id}, running from the start: {e}")
+        return {}
+    by_step = {record["step"]: record for record in records}
+    completed = {}
+    stale = 0
+    for step, node in enumerate(nodes):
+        record = by_step.get(step)
+        if record is None:
+            continue
+        if record.get("version") != version or record.get("task") != task_name(node.task_func):
+            stale += 1
+            continue
+        completed[node.key] = record
+    # Blob reads go to a thread, all at once rather than one after another.
+    outputs = await asyncio.gather(*(load_async(record.get("output")) for record in completed.values()))
+    completed = {key: RestoredTaskResult(record, output) for (key, record), output in zip(completed.items(), outputs)}
+    if stale:
+        logger.warning(f"Ignoring {stale} stale checkpoints for job {job_id}: workflow definition changed")
+    return completed
+
+
+async def save_checkpoint(job_id, step, node, version, task_result, durable=False):
+    if hasattr(task_result, "offload_payloads"):
+        await task_result.offload_payloads()
+    record = dict(task_result.to_dict())
+    output = record.pop("output_data")
+    await persist_checkpoint({
+        "job_id": job_id,
+        "step": step,
+        "task": task_name(node.task_func),
+        "version": version,
+        "output": output,
+        "task_result": record,
+        "created_at": time.time_ns(),
+    }, durable)
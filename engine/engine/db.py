@@ -1,27 +1,428 @@
-from surrealdb import Surreal
+import asyncio
+import contextlib
+import os
+import time
+import uuid
+from collections import deque
+
+try:
+    from surrealdb import Surreal
+except ImportError:
+    Surreal = None
+
+try:
+    from websockets.exceptions import ConnectionClosed
+except ImportError:
+    ConnectionClosed = ConnectionError
+
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+SURREAL_URL = os.environ.get("SURREAL_URL", "ws://localhost:8000/rpc")
+SURREAL_USER = os.environ.get("SURREAL_USER", "root")
+SURREAL_PASS = os.environ.get("SURREAL_PASS", "root")
+SURREAL_NS = os.environ.get("SURREAL_NS", "test")
+SURREAL_DB = os.environ.get("SURREAL_DB", "test")
+# How long applied batch ids are kept to recognise a resent batch (seconds).
+WRITE_BATCH_TTL = int(os.environ.get("ENGINE_WRITE_BATCH_TTL", 24 * 3600))
+
+# Errors that mean the websocket is gone and the connection must be replaced.
+CONNECTION_ERRORS = (ConnectionError, OSError, ConnectionClosed, asyncio.TimeoutError)
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.connects = 0
+        self.reconnects = 0
+        self.closed_idle = 0
+        self.errors = 0
+
+    def to_dict(self):
+        return {
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "wait_time": self.wait_time,
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "closed_idle": self.closed_idle,
+            "errors": self.errors,
+        }
+
+
+class SurrealPool:
+    def __init__(self, url=SURREAL_URL, user=SURREAL_USER, password=SURREAL_PASS,
+                 namespace=SURREAL_NS, database=SURREAL_DB, max_size=10,
+                 idle_timeout=60.0, connect_timeout=10.0, client_factory=Surreal):
+        self.url = url
+        self.user = user
+        self.password = password
+        self.namespace = namespace
+        self.database = database
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.client_factory = client_factory
+        self.metrics = PoolMetrics()
+        self._loop = None
+        self._idle = deque()
+        self._size = 0
+        self._cond = None
+
+    def _bind_loop(self):
+        # Connections and the condition belong to one event loop. A new
+        # asyncio.run() in the same process starts over with a fresh pool.
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._idle = deque()
+            self._size = 0
+            self._cond = asyncio.Condition()
+
+    async def _connect(self):
+        if self.client_factory is None:
+            raise RuntimeError("surrealdb is not installed; install it or set ENGINE_BACKEND=sqlite")
+        db = self.client_factory(self.url)
+        try:
+            await asyncio.wait_for(db.connect(), self.connect_timeout)
+            await db.signin({"user": self.user, "pass": self.password})
+            await db.use(self.namespace, self.database)
+        except BaseException:
+            await self._close_quietly(db)
+            raise
+        self.metrics.connects += 1
+        return db
+
+    async def _close_quietly(self, db):
+        try:
+            await db.close()
+        except Exception:
+            pass
+
+    async def _prune_idle(self):
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            db, _ = self._idle.popleft()
+            self._size -= 1
+            self.metrics.closed_idle += 1
+            await self._close_quietly(db)
+
+    async def acquire(self):
+        self._bind_loop()
+        async with self._cond:
+            await self._prune_idle()
+            if not self._idle and self._size >= self.max_size:
+                self.metrics.waits += 1
+                started = time.monotonic()
+                await self._cond.wait_for(lambda: self._idle or self._size < self.max_size)
+                self.metrics.wait_time += time.monotonic() - started
+            self.metrics.checkouts += 1
+            if self._idle:
+                # Most recently used first, so surplus connections go idle and expire.
+                db, _ = self._idle.pop()
+                return db
+            self._size += 1
+        try:
+            return await self._connect()
+        except BaseException:
+            async with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    async def release(self, db, discard=False):
+        async with self._cond:
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((db, time.monotonic()))
+            self._cond.notify()
+        if discard:
+            await self._close_quietly(db)
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        db = await self.acquire()
+        try:
+            yield db
+        except CONNECTION_ERRORS:
+            await self.release(db, discard=True)
+            raise
+        except BaseException:
+            await self.release(db)
+            raise
+        else:
+            await self.release(db)
+
+    async def run(self, operation, retries=1):
+        # Run `operation(db)` on a pooled connection, replacing dead
+        # connections and retrying up to `retries` more times. A dropped
+        # connection does not say whether the operation was applied, so
+        # it must be safe to repeat.
+        for attempt in range(retries + 1):
+            try:
+                async with self.connection() as db:
+                    return await operation(db)
+            except CONNECTION_ERRORS as e:
+                self.metrics.errors += 1
+                if attempt >= retries:
+                    raise
+                self.metrics.reconnects += 1
+                logger.warning(f"SurrealDB connection lost ({e!r}), reconnecting")
+
+    async def close(self):
+        if self._cond is None or self._loop is not asyncio.get_running_loop():
+            return
+        async with self._cond:
+            while self._idle:
+                db, _ = self._idle.popleft()
+                self._size -= 1
+                await self._close_quietly(db)
+
+    def stats(self):
+        stats = self.metrics.to_dict()
+        stats["size"] = self._size
+        stats["idle"] = len(self._idle)
+        return stats
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = SurrealPool(
+            max_size=int(os.environ.get("SURREAL_POOL_SIZE", 10)),
+            idle_timeout=float(os.environ.get("SURREAL_POOL_IDLE_TIMEOUT", 60)),
+        )
+    return _pool
+
+
+def configure_pool(**kwargs):
+    global _pool
+    _pool = SurrealPool(**kwargs)
+    return _pool
+
+
+async def close_pool():
+    if _pool is not None:
+        await _pool.close()
+
+
+class StorageBackend:
+    # Everything the engine persists goes through one of these. write_batch
+    # is the hot path; the single-record methods default to a batch of one.
+    #
+    # write_batch gets task and workflow results as to_dict() dicts, or as
+    # the TaskResult / WorkflowResult objects themselves when accepts_records
+    # is true, for backends that serialize them directly (engine.serializers).
+    accepts_records = False
+
+    async def save_task_result(self, task_result):
+        await self.write_batch(task_results=[task_result])
+
+    async def save_workflow_result(self, workflow_result):
+        await self.write_batch(workflow_results=[workflow_result])
+
+    async def create_workflow_status(self, job_id, status):
+        await self.write_batch(statuses={job_id: status})
+
+    async def update_workflow_status(self, job_id, status):
+        await self.write_batch(statuses={job_id: status})
+
+    async def write_batch(self, task_results=(), statuses=None, workflow_results=(), checkpoints=(),
+                          rollups=(), batch_id=None):
+        # rollups are engine.rollups.Rollup dicts to be added to the stored
+        # ones for the same task and window. batch_id names those rollups:
+        # the write-behind queue resends a failed batch under the same id,
+        # and a backend that cannot tell whether it was applied uses it to
+        # apply the rollups once.
+        raise NotImplementedError
+
+    async def load_checkpoints(self, job_id):
+        raise NotImplementedError
+
+    # Read side, used by engine.query. Times are ISO strings for runs and
+    # epoch seconds for rollup windows.
+    async def list_runs(self, name=None, state=None, since=None, until=None, limit=100):
+        raise NotImplementedError
+
+    async def get_run(self, job_id):
+        raise NotImplementedError
+
+    async def load_rollups(self, task=None, since=None, until=None):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class SurrealBackend(StorageBackend):
+    def __init__(self, pool=None, batch_ttl=WRITE_BATCH_TTL):
+        self._pool = pool
+        self.batch_ttl = batch_ttl
+        self._pruned_at = None
+
+    @property
+    def pool(self):
+        return self._pool if self._pool is not None else get_pool()
+
+    async def save_task_result(self, task_result):
+        await self.pool.run(lambda db: db.create(f'task_results:{task_result["id"]}', task_result))
+
+    async def save_workflow_result(self, workflow_result):
+        await self.pool.run(lambda db: db.create(f'workflow_results:{workflow_result["job_id"]}', workflow_result))
+
+    async def create_workflow_status(self, job_id, status):
+        await self.pool.run(lambda db: db.create(f'workflow_status:{job_id}', {"status": status}))
+
+    async def update_workflow_status(self, job_id, status):
+        await self.pool.run(lambda db: db.update(f'workflow_status:{job_id}', {"status": status}))
+
+    async def write_batch(self, task_results=(), statuses=None, workflow_results=(), checkpoints=(),
+                          rollups=(), batch_id=None):
+        # One round-trip and one transaction per batch. UPDATE on a record id
+        # creates the record when it does not exist yet.
+        rows = [("task_results", r["id"], "CONTENT", r) for r in task_results]
+        rows += [("workflow_status", job_id, "MERGE", {"status": s}) for job_id, s in (statuses or {}).items()]
+        rows += [("workflow_results", r["job_id"], "CONTENT", r) for r in workflow_results]
+        rows += [("checkpoints", [c["job_id"], c["step"]], "CONTENT", c) for c in checkpoints]
+        if not rows and not rollups:
+            return
+        statements = ["BEGIN TRANSACTION;"]
+        params = {}
+        for i, (table, record_id, verb, data) in enumerate(rows):
+            statements.append(f"UPDATE type::thing('{table}', $id{i}) {verb} $data{i};")
+            params[f"id{i}"] = record_id
+            params[f"data{i}"] = {k: v for k, v in data.items() if k != "id"}
+        if rollups:
+            # The rollup += updates are not idempotent, and a batch is sent
+            # again after a dropped connection (pool.run) or a failed flush
+            # (the write-behind queue), possibly after it was committed.
+            # They only apply if the batch id is not recorded yet.
+            params["batch"] = batch_id or uuid.uuid4().hex
+            statements.append("IF array::len((SELECT VALUE id FROM type::thing('write_batches', $batch))) = 0 {")
+            for i, rollup in enumerate(rollups):
+                # Bucket indexes are ints we generate, so they are safe to inline.
+                buckets = "".join(f", buckets.b{int(index)} += {int(count)}"
+                                  for index, count in rollup["buckets"].items())
+                statements.append(
+                    f"UPDATE type::thing('task_rollups', $rid{i}) SET task = $rollup{i}.task, "
+                    f"window_start = $rollup{i}.window_start, count += $rollup{i}.count, "
+                    f"failures += $rollup{i}.failures, timeouts += $rollup{i}.timeouts, "
+                    f"retries += $rollup{i}.retries, duration_sum += $rollup{i}.duration_sum{buckets};")
+                params[f"rid{i}"] = [rollup["task"], rollup["window_start"]]
+                params[f"rollup{i}"] = rollup
+            statements.append("};")
+            statements.append("UPDATE type::thing('write_batches', $batch) SET created_at = time::now();")
+            # Ids only need to outlive the resends of their batch; old ones
+            # are dropped along with a batch, at most once per tenth of the TTL.
+            now = time.monotonic()
+            if self._pruned_at is None or now - self._pruned_at >= self.batch_ttl / 10:
+                self._pruned_at = now
+                statements.append("DELETE write_batches WHERE created_at < time::now() - type::duration($ttl);")
+                params["ttl"] = f"{int(self.batch_ttl)}s"
+        statements.append("COMMIT TRANSACTION;")
+        query = "\n".join(statements)
+        await self.pool.run(lambda db: db.query(query, params))
+
+    async def load_checkpoints(self, job_id):
+        response = await self.pool.run(
+            lambda db: db.query("SELECT * FROM checkpoints WHERE job_id = $job_id ORDER BY step;", {"job_id": job_id}))
+        return response[0]["result"] if response else []
+
+    async def _select(self, query, params):
+        response = await self.pool.run(lambda db: db.query(query, params))
+        return response[0]["result"] if response else []
+
+    async def list_runs(self, name=None, state=None, since=None, until=None, limit=100):
+        filters = {"name = $name": name, "state = $state": state,
+                   "start_time >= $since": since, "start_time < $until": until}
+        where = " AND ".join(condition for condition, value in filters.items() if value is not None)
+        return await self._select(
+            "SELECT job_id, name, state, start_time, end_time, duration, error_message FROM workflow_results"
+            + (f" WHERE {where}" if where else "") + " ORDER BY start_time DESC LIMIT $limit;",
+            {"name": name, "state": state, "since": since, "until": until, "limit": limit})
+
+    async def get_run(self, job_id):
+        runs = await self._select("SELECT * FROM type::thing('workflow_results', $job_id);", {"job_id": job_id})
+        if not runs:
+            return None
+        status = await self._select("SELECT status FROM type::thing('workflow_status', $job_id);", {"job_id": job_id})
+        run = runs[0]
+        run["status"] = status[0]["status"] if status else None
+        return run
+
+    async def load_rollups(self, task=None, since=None, until=None):
+        filters = {"task = $task": task, "window_start >= $since": since, "window_start < $until": until}
+        where = " AND ".join(condition for condition, value in filters.items() if value is not None)
+        rows = await self._select("SELECT * FROM task_rollups" + (f" WHERE {where}" if where else "") + ";",
+                                  {"task": task, "since": since, "until": until})
+        for row in rows:
+            row["buckets"] = {index[1:]: count for index, count in (row.get("buckets") or {}).items()}
+        return rows
+
+    async def close(self):
+        await self.pool.close()
+
+
+BACKENDS = ("surreal", "sqlite", "journal")
+_backend = None
+
+
+def create_backend(name, **kwargs):
+    if name == "surreal":
+        return SurrealBackend(**kwargs)
+    if name == "sqlite":
+        from engine.sqlite_store import SQLiteBackend
+        return SQLiteBackend(**kwargs)
+    if name == "journal":
+        from engine.journal import JournalBackend
+        return JournalBackend(**kwargs)
+    raise ValueError(f"Unknown storage backend {name!r}, expected one of {BACKENDS}")
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = create_backend(os.environ.get("ENGINE_BACKEND", "surreal"))
+    return _backend
+
+
+def set_backend(backend, **kwargs):
+    # Takes a StorageBackend or a backend name plus its options.
+    global _backend
+    _backend = create_backend(backend, **kwargs) if isinstance(backend, str) else backend
+    return _backend
+
+
+async def close_backend():
+    if _backend is not None:
+        await _backend.close()
 
 
 async def save_task_result(task_result):
-    async with Surreal("ws://localhost:8000/rpc") as db:
-            await db.signin({"user": "root", "pass": "root"})
-            await db.use("test", "test")
-            await db.create(f'task_results:{task_result["id"]}', task_result)
+    await get_backend().save_task_result(task_result)
 
 async def save_workflow_result(workflow_result):
-    async with Surreal("ws://localhost:8000/rpc") as db:
-        await db.signin({"user": "root", "pass": "root"})
-        await db.use("test", "test")    
-        await db.create(f'workflow_results:{workflow_result["job_id"]}', workflow_result)
+    await get_backend().save_workflow_result(workflow_result)
 
 async def create_workflow_status(job_id, status):
-    async with Surreal("ws://localhost:8000/rpc") as db:
-        await db.signin({"user": "root", "pass": "root"})
-        await db.use("test", "test")
-        await db.create(f'workflow_status:{job_id}', {"status": status})
+    await get_backend().create_workflow_status(job_id, status)
 
 async def update_workflow_status(job_id, status):
-    print(job_id, status)
-    async with Surreal("ws://localhost:8000/rpc") as db:
-        await db.signin({"user": "root", "pass": "root"})
-        await db.use("test", "test")
-        await db.update(f'workflow_status:{job_id}', {"status": status})
\ No newline at end of file
+    logger.debug("workflow_status=%s status=%s", job_id, status)
+    await get_backend().update_workflow_status(job_id, status)
+
+
+async def write_batch(task_results=(), statuses=None, workflow_results=(), checkpoints=(), rollups=(),
+                      batch_id=None):
+    await get_backend().write_batch(task_results, statuses, workflow_results, checkpoints, rollups, batch_id)
+
+
+async def load_checkpoints(job_id):
+    return await get_backend().load_checkpoints(job_id)
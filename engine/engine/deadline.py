@@ -0,0 +1,61 @@
+import asyncio
+import contextvars
+import time
+
+# Absolute wall-clock deadline (time.time()), so it means the same thing in
+# executor threads and worker processes.
+_deadline = contextvars.ContextVar("engine_deadline", default=None)
+# Set when an executor call is abandoned by its task; see check().
+_cancel_event = contextvars.ContextVar("engine_cancel_event", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+def current_deadline():
+    return _deadline.get()
+
+
+def remaining():
+    # Seconds left before the innermost deadline, or None when there is none.
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+
+def use_deadline(seconds=None, at=None):
+    # A nested deadline can only shorten the one it runs under. Returns a
+    # token for reset_deadline().
+    deadline = at if at is not None else time.time() + seconds
+    outer = _deadline.get()
+    if outer is not None and outer < deadline:
+        deadline = outer
+    return _deadline.set(deadline)
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+def effective_timeout(timeout=None):
+    left = remaining()
+    if left is None:
+        return timeout
+    left = max(left, 0.0)
+    return left if timeout is None else min(timeout, left)
+
+
+def bind_cancel_event(event):
+    _cancel_event.set(event)
+
+
+def check():
+    # For long-running task bodies, including ones on the thread and process
+    # executors, which asyncio cannot interrupt: raises once the task was
+    # cancelled or its deadline has passed.
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise DeadlineExceeded("Task was cancelled")
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("Deadline exceeded")
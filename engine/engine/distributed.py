@@ -0,0 +1,607 @@
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from engine import deadline, events, writer
+from engine.task import TaskState
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+DISPATCH_PATH = os.environ.get("ENGINE_DISPATCH_PATH", "dispatch.db")
+# A task whose worker died is dispatched at most this many times in total.
+MAX_DISPATCHES = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dispatch_tasks (
+    id TEXT PRIMARY KEY,
+    task TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    assigned TEXT,
+    worker TEXT,
+    lease_expires REAL,
+    dispatches INTEGER NOT NULL DEFAULT 0,
+    deadline REAL,
+    created REAL NOT NULL,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS dispatch_tasks_queued ON dispatch_tasks (state, assigned, created);
+CREATE INDEX IF NOT EXISTS dispatch_tasks_worker ON dispatch_tasks (worker, state);
+
+CREATE TABLE IF NOT EXISTS dispatch_workers (
+    id TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    capacity INTEGER NOT NULL,
+    running INTEGER NOT NULL,
+    heartbeat REAL NOT NULL
+);
+"""
+
+INSERT_TASK = ("INSERT INTO dispatch_tasks (id, task, payload, state, assigned, deadline, created) "
+               "VALUES (?, ?, ?, 'QUEUED', ?, ?, ?)")
+UPSERT_WORKER = ("INSERT INTO dispatch_workers (id, host, pid, capacity, running, heartbeat) VALUES (?, ?, ?, ?, ?, ?) "
+                 "ON CONFLICT (id) DO UPDATE SET capacity = excluded.capacity, running = excluded.running, "
+                 "heartbeat = excluded.heartbeat")
+# Load of each live worker: tasks queued for it plus tasks it is running, per slot.
+SELECT_LOADS = ("SELECT w.id, w.capacity, w.running + COUNT(t.id) FROM dispatch_workers w "
+                "LEFT JOIN dispatch_tasks t ON t.assigned = w.id AND t.state = 'QUEUED' "
+                "WHERE w.heartbeat >= ? GROUP BY w.id")
+SELECT_OWN = ("SELECT id FROM dispatch_tasks WHERE state = 'QUEUED' AND (assigned = ? OR assigned IS NULL) "
+              "ORDER BY created LIMIT ?")
+# Tasks that have sat in another worker's queue for too long.
+SELECT_STEALABLE = ("SELECT id FROM dispatch_tasks WHERE state = 'QUEUED' AND assigned != ? AND created <= ? "
+                    "ORDER BY created LIMIT ?")
+
+
+class DispatchError(RuntimeError):
+    pass
+
+
+def task_path(task_func):
+    module, qualname = task_func.__module__, task_func.__qualname__
+    if module == "__main__" or "<locals>" in qualname:
+        raise ValueError(f"Task {qualname} must be defined at module level of an importable module "
+                         f"to be dispatched")
+    return f"{module}:{qualname}"
+
+
+_resolved = {}
+
+
+def resolve_task(path):
+    func = _resolved.get(path)
+    if func is None:
+        module, _, qualname = path.partition(":")
+        func = importlib.import_module(module)
+        for attr in qualname.split("."):
+            func = getattr(func, attr)
+        _resolved[path] = func
+    return func
+
+
+def _marks(values):
+    return ", ".join("?" * len(values))
+
+
+class TaskQueue:
+    # The tables a coordinator and its workers share. Every method blocks;
+    # Coordinator and DistributedWorker call them on a thread of their own.
+    # Each process opens its own connection, so the file must be on a local
+    # disk (or a network filesystem with working locks).
+    def __init__(self, path=DISPATCH_PATH, busy_timeout=10.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so two workers can never
+        # claim the same row.
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def enqueue(self, tasks, worker_ttl):
+        # tasks: [(id, task path, payload, deadline)]. Each goes to the
+        # queue of the least loaded live worker, or to anyone if none is up.
+        now = time.time()
+        with self._transaction() as conn:
+            loads = {}
+            capacity = {}
+            for worker_id, slots, load in conn.execute(SELECT_LOADS, (now - worker_ttl,)):
+                capacity[worker_id] = max(slots, 1)
+                loads[worker_id] = load / capacity[worker_id]
+            rows = []
+            for task_id, path, payload, deadline_at in tasks:
+                assigned = None
+                if loads:
+                    assigned = min(loads, key=loads.get)
+                    loads[assigned] += 1 / capacity[assigned]
+                rows.append((task_id, path, payload, assigned, deadline_at, now))
+            conn.executemany(INSERT_TASK, rows)
+
+    def claim(self, worker_id, limit, steal_after, lease_ttl):
+        # Returns the leased rows and how many of them were stolen.
+        now = time.time()
+        with self._transaction() as conn:
+            ids = [row[0] for row in conn.execute(SELECT_OWN, (worker_id, limit))]
+            stolen = 0
+            if len(ids) < limit:
+                more = [row[0] for row in conn.execute(SELECT_STEALABLE, (worker_id, now - steal_after,
+                                                                          limit - len(ids)))]
+                stolen = len(more)
+                ids += more
+            if not ids:
+                return [], 0
+            conn.execute(f"UPDATE dispatch_tasks SET state = 'LEASED', worker = ?, lease_expires = ?, "
+                         f"dispatches = dispatches + 1 WHERE id IN ({_marks(ids)})",
+                         [worker_id, now + lease_ttl] + ids)
+            rows = conn.execute(f"SELECT id, task, payload, deadline, dispatches FROM dispatch_tasks "
+                                f"WHERE id IN ({_marks(ids)}) ORDER BY created", ids).fetchall()
+        return rows, stolen
+
+    def heartbeat(self, worker_id, capacity, running, lease_ttl):
+        # running: [(task id, dispatches)] held by the worker. Extends their
+        # leases and returns the ids the worker no longer owns: cancelled by
+        # the coordinator, or re-dispatched after the lease ran out.
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(UPSERT_WORKER, (worker_id, socket.gethostname(), os.getpid(), capacity, len(running), now))
+            conn.execute("UPDATE dispatch_tasks SET lease_expires = ? WHERE worker = ? AND state = 'LEASED'",
+                         (now + lease_ttl, worker_id))
+            if not running:
+                return []
+            owned = set(conn.execute("SELECT id, dispatches FROM dispatch_tasks WHERE worker = ? AND state = 'LEASED'",
+                                     (worker_id,)))
+        return [task_id for task_id, dispatches in running if (task_id, dispatches) not in owned]
+
+    def complete(self, task_id, worker_id, dispatches, state, result):
+        # Fenced by worker and dispatch number: a worker whose lease was
+        # taken over cannot overwrite the new attempt. state=None hands the
+        # task back unfinished.
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM dispatch_tasks WHERE id = ? AND state = 'CANCELLED'", (task_id,))
+            if state is None:
+                conn.execute("UPDATE dispatch_tasks SET state = 'QUEUED', worker = NULL, assigned = NULL, "
+                             "lease_expires = NULL WHERE id = ? AND worker = ? AND dispatches = ? AND state = 'LEASED'",
+                             (task_id, worker_id, dispatches))
+            else:
+                conn.execute("UPDATE dispatch_tasks SET state = ?, result = ?, lease_expires = NULL "
+                             "WHERE id = ? AND worker = ? AND dispatches = ? AND state = 'LEASED'",
+                             (state, result, task_id, worker_id, dispatches))
+
+    def expire(self, max_dispatches=MAX_DISPATCHES):
+        # Re-dispatches tasks whose worker stopped heartbeating, or fails
+        # them once they have used up their dispatches.
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM dispatch_tasks WHERE state = 'CANCELLED' AND lease_expires < ?", (now,))
+            failed = conn.execute(
+                "UPDATE dispatch_tasks SET state = 'FAILED', result = ?, lease_expires = NULL "
+                "WHERE state = 'LEASED' AND lease_expires < ? AND dispatches >= ? RETURNING id",
+                (json.dumps({"error": f"Worker lost {max_dispatches} times"}), now, max_dispatches)).fetchall()
+            requeued = conn.execute(
+                "UPDATE dispatch_tasks SET state = 'QUEUED', worker = NULL, assigned = NULL, lease_expires = NULL "
+                "WHERE state = 'LEASED' AND lease_expires < ? RETURNING id", (now,)).fetchall()
+        if requeued or failed:
+            logger.warning(f"Expired leases: {len(requeued)} tasks re-dispatched, {len(failed)} failed")
+        return len(requeued), len(failed)
+
+    def cancel(self, ids):
+        with self._transaction() as conn:
+            conn.execute(f"DELETE FROM dispatch_tasks WHERE id IN ({_marks(ids)}) "
+                         f"AND state IN ('QUEUED', 'DONE', 'FAILED')", ids)
+            conn.execute(f"UPDATE dispatch_tasks SET state = 'CANCELLED' WHERE id IN ({_marks(ids)}) "
+                         f"AND state = 'LEASED'", ids)
+
+    def finished(self, ids):
+        # Takes the DONE/FAILED rows among ids off the queue.
+        rows = []
+        with self._transaction() as conn:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows += conn.execute(f"DELETE FROM dispatch_tasks WHERE id IN ({_marks(chunk)}) "
+                                     f"AND state IN ('DONE', 'FAILED') RETURNING id, state, result", chunk).fetchall()
+        return rows
+
+    def leave(self, worker_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM dispatch_workers WHERE id = ?", (worker_id,))
+            conn.execute("UPDATE dispatch_tasks SET assigned = NULL WHERE assigned = ? AND state = 'QUEUED'",
+                         (worker_id,))
+
+    def stats(self, worker_ttl):
+        conn = self._connection()
+        states = dict(conn.execute("SELECT state, COUNT(*) FROM dispatch_tasks GROUP BY state"))
+        workers = [dict(zip(("id", "host", "pid", "capacity", "running", "heartbeat"), row))
+                   for row in conn.execute("SELECT id, host, pid, capacity, running, heartbeat FROM dispatch_workers "
+                                           "WHERE heartbeat >= ? ORDER BY id", (time.time() - worker_ttl,))]
+        return {"tasks": states, "workers": workers}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class RemoteTaskResult:
+    # Stands in for the TaskResult of a call that ran on a worker, which
+    # persisted the full record itself.
+    __slots__ = ("name", "id", "state", "error_message", "output_data", "record")
+
+    def __init__(self, record, output):
+        self.name = record["name"]
+        self.id = record["id"]
+        self.state = TaskState[record["state"]]
+        self.error_message = record.get("error_message")
+        self.output_data = output
+        self.record = record
+
+    def to_dict(self):
+        return self.record
+
+
+class Coordinator:
+    # Sends @task calls to DistributedWorker processes instead of running
+    # them here: Workflow(..., dispatcher=Coordinator()) dispatches every
+    # task of the run, or call await coordinator.run(task_func, *args).
+    # Arguments and outputs must be JSON-serializable.
+    def __init__(self, path=DISPATCH_PATH, lease_ttl=10.0, poll_interval=0.01, max_dispatches=MAX_DISPATCHES,
+                 busy_timeout=10.0):
+        self.queue = TaskQueue(path, busy_timeout)
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.max_dispatches = max_dispatches
+        self._executor = None
+        self._loop = None
+        self._expired_at = 0.0
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._outbox = []
+            self._cancelled = []
+            self._waiting = {}
+            self._poller = None
+
+    async def _submit(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="engine-dispatch")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def __call__(self, task_func, args, kwargs):
+        return await self.run(task_func, *args, **kwargs)
+
+    async def run(self, task_func, *args, **kwargs):
+        # Returns (task_result, output) like calling the task directly.
+        if not hasattr(task_func, "run_streaming"):
+            raise TypeError(f"{task_func!r} is not a @task function")
+        self._bind()
+        task_id = uuid.uuid4().hex
+        payload = json.dumps({"args": args, "kwargs": kwargs, "job_id": events.current_job()}, separators=(",", ":"))
+        future = self._loop.create_future()
+        # Queued calls go out together on the next poll.
+        self._outbox.append((task_id, task_path(task_func), payload, deadline.current_deadline()))
+        self._waiting[task_id] = future
+        self._wake()
+        try:
+            state, result = await future
+        except asyncio.CancelledError:
+            self._waiting.pop(task_id, None)
+            self._cancelled.append(task_id)
+            self._wake()
+            raise
+        result = json.loads(result)
+        if state == "FAILED":
+            raise DispatchError(result["error"])
+        return RemoteTaskResult(result["task_result"], result["output"]), result["output"]
+
+    def _wake(self):
+        if self._poller is None:
+            self._poller = self._loop.create_task(self._poll())
+
+    def _sync(self, outbox, cancelled, waiting):
+        if outbox:
+            self.queue.enqueue(outbox, self.lease_ttl)
+        if cancelled:
+            self.queue.cancel(cancelled)
+        now = time.time()
+        if now - self._expired_at >= self.lease_ttl / 4:
+            self._expired_at = now
+            self.queue.expire(self.max_dispatches)
+        return self.queue.finished(waiting) if waiting else []
+
+    async def _poll(self):
+        try:
+            while self._waiting or self._outbox or self._cancelled:
+                outbox, self._outbox = self._outbox, []
+                cancelled, self._cancelled = self._cancelled, []
+                try:
+                    finished = await self._submit(self._sync, outbox, cancelled, list(self._waiting))
+                except Exception as e:
+                    logger.error(f"Dispatch queue unavailable, will retry: {e}")
+                    self._outbox = outbox + self._outbox
+                    self._cancelled = cancelled + self._cancelled
+                    await asyncio.sleep(self.poll_interval * 10)
+                    continue
+                for task_id, state, result in finished:
+                    future = self._waiting.pop(task_id, None)
+                    if future is not None and not future.done():
+                        future.set_result((state, result))
+                if not finished:
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            self._poller = None
+
+    async def stats(self):
+        return await self._submit(self.queue.stats, self.lease_ttl)
+
+    async def close(self):
+        if self._executor is not None:
+            await self._submit(self.queue.close)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class DistributedWorkerStats:
+    def __init__(self):
+        self.claimed = 0
+        self.stolen = 0
+        self.completed = 0
+        self.failed = 0
+        self.lost = 0
+
+    def to_dict(self):
+        return {
+            "claimed": self.claimed,
+            "stolen": self.stolen,
+            "completed": self.completed,
+            "failed": self.failed,
+            "lost": self.lost,
+        }
+
+
+class DistributedWorker:
+    # Runs tasks dispatched by a Coordinator. Takes tasks queued for it
+    # first and steals ones that waited steal_after seconds in another
+    # worker's queue. Leases are renewed every heartbeat_interval; a worker
+    # that misses lease_ttl seconds of heartbeats loses its tasks.
+    def __init__(self, path=DISPATCH_PATH, concurrency=16, worker_id=None, lease_ttl=10.0, heartbeat_interval=None,
+                 poll_interval=0.02, max_poll_interval=0.2, steal_after=0.5, drain_timeout=None,
+                 max_dispatches=MAX_DISPATCHES, busy_timeout=10.0):
+        self.queue = TaskQueue(path, busy_timeout)
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval or lease_ttl / 3
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.steal_after = steal_after
+        self.drain_timeout = drain_timeout
+        self.max_dispatches = max_dispatches
+        self.stats = DistributedWorkerStats()
+        self._running = {}
+        self._stopping = False
+        self._executor = None
+        self._loop = None
+
+    async def _submit(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="engine-dispatch")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def stop(self):
+        if not self._stopping:
+            logger.info(f"Worker {self.worker_id} draining: no new tasks claimed")
+            self._stopping = True
+            if self._loop is not None:
+                self._wakeup.set()
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                running = [(task_id, dispatches) for task_id, (dispatches, _) in self._running.items()]
+                for task_id in await self._submit(self.queue.heartbeat, self.worker_id, self.concurrency, running,
+                                                  self.lease_ttl):
+                    entry = self._running.get(task_id)
+                    if entry is not None:
+                        self.stats.lost += 1
+                        entry[1].cancel()
+                await self._submit(self.queue.expire, self.max_dispatches)
+            except Exception as e:
+                logger.error(f"Worker {self.worker_id} heartbeat failed: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def _sleep(self, seconds):
+        # Woken early by stop() or a finished task. Not wait_for(), which
+        # can swallow a cancel that lands as the event is set.
+        timer = self._loop.call_later(seconds, self._wakeup.set)
+        try:
+            await self._wakeup.wait()
+        finally:
+            timer.cancel()
+            self._wakeup.clear()
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        # Register before claiming so coordinators start assigning to us.
+        await self._submit(self.queue.heartbeat, self.worker_id, self.concurrency, [], self.lease_ttl)
+        heartbeat = asyncio.ensure_future(self._heartbeat())
+        logger.info(f"Worker {self.worker_id} serving {self.queue.path} with {self.concurrency} slots")
+        try:
+            idle = 0
+            while not self._stopping:
+                free = self.concurrency - len(self._running)
+                rows = []
+                if free > 0:
+                    try:
+                        rows, stolen = await self._submit(self.queue.claim, self.worker_id, free, self.steal_after,
+                                                          self.lease_ttl)
+                    except sqlite3.Error as e:
+                        logger.error(f"Worker {self.worker_id} could not claim tasks: {e}")
+                        stolen = 0
+                    self.stats.claimed += len(rows)
+                    self.stats.stolen += stolen
+                for task_id, path, payload, deadline_at, dispatches in rows:
+                    future = asyncio.ensure_future(self._execute(task_id, path, payload, deadline_at, dispatches))
+                    self._running[task_id] = (dispatches, future)
+                if rows and len(self._running) < self.concurrency:
+                    idle = 0
+                    continue
+                # Back off while there is nothing to do.
+                idle = 0 if rows else idle + 1
+                await self._sleep(min(self.poll_interval * 2 ** max(idle - 1, 0), self.max_poll_interval))
+            await self._drain()
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+            await self._submit(self.queue.leave, self.worker_id)
+
+    async def _drain(self):
+        if not self._running:
+            return
+        futures = [future for _, future in self._running.values()]
+        logger.info(f"Worker {self.worker_id} waiting for {len(futures)} running tasks")
+        _, pending = await asyncio.wait(futures, timeout=self.drain_timeout)
+        for future in pending:
+            future.cancel()
+        if pending:
+            logger.warning(f"Worker {self.worker_id} handed back {len(pending)} tasks after drain timeout")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _execute(self, task_id, path, payload, deadline_at, dispatches):
+        state = result = None
+        try:
+            task_func = resolve_task(path)
+            data = json.loads(payload)
+            scope = deadline.use_deadline(at=deadline_at) if deadline_at is not None else None
+            # Records and events of the call carry the coordinator's job.
+            job_token = events.use_job(data.get("job_id"))
+            try:
+                task_result, output = await task_func(*data["args"], **data["kwargs"])
+            finally:
+                events.reset_job(job_token)
+                if scope is not None:
+                    deadline.reset_deadline(scope)
+            try:
+                result = json.dumps({"task_result": task_result.to_dict(), "output": output}, separators=(",", ":"))
+            except TypeError as e:
+                raise DispatchError(f"Output of {path} is not JSON-serializable: {e}") from None
+            state = "DONE"
+            self.stats.completed += 1
+        except asyncio.CancelledError:
+            # Cancelled by the coordinator, lost to an expired lease, or cut
+            # off by the drain timeout; handed back below either way.
+            pass
+        except Exception as e:
+            logger.error(f"Worker {self.worker_id} could not run {path}: {e}")
+            state, result = "FAILED", json.dumps({"error": f"{type(e).__name__}: {e}"})
+            self.stats.failed += 1
+        finally:
+            self._running.pop(task_id, None)
+            self._wakeup.set()
+        try:
+            await self._submit(self.queue.complete, task_id, self.worker_id, dispatches, state, result)
+        except sqlite3.Error as e:
+            # The lease runs out and the task is dispatched again.
+            logger.error(f"Worker {self.worker_id} could not report task {task_id}: {e}")
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+        try:
+            await self.run()
+        finally:
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(sig)
+            await writer.shutdown()
+            if self._executor is not None:
+                await self._submit(self.queue.close)
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+def _serve_worker(options, imports):
+    for module in imports:
+        importlib.import_module(module)
+    asyncio.run(DistributedWorker(**options).serve())
+
+
+def _run_workers(args):
+    options = {"path": args.db, "concurrency": args.concurrency, "lease_ttl": args.lease_ttl,
+               "steal_after": args.steal_after, "drain_timeout": args.drain_timeout}
+    if args.processes == 1:
+        _serve_worker(options, args.imports)
+        return
+    # One worker per process, so CPU-bound task bodies use every core.
+    processes = [multiprocessing.Process(target=_serve_worker, args=(options, args.imports), daemon=False)
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed task workers over a shared SQLite queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+    worker = commands.add_parser("worker", help="run workers until SIGTERM/SIGINT")
+    worker.add_argument("--db", default=DISPATCH_PATH)
+    worker.add_argument("--processes", type=int, default=1)
+    worker.add_argument("--concurrency", type=int, default=16, help="tasks at once per process")
+    worker.add_argument("--lease-ttl", type=float, default=10.0)
+    worker.add_argument("--steal-after", type=float, default=0.5)
+    worker.add_argument("--drain-timeout", type=float, default=None)
+    worker.add_argument("--import", dest="imports", action="append", default=[],
+                        help="module to import at startup, e.g. the one defining the tasks")
+    status = commands.add_parser("status", help="print queued/leased task counts and live workers")
+    status.add_argument("--db", default=DISPATCH_PATH)
+    status.add_argument("--lease-ttl", type=float, default=10.0)
+    args = parser.parse_args()
+    if args.command == "worker":
+        _run_workers(args)
+    else:
+        queue = TaskQueue(args.db)
+        print(json.dumps(queue.stats(args.lease_ttl), indent=2))
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+import asyncio
+import contextvars
+import itertools
+import json
+import time
+from collections import OrderedDict, deque
+from enum import Enum
+from urllib.parse import parse_qs, urlsplit
+
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+_current_job = contextvars.ContextVar("engine_current_job", default=None)
+
+
+class EventType(Enum):
+    WORKFLOW_STARTED = "workflow.started"
+    WORKFLOW_PROGRESS = "workflow.progress"
+    WORKFLOW_FINISHED = "workflow.finished"
+    TASK_STARTED = "task.started"
+    TASK_RETRYING = "task.retrying"
+    TASK_COMPLETED = "task.completed"
+    TASK_FAILED = "task.failed"
+    CHUNK_PRODUCED = "chunk.produced"
+
+
+# What a subscriber's full queue does with a new event: drop the oldest
+# queued one, drop the new one, or end the subscription.
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DISCONNECT = "disconnect"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+
+class Event:
+    __slots__ = ("seq", "type", "time_ns", "job_id", "task", "task_id", "data")
+
+    def __init__(self, type, job_id=None, task=None, task_id=None, data=None):
+        self.seq = None
+        self.type = type
+        self.time_ns = time.time_ns()
+        self.job_id = job_id
+        self.task = task
+        self.task_id = task_id
+        self.data = data or {}
+
+    def to_dict(self):
+        return {
+            "seq": self.seq,
+            "type": self.type.value,
+            "time_ns": self.time_ns,
+            "job_id": self.job_id,
+            "task": self.task,
+            "task_id": self.task_id,
+            "data": self.data
+        }
+
+
+class Subscription:
+    # A bounded queue of the bus's events, filtered by type and job. Read it
+    # with `async for event in subscription` or get(); publishing never
+    # waits for a subscriber, the policy decides what a full queue drops.
+    def __init__(self, bus, types=None, job_id=None, maxsize=1000, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}, got {policy!r}")
+        self.bus = bus
+        self.types = frozenset(types) if types else None
+        self.job_id = None if job_id is None else str(job_id)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self._queue = deque()
+        self._waiter = None
+
+    def matches(self, event):
+        return ((self.types is None or event.type in self.types)
+                and (self.job_id is None or str(event.job_id) == self.job_id))
+
+    def _offer(self, event):
+        if len(self._queue) >= self.maxsize:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return
+            if self.policy == DISCONNECT:
+                logger.warning(f"Dropping slow event subscriber after {self.maxsize} queued events")
+                self.close()
+                return
+            self._queue.popleft()
+        self._queue.append(event)
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def get(self, timeout=None):
+        # The next event, or None once closed or after `timeout` seconds.
+        while not self._queue:
+            if self.closed:
+                return None
+            loop = asyncio.get_running_loop()
+            self._waiter = loop.create_future()
+            timer = loop.call_later(timeout, self._wake) if timeout is not None else None
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+                if timer is not None:
+                    timer.cancel()
+            if timeout is not None and not self._queue:
+                return None
+        return self._queue.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.policy == DISCONNECT:
+                self._queue.clear()
+            self.bus._unsubscribe(self)
+            self._wake()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class EventBus:
+    # In-process fan-out of progress events. It also keeps the latest
+    # snapshot of each job it has seen events for, so late subscribers can
+    # start from the current state.
+    def __init__(self, max_snapshots=1000):
+        self.max_snapshots = max_snapshots
+        self.snapshots = OrderedDict()
+        self._subscriptions = ()
+        self._seq = itertools.count(1)
+
+    def subscribe(self, types=None, job_id=None, maxsize=1000, policy=DROP_OLDEST):
+        subscription = Subscription(self, types, job_id, maxsize, policy)
+        self._subscriptions += (subscription,)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+
+    @property
+    def subscribers(self):
+        return len(self._subscriptions)
+
+    def publish(self, event):
+        event.seq = next(self._seq)
+        self._snapshot(event)
+        for subscription in self._subscriptions:
+            if subscription.matches(event):
+                subscription._offer(event)
+
+    def _snapshot(self, event):
+        if event.job_id is None:
+            return
+        job_id = str(event.job_id)
+        snapshot = self.snapshots.get(job_id)
+        if snapshot is None:
+            snapshot = self.snapshots[job_id] = {"job_id": job_id, "name": None, "state": "RUNNING",
+                                                 "completed": 0, "total": None, "task": None,
+                                                 "error_message": None}
+            if len(self.snapshots) > self.max_snapshots:
+                self.snapshots.popitem(last=False)
+        else:
+            self.snapshots.move_to_end(job_id)
+        if event.type is EventType.WORKFLOW_STARTED:
+            snapshot.update(name=event.data.get("name"), total=event.data.get("total"))
+        elif event.type is EventType.WORKFLOW_PROGRESS:
+            snapshot["completed"] = event.data.get("completed")
+        elif event.type is EventType.WORKFLOW_FINISHED:
+            snapshot.update(state=event.data.get("state"), error_message=event.data.get("error_message"))
+        elif event.task is not None:
+            snapshot["task"] = event.task
+        snapshot["updated_ns"] = event.time_ns
+
+    def snapshot(self, job_id):
+        snapshot = self.snapshots.get(str(job_id))
+        return dict(snapshot) if snapshot is not None else None
+
+
+_bus = None
+
+
+def get_bus():
+    global _bus
+    if _bus is None:
+        _bus = EventBus()
+    return _bus
+
+
+def configure_bus(**kwargs):
+    global _bus
+    _bus = EventBus(**kwargs)
+    return _bus
+
+
+def listening():
+    # Events are only built once something has asked for the bus.
+    return _bus is not None
+
+
+def emit(type, task_result=None, job_id=None, **data):
+    bus = _bus
+    if bus is None:
+        return
+    if job_id is None:
+        job_id = _current_job.get()
+    if task_result is not None:
+        bus.publish(Event(type, job_id, task_result.name, task_result.id, data))
+    else:
+        bus.publish(Event(type, job_id, data=data))
+
+
+def emit_task_finished(task_result):
+    if _bus is None:
+        return
+    if task_result.state.name == "SUCCESS":
+        emit(EventType.TASK_COMPLETED, task_result, duration=task_result.duration_seconds,
+             cached=bool(task_result.cache_hits), coalesced=task_result.coalesced)
+    else:
+        emit(EventType.TASK_FAILED, task_result, state=task_result.state.name, error=task_result.error_message,
+             retries=task_result.retries)
+
+
+def current_job():
+    return _current_job.get()
+
+
+def use_job(job_id):
+    # Tags the events of tasks run in this context with the job's id.
+    return _current_job.set(job_id)
+
+
+def reset_job(token):
+    _current_job.reset(token)
+
+
+def _sse(event_type, data, event_id=None):
+    lines = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{lines}event: {event_type}\ndata: {json.dumps(data, default=str)}\n\n".encode()
+
+
+class EventServer:
+    # Server-sent events over plain asyncio streams:
+    #   GET /events?job_id=...&types=task.completed,task.failed
+    #       streams matching events, starting with the job's snapshot
+    #   GET /snapshots[?job_id=...]  the latest snapshot(s) as JSON
+    # Each client gets its own subscription, so a slow client only loses
+    # its own events (per `policy`); a "dropped" event tells it how many.
+    def __init__(self, bus=None, host="127.0.0.1", port=8765, maxsize=1000, policy=DROP_OLDEST, keepalive=15.0):
+        self.bus = bus
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.policy = policy
+        self.keepalive = keepalive
+        self._server = None
+        self._clients = {}
+
+    async def start(self):
+        if self.bus is None:
+            self.bus = get_bus()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Serving workflow events on http://{self.host}:{self.port}/events")
+        return self
+
+    async def close(self):
+        # Ends open streams too; the server alone only stops accepting.
+        if self._server is not None:
+            self._server.close()
+            for subscription in self._clients.values():
+                if subscription is not None:
+                    subscription.close()
+            if self._clients:
+                await asyncio.gather(*self._clients, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _handle(self, reader, writer):
+        handler = asyncio.current_task()
+        self._clients[handler] = None
+        try:
+            request = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()).strip():
+                pass
+            if len(request) < 2 or request[0] != "GET":
+                await self._respond(writer, "405 Method Not Allowed", {"error": "only GET is supported"})
+                return
+            url = urlsplit(request[1])
+            query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            if url.path == "/events":
+                await self._stream(writer, query)
+            elif url.path == "/snapshots":
+                job_id = query.get("job_id")
+                body = self.bus.snapshot(job_id) if job_id else list(self.bus.snapshots.values())
+                await self._respond(writer, "200 OK" if body is not None else "404 Not Found", body)
+            else:
+                await self._respond(writer, "404 Not Found", {"error": f"no such path {url.path}"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self._clients[handler]
+            writer.close()
+
+    async def _respond(self, writer, status, body):
+        data = json.dumps(body, default=str).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + data)
+        await writer.drain()
+
+    async def _stream(self, writer, query):
+        try:
+            types = [EventType(value) for value in query["types"].split(",")] if query.get("types") else None
+        except ValueError as e:
+            await self._respond(writer, "400 Bad Request", {"error": str(e)})
+            return
+        job_id = query.get("job_id")
+        with self.bus.subscribe(types, job_id, self.maxsize, self.policy) as subscription:
+            self._clients[asyncio.current_task()] = subscription
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                         b"Connection: keep-alive\r\nAccess-Control-Allow-Origin: *\r\n\r\n")
+            snapshot = self.bus.snapshot(job_id) if job_id else None
+            if snapshot is not None:
+                writer.write(_sse("snapshot", snapshot))
+            await writer.drain()
+            reported = 0
+            while True:
+                event = await subscription.get(self.keepalive)
+                if subscription.dropped > reported:
+                    writer.write(_sse("dropped", {"count": subscription.dropped - reported}))
+                    reported = subscription.dropped
+                if event is not None:
+                    writer.write(_sse(event.type.value, event.to_dict(), event.seq))
+                elif subscription.closed:
+                    return
+                else:
+                    writer.write(b": keepalive\n\n")
+                await writer.drain()
+
+
+async def start_event_server(**kwargs):
+    # await start_event_server(port=8765): serves the process-wide bus until
+    # closed with `await server.close()`.
+    return await EventServer(**kwargs).start()
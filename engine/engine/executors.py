@@ -0,0 +1,84 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from engine import deadline
+
+EXECUTOR_MODES = ("async", "thread", "process")
+
+_config = {
+    "max_threads": int(os.environ["ENGINE_MAX_THREADS"]) if "ENGINE_MAX_THREADS" in os.environ else None,
+    "max_processes": int(os.environ["ENGINE_MAX_PROCESSES"]) if "ENGINE_MAX_PROCESSES" in os.environ else None,
+    "mp_context": None,
+}
+_pools = {}
+
+
+def configure_executors(max_threads=None, max_processes=None, mp_context=None):
+    shutdown_executors(wait=False)
+    _config.update(max_threads=max_threads, max_processes=max_processes, mp_context=mp_context)
+
+
+def get_executor(mode):
+    pool = _pools.get(mode)
+    if pool is None:
+        if mode == "thread":
+            pool = ThreadPoolExecutor(_config["max_threads"], thread_name_prefix="engine-task")
+        elif mode == "process":
+            pool = ProcessPoolExecutor(_config["max_processes"], mp_context=_config["mp_context"])
+        else:
+            raise ValueError(f"No executor for mode {mode!r}, expected 'thread' or 'process'")
+        _pools[mode] = pool
+    return pool
+
+
+def shutdown_executors(wait=True):
+    for pool in _pools.values():
+        pool.shutdown(wait=wait)
+    _pools.clear()
+
+
+def call_task_body(wrapper, *args, **kwargs):
+    # Runs in the worker process. The decorated wrapper is what the task's
+    # module exposes, so it is what gets pickled; call the original body.
+    return wrapper.__wrapped__(*args, **kwargs)
+
+
+def _timed_call(func, args, kwargs, submitted, deadline_at=None):
+    # time.time() rather than perf_counter() so the measurement is
+    # comparable across the process boundary.
+    token = deadline.use_deadline(at=deadline_at) if deadline_at is not None else None
+    try:
+        started = time.time()
+        result = func(*args, **kwargs)
+        if asyncio.iscoroutine(result):
+            result = asyncio.run(result)
+        return result, started - submitted, time.time() - started
+    finally:
+        if token is not None:
+            deadline.reset_deadline(token)
+
+
+async def run_in_executor(mode, func, args=(), kwargs=None, timeout=None):
+    # Returns (result, queue_wait, run_time) in seconds.
+    cancelled = threading.Event()
+    if mode == "thread":
+        # The call sees the caller's deadline and a cancel flag through
+        # engine.deadline.check(); a process only gets the deadline.
+        context = contextvars.copy_context()
+        context.run(deadline.bind_cancel_event, cancelled)
+        future = get_executor(mode).submit(context.run, _timed_call, func, args, kwargs or {}, time.time())
+    else:
+        future = get_executor(mode).submit(_timed_call, func, args, kwargs or {}, time.time(),
+                                           deadline.current_deadline())
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except BaseException:
+        # Only stops calls that have not started; a running call is told to
+        # stop through the cancel flag, and its result is dropped.
+        cancelled.set()
+        future.cancel()
+        raise
@@ -0,0 +1,196 @@
+import asyncio
+from collections import deque
+
+from engine.stream import TaskStream
+from engine.task import TaskState
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+class TaskNode:
+    def __init__(self, key, task_func, args=(), kwargs=None, upstream=()):
+        self.key = key
+        self.task_func = task_func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.upstream = list(upstream)
+
+
+def output_value(result):
+    # Chat-style tasks return {"response": ...}; downstream tasks receive the
+    # response itself, everything else is passed through unchanged.
+    if isinstance(result, dict) and "response" in result:
+        return result["response"]
+    return result
+
+
+class FlowEngine:
+    def __init__(self, nodes, concurrency=None, on_start=None, on_complete=None, stream_buffer=16,
+                 completed=None, dispatcher=None):
+        self.nodes = {node.key: node for node in nodes}
+        self.order = [node.key for node in nodes]
+        self.concurrency = concurrency
+        self.on_start = on_start
+        self.on_complete = on_complete
+        # dispatcher(task_func, args, kwargs) -> (task_result, result) runs a
+        # task somewhere else, e.g. engine.distributed.Coordinator.
+        self.dispatcher = dispatcher
+        self.results = {}
+        self.task_results = {}
+        self.failed = None
+        self.started = set()
+        self.dependents = {key: [] for key in self.order}
+        for key in self.order:
+            for upstream in self.nodes[key].upstream:
+                if upstream not in self.nodes:
+                    raise ValueError(f"Task {key!r} depends on unknown task {upstream!r}")
+                self.dependents[upstream].append(key)
+        self._check_acyclic()
+        # A streaming task feeds each downstream task that accepts a stream
+        # through its own bounded channel; other consumers get the collected chunks.
+        self.streams = {}
+        for key in self.order:
+            node = self.nodes[key]
+            for upstream in node.upstream:
+                if self._is_stream_edge(upstream, key):
+                    self.streams[(upstream, key)] = TaskStream(stream_buffer)
+        # Outputs of tasks finished in an earlier run of the same job.
+        self.completed = {key: result for key, result in (completed or {}).items()
+                          if key in self.nodes and self.restorable(key)}
+
+    def _check_acyclic(self):
+        remaining = {key: len(node.upstream) for key, node in self.nodes.items()}
+        ready = [key for key, count in remaining.items() if count == 0]
+        seen = 0
+        while ready:
+            key = ready.pop()
+            seen += 1
+            for downstream in self.dependents[key]:
+                remaining[downstream] -= 1
+                if remaining[downstream] == 0:
+                    ready.append(downstream)
+        if seen != len(self.nodes):
+            raise ValueError("Workflow tasks contain a dependency cycle")
+
+    def _is_stream_edge(self, upstream, key):
+        return (getattr(self.nodes[upstream].task_func, "streams", False)
+                and getattr(self.nodes[key].task_func, "accepts_stream", False))
+
+    def _consumes_stream(self, key):
+        return any((upstream, key) in self.streams for upstream in self.nodes[key].upstream)
+
+    def _has_capacity(self, running):
+        return self.concurrency is None or len(running) < self.concurrency
+
+    def _make_ready(self, key, ready, consumers):
+        # Stream consumers are paced by their producer and must run alongside
+        # it, so they get their own queue and never wait for a free slot,
+        # nor behind a node that does.
+        (consumers if self._consumes_stream(key) else ready).append(key)
+
+    def _upstream_value(self, upstream, key):
+        stream = self.streams.get((upstream, key))
+        if stream is not None:
+            return stream
+        return output_value(self.results[upstream])
+
+    async def _run_node(self, node):
+        args = tuple(self._upstream_value(key, node.key) for key in node.upstream) + tuple(node.args)
+        if self.on_start:
+            await self.on_start(node)
+        sinks = [stream for (upstream, _), stream in self.streams.items() if upstream == node.key]
+        if sinks:
+            collect = len(sinks) < len(self.dependents[node.key]) or not self.dependents[node.key]
+            return await node.task_func.run_streaming(sinks, collect, *args, **node.kwargs)
+        # Streams cannot leave the process, so their consumers run here too,
+        # as do map nodes, which are not @task functions themselves.
+        if (self.dispatcher is not None and hasattr(node.task_func, "run_streaming")
+                and not any(isinstance(arg, TaskStream) for arg in args)):
+            return await self.dispatcher(node.task_func, args, node.kwargs)
+        return await node.task_func(*args, **node.kwargs)
+
+    def restorable(self, key):
+        # Stream-connected tasks must run together, so they are never restored.
+        return not any(key in edge for edge in self.streams)
+
+    async def run(self):
+        waiting = {key: set(node.upstream) for key, node in self.nodes.items()}
+        for key, result in self.completed.items():
+            self.results[key] = result
+            self.started.add(key)
+            for downstream in self.dependents[key]:
+                waiting[downstream].discard(key)
+        ready = deque()
+        consumers = deque()
+        for key in self.order:
+            if not waiting[key] and key not in self.completed:
+                self._make_ready(key, ready, consumers)
+        running = {}
+        try:
+            while ready or consumers or running:
+                while self.failed is None and (consumers or (ready and self._has_capacity(running))):
+                    node = self.nodes[consumers.popleft() if consumers else ready.popleft()]
+                    running[asyncio.ensure_future(self._run_node(node))] = node
+                    self._started(node, waiting, ready, consumers)
+                if not running:
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    await self._complete(node, future, waiting, ready, consumers)
+                if self.failed is not None:
+                    # The run has failed, so siblings still running are
+                    # cancelled now rather than awaited.
+                    break
+        finally:
+            for future in running:
+                future.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+            for stream in self.streams.values():
+                stream.abandon()
+        return self.results
+
+    def _started(self, node, waiting, ready, consumers):
+        self.started.add(node.key)
+        # Stream consumers become ready as soon as their producer starts.
+        for downstream in self.dependents[node.key]:
+            if (node.key, downstream) in self.streams:
+                waiting[downstream].discard(node.key)
+                if not waiting[downstream]:
+                    self._make_ready(downstream, ready, consumers)
+
+    async def _complete(self, node, future, waiting, ready, consumers):
+        for upstream in node.upstream:
+            stream = self.streams.get((upstream, node.key))
+            if stream is not None:
+                stream.abandon()
+        try:
+            task_result, result = future.result()
+        except Exception as e:
+            logger.error(f"Task {node.key!r} raised: {e}")
+            self._fail(node, str(e))
+            return
+        self.task_results[node.key] = task_result
+        if self.on_complete:
+            await self.on_complete(node, task_result)
+        if task_result.state != TaskState.SUCCESS:
+            self._fail(node, task_result.error_message)
+            return
+        self.results[node.key] = result
+        for downstream in self.dependents[node.key]:
+            if (node.key, downstream) in self.streams:
+                continue
+            waiting[downstream].discard(node.key)
+            if not waiting[downstream]:
+                self._make_ready(downstream, ready, consumers)
+
+    def _fail(self, node, error_message):
+        if self.failed is None:
+            self.failed = (node, error_message)
+        # Nothing new is scheduled after a failure, so producers must not
+        # block on channels whose consumers will never start.
+        for (upstream, key), stream in self.streams.items():
+            if key not in self.started:
+                stream.abandon()
@@ -0,0 +1,414 @@
+import asyncio
+import json
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from engine.db import StorageBackend
+from engine.rollups import Rollup
+from engine.serializers import decode, get_serializer
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+JOURNAL_DIR = os.environ.get("ENGINE_JOURNAL_DIR", "journal")
+
+# Each record is a 4-byte big-endian payload length, a CRC32 of the
+# payload, then the payload itself, written by the journal's serializer
+# (compact JSON by default). Segments may mix serializers.
+HEADER = struct.Struct(">II")
+
+
+def _field(record, name):
+    # Task and workflow records may be the result objects themselves.
+    return record.get(name) if isinstance(record, dict) else getattr(record, name, None)
+
+
+def _entry(kind, record):
+    # The key decides which records replace each other on compaction;
+    # job is what the sparse index is keyed by.
+    if kind == "task_result":
+        key = _field(record, "id") or f"{_field(record, 'name')}:{_field(record, 'start_time')}"
+        job = _field(record, "job_id")
+    elif kind == "checkpoint":
+        key = f"{record['job_id']}:{record['step']}"
+        job = record["job_id"]
+    elif kind == "rollup":
+        key = f"{record['task']}:{record['window_start']}"
+        job = None
+    else:
+        job = _field(record, "job_id")
+        key = job if job is not None else f"{_field(record, 'name')}:{_field(record, 'start_time')}"
+    return {"kind": kind, "key": key, "job": job, "record": record}
+
+
+def _fold(state, entry):
+    # Later records replace earlier ones with the same key, except rollups,
+    # which are counts and add up.
+    key = (entry["kind"], entry["key"])
+    previous = state.get(key)
+    if previous is not None and entry["kind"] == "rollup":
+        merged = Rollup.from_dict(previous["record"]).merge(Rollup.from_dict(entry["record"]))
+        entry = dict(entry, record=merged.to_dict())
+    state[key] = entry
+
+
+def frame(entry, serializer=None):
+    # (job, buffers, size) of one record, ready for Journal.append_frames.
+    # The payload buffers are not joined, so large bytes are copied once,
+    # into the batch.
+    parts = get_serializer(serializer).dump_parts(entry)
+    crc = size = 0
+    for part in parts:
+        crc = zlib.crc32(part, crc)
+        size += len(part)
+    return entry["job"], [HEADER.pack(size, crc)] + parts, HEADER.size + size
+
+
+def encode(entry, serializer=None):
+    return b"".join(frame(entry, serializer)[1])
+
+
+def read_segment(path, start=0, end=None):
+    # Yields (offset, next offset, entry). Stops at the first torn or corrupt record,
+    # which can only be the tail of the segment that was being written.
+    with open(path, "rb") as file:
+        file.seek(start)
+        offset = start
+        while end is None or offset <= end:
+            header = file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, crc = HEADER.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            end_offset = offset + HEADER.size + length
+            yield offset, end_offset, decode(payload)
+            offset = end_offset
+
+
+class Segment:
+    def __init__(self, directory, seq):
+        self.seq = seq
+        self.path = os.path.join(directory, f"{seq:08d}.log")
+        self.index_path = os.path.join(directory, f"{seq:08d}.idx")
+        # Sparse index: job_id -> [first offset, last offset] in this segment.
+        self.jobs = {}
+        self.size = 0
+
+    def add(self, job, offset):
+        if job is None:
+            return
+        job = str(job)
+        span = self.jobs.get(job)
+        if span is None:
+            self.jobs[job] = [offset, offset]
+        else:
+            span[1] = offset
+
+    def scan(self):
+        # Rebuilds the index and returns the offset after the last good record.
+        self.jobs = {}
+        end = 0
+        for offset, end, entry in read_segment(self.path):
+            self.add(entry["job"], offset)
+        return end
+
+    def load_index(self):
+        try:
+            with open(self.index_path) as file:
+                self.jobs = json.load(file)
+            self.size = os.path.getsize(self.path)
+        except (OSError, ValueError):
+            self.size = self.scan()
+            self.write_index()
+
+    def write_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(self.jobs, file, separators=(",", ":"))
+        os.replace(tmp, self.index_path)
+
+    def remove(self):
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class Journal:
+    def __init__(self, directory=JOURNAL_DIR, segment_bytes=64 * 1024 * 1024, fsync=True, serializer=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        # Only decides how new records are written; reads detect the format.
+        self.serializer = get_serializer(serializer)
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+        self.sealed = []
+        self._open()
+
+    def _open(self):
+        seqs = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log"))
+        for seq in seqs[:-1]:
+            segment = Segment(self.directory, seq)
+            segment.load_index()
+            self.sealed.append(segment)
+        self.active = Segment(self.directory, seqs[-1] if seqs else 1)
+        if os.path.exists(self.active.path):
+            end = self.active.scan()
+            if end < os.path.getsize(self.active.path):
+                logger.warning(f"Truncating torn tail of {self.active.path} at offset {end}")
+                with open(self.active.path, "r+b") as file:
+                    file.truncate(end)
+            self.active.size = end
+        self._file = open(self.active.path, "ab")
+
+    def _rotate(self):
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self.active.write_index()
+        self.sealed.append(self.active)
+        self.active = Segment(self.directory, self.active.seq + 1)
+        self._file = open(self.active.path, "ab")
+
+    def frame(self, entry):
+        return frame(entry, self.serializer)
+
+    def append(self, entries):
+        self.append_frames([self.frame(entry) for entry in entries])
+
+    def append_frames(self, frames):
+        # Group commit: one write for the batch, and one fsync shared by
+        # every thread whose batch landed before it.
+        with self._lock:
+            if self.active.size >= self.segment_bytes:
+                self._rotate()
+            chunks = []
+            for job, parts, size in frames:
+                self.active.add(job, self.active.size)
+                self.active.size += size
+                chunks += parts
+            self._file.write(b"".join(chunks))
+            self._written += 1
+            ticket = self._written
+        if self.fsync:
+            self._sync(ticket)
+        else:
+            with self._lock:
+                self._file.flush()
+
+    def append_record(self, kind, record):
+        self.append([_entry(kind, record)])
+
+    def _sync(self, ticket):
+        with self._sync_lock:
+            if self._synced >= ticket:
+                return
+            with self._lock:
+                self._file.flush()
+                target = self._written
+                # A dup stays valid if another thread rotates meanwhile.
+                fd = os.dup(self._file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._synced = target
+
+    def segments(self):
+        with self._lock:
+            self._file.flush()
+            return self.sealed + [self.active]
+
+    def scan(self):
+        for segment in self.segments():
+            for _, _, entry in read_segment(segment.path):
+                yield entry
+
+    def job_entries(self, job_id):
+        # Only reads the offset range each segment's index gives for the job.
+        job_id = str(job_id)
+        for segment in self.segments():
+            span = segment.jobs.get(job_id)
+            if span is None:
+                continue
+            for _, _, entry in read_segment(segment.path, span[0], span[1]):
+                if entry["job"] is not None and str(entry["job"]) == job_id:
+                    yield entry
+
+    def latest(self, kind=None):
+        # {(kind, key): record} as of the last write.
+        state = {}
+        for entry in self.scan():
+            if kind is None or entry["kind"] == kind:
+                _fold(state, entry)
+        return {key: entry["record"] for key, entry in state.items()}
+
+    def compact(self):
+        # Rewrites the sealed segments into one holding the latest record per
+        # key. It takes the highest sealed sequence number, so replay order
+        # stays correct even if we crash before the old segments are removed.
+        with self._lock:
+            sealed = list(self.sealed)
+        if not sealed:
+            return 0
+        latest = {}
+        count = 0
+        for segment in sealed:
+            for _, _, entry in read_segment(segment.path):
+                _fold(latest, entry)
+                count += 1
+        target = Segment(self.directory, sealed[-1].seq)
+        tmp = target.path + ".tmp"
+        with open(tmp, "wb") as file:
+            for entry in latest.values():
+                data = encode(entry, self.serializer)
+                target.add(entry["job"], target.size)
+                target.size += len(data)
+                file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, target.path)
+        target.write_index()
+        for segment in sealed[:-1]:
+            segment.remove()
+        with self._lock:
+            self.sealed = [target] + self.sealed[len(sealed):]
+        logger.info(f"Compacted {len(sealed)} journal segments: {count} records down to {len(latest)}")
+        return count - len(latest)
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self.active.write_index()
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = Journal()
+        return _journal
+
+
+def configure_journal(**kwargs):
+    global _journal
+    with _journal_lock:
+        _journal = Journal(**kwargs)
+        return _journal
+
+
+class JournalBackend(StorageBackend):
+    # Persists through the process-wide journal unless given its own options.
+    def __init__(self, journal=None, **kwargs):
+        self._journal = journal
+        self._options = kwargs
+        self._executor = None
+
+    @property
+    def journal(self):
+        if self._journal is None:
+            self._journal = Journal(**self._options) if self._options else get_journal()
+        return self._journal
+
+    async def _submit(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="engine-journal")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    @property
+    def accepts_records(self):
+        return self.journal.serializer.records
+
+    async def write_batch(self, task_results=(), statuses=None, workflow_results=(), checkpoints=(),
+                          rollups=(), batch_id=None):
+        entries = [_entry("task_result", r) for r in task_results]
+        entries += [_entry("workflow_status", {"job_id": job_id, "status": status})
+                    for job_id, status in (statuses or {}).items()]
+        entries += [_entry("workflow_result", r) for r in workflow_results]
+        entries += [_entry("checkpoint", c) for c in checkpoints]
+        entries += [_entry("rollup", r) for r in rollups]
+        if not entries:
+            return
+        if self.accepts_records:
+            # Result objects may still change once control returns to the
+            # loop, so they are encoded here rather than on the journal thread.
+            await self._submit(self.journal.append_frames, [self.journal.frame(entry) for entry in entries])
+        else:
+            await self._submit(self.journal.append, entries)
+
+    async def load_checkpoints(self, job_id):
+        def read():
+            latest = {}
+            for entry in self.journal.job_entries(job_id):
+                if entry["kind"] == "checkpoint":
+                    latest[entry["record"]["step"]] = entry["record"]
+            return [latest[step] for step in sorted(latest)]
+        return await self._submit(read)
+
+    def _list_runs(self, name, state, since, until, limit):
+        runs = []
+        for run in self.journal.latest("workflow_result").values():
+            if ((name is None or run.get("name") == name) and (state is None or run.get("state") == state)
+                    and (since is None or (run.get("start_time") or "") >= since)
+                    and (until is None or (run.get("start_time") or "") < until)):
+                runs.append({k: v for k, v in run.items() if k != "tasks"})
+        runs.sort(key=lambda run: run.get("start_time") or "", reverse=True)
+        return runs[:limit]
+
+    def _get_run(self, job_id):
+        run = status = None
+        for entry in self.journal.job_entries(job_id):
+            if entry["kind"] == "workflow_result":
+                run = entry["record"]
+            elif entry["kind"] == "workflow_status":
+                status = entry["record"]["status"]
+        if run is not None:
+            run = dict(run, status=status)
+        return run
+
+    def _load_rollups(self, task, since, until):
+        return [rollup for rollup in self.journal.latest("rollup").values()
+                if (task is None or rollup["task"] == task)
+                and (since is None or rollup["window_start"] >= since)
+                and (until is None or rollup["window_start"] < until)]
+
+    async def list_runs(self, name=None, state=None, since=None, until=None, limit=100):
+        return await self._submit(self._list_runs, name, state, since, until, limit)
+
+    async def get_run(self, job_id):
+        return await self._submit(self._get_run, job_id)
+
+    async def load_rollups(self, task=None, since=None, until=None):
+        return await self._submit(self._load_rollups, task, since, until)
+
+    async def compact(self):
+        return await self._submit(self.journal.compact)
+
+    async def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+if __name__ == "__main__":
+    # python -m engine.journal [directory]  -- compact the sealed segments
+    import sys
+    journal = Journal(sys.argv[1] if len(sys.argv) > 1 else JOURNAL_DIR)
+    journal.compact()
+    journal.close()
@@ -0,0 +1,265 @@
+import asyncio
+import functools
+import inspect
+import itertools
+import time
+
+from engine import deadline, events, tracing
+from engine.executors import call_task_body, run_in_executor
+from engine.ratelimit import get_limit
+from engine.task import TaskResult
+from engine.writer import persist_task_result, record_outcome
+
+
+class MapError(Exception):
+    # errors: {element index: exception}; results: outputs in input order,
+    # None where the element failed (set once the whole map has finished).
+    def __init__(self, errors, results=None):
+        index = min(errors)
+        super().__init__(f"{len(errors)} elements failed; element {index}: "
+                         f"{type(errors[index]).__name__}: {errors[index]}")
+        self.errors = errors
+        self.results = results
+
+
+def run_batch(func, items):
+    # The body of one executor call: every element of a chunk attempt, with
+    # each element's exception returned instead of raised.
+    outcomes = []
+    for item in items:
+        try:
+            result = func(item)
+            if asyncio.iscoroutine(result):
+                result = asyncio.run(result)
+            outcomes.append((True, result))
+        except Exception as e:
+            outcomes.append((False, e))
+    return outcomes
+
+
+class MapRun:
+    # task.map(iterable, ...): the task body applied to every element.
+    #
+    # Elements are taken from the iterable chunk_size at a time, and up to
+    # `concurrency` chunks run at once. On the event loop a chunk calls its
+    # elements one after the other, so `concurrency` is also the number of
+    # calls in flight; with executor="thread"/"process" a chunk is one
+    # executor call. Each chunk is persisted as one "<task>.map" record and
+    # only the failed elements of a chunk are retried, under the task's
+    # retry policy.
+    #
+    # `async for index, result in run` streams results chunk by chunk, in
+    # input order or, with ordered=False, as chunks finish. `await run`
+    # returns all results in input order. Elements that still fail raise a
+    # MapError at the end, unless return_exceptions=True puts the exception
+    # in place of the result.
+    def __init__(self, func, wrapper, executor, timeout, retry_policy, limit, limit_tokens, durable, iterable,
+                 chunk_size=100, concurrency=4, ordered=True, return_exceptions=False):
+        if chunk_size < 1 or concurrency < 1:
+            raise ValueError("chunk_size and concurrency must be at least 1")
+        self.name = f"{func.__name__}.map"
+        self.func = func
+        self.wrapper = wrapper
+        self.executor = executor
+        self.timeout = timeout
+        self.retry_policy = retry_policy
+        self.limit = limit
+        self.limit_tokens = limit_tokens
+        self.durable = durable
+        self.iterable = iterable
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.return_exceptions = return_exceptions
+        self.count = 0
+        self.chunks = 0
+        self.retries = 0
+        self.errors = {}
+
+    def __aiter__(self):
+        return self._iterate()
+
+    def __await__(self):
+        return self._collect().__await__()
+
+    async def _collect(self):
+        results = {}
+        try:
+            async for index, result in self._iterate():
+                results[index] = result
+        except MapError as e:
+            e.results = [results.get(index) for index in range(self.count)]
+            raise
+        return [results[index] for index in range(self.count)]
+
+    def _split(self):
+        iterator = iter(self.iterable)
+        for index in itertools.count():
+            items = list(itertools.islice(iterator, self.chunk_size))
+            if not items:
+                return
+            yield index, self.count, items
+            self.count += len(items)
+
+    async def _iterate(self):
+        chunks = self._split()
+        running = {}
+        finished = {}
+        next_index = 0
+        exhausted = False
+        try:
+            while True:
+                # In order, finished chunks wait for the ones before them;
+                # they count against the window so the buffer stays bounded.
+                while (not exhausted and len(running) < self.concurrency
+                       and len(running) + len(finished) < 2 * self.concurrency):
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    index, offset, items = chunk
+                    running[asyncio.ensure_future(self._run_chunk(index, items))] = (index, offset)
+                if not running and not finished:
+                    break
+                if running:
+                    done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        index, offset = running.pop(future)
+                        finished[index] = (offset,) + future.result()
+                        self.chunks += 1
+                if self.ordered:
+                    ready = []
+                    while next_index in finished:
+                        ready.append(finished.pop(next_index))
+                        next_index += 1
+                else:
+                    ready = list(finished.values())
+                    finished.clear()
+                for offset, results, errors in ready:
+                    for i, result in enumerate(results):
+                        if i in errors:
+                            if not self.return_exceptions:
+                                self.errors[offset + i] = errors[i]
+                                continue
+                            result = errors[i]
+                        yield offset + i, result
+        finally:
+            for future in running:
+                future.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+        if self.errors:
+            raise MapError(self.errors)
+
+    async def _call_async(self, item, pool):
+        timeout = deadline.effective_timeout(self.timeout)
+        if pool is not None:
+            async with pool.slot(self.limit_tokens(item) if self.limit_tokens else 1):
+                result = self.func(item)
+                return await asyncio.wait_for(result, timeout) if inspect.isawaitable(result) else result
+        result = self.func(item)
+        return await asyncio.wait_for(result, timeout) if inspect.isawaitable(result) else result
+
+    async def _run_batch(self, items, task_result):
+        if self.executor == "async":
+            pool = get_limit(self.limit) if self.limit is not None else None
+            started = time.perf_counter()
+            outcomes = []
+            for item in items:
+                try:
+                    outcomes.append((True, await self._call_async(item, pool)))
+                except Exception as e:
+                    outcomes.append((False, e))
+            task_result.run_time = (task_result.run_time or 0.0) + time.perf_counter() - started
+            return outcomes
+        func = functools.partial(call_task_body, self.wrapper) if self.executor == "process" else self.func
+        timeout = deadline.effective_timeout(self.timeout * len(items) if self.timeout is not None else None)
+        try:
+            outcomes, queue_wait, run_time = await run_in_executor(self.executor, run_batch, (func, items), None,
+                                                                   timeout)
+        except asyncio.TimeoutError as e:
+            return [(False, e)] * len(items)
+        task_result.queue_wait = (task_result.queue_wait or 0.0) + queue_wait
+        task_result.run_time = (task_result.run_time or 0.0) + run_time
+        return outcomes
+
+    async def _run_chunk(self, index, items):
+        # Returns (results, {position in chunk: exception}).
+        task_result = TaskResult(self.name)
+        task_result.start(items)
+        results = [None] * len(items)
+        errors = {}
+        pending = list(range(len(items)))
+        started = time.monotonic()
+        attempt = 0
+        with tracing.start_span(f"task {self.name}") as span:
+            while pending:
+                attempt += 1
+                outcomes = await self._run_batch([items[i] for i in pending], task_result)
+                retry = []
+                retry_delay = 0.0
+                for i, (ok, value) in zip(pending, outcomes):
+                    if ok:
+                        results[i] = value
+                        errors.pop(i, None)
+                        continue
+                    errors[i] = value
+                    wait = self.retry_policy.next_delay(value, attempt, time.monotonic() - started)
+                    if wait is not None:
+                        retry.append(i)
+                        retry_delay = max(retry_delay, wait)
+                left = deadline.remaining()
+                if not retry or (left is not None and retry_delay >= left):
+                    break
+                task_result.retries += len(retry)
+                await asyncio.sleep(retry_delay)
+                pending = retry
+            self.retries += task_result.retries
+            if errors:
+                i = min(errors)
+                task_result.output_data = results
+                task_result.fail(f"{len(errors)} of {len(items)} elements failed; element {i}: "
+                                 f"{type(errors[i]).__name__}: {errors[i]}")
+                span.set_status(tracing.STATUS_ERROR, task_result.error_message)
+            else:
+                task_result.complete(results)
+                span.set_status(tracing.STATUS_OK)
+            if span.recording:
+                span.set_attributes({"task.name": self.name, "map.chunk": index, "map.size": len(items),
+                                     "map.failed": len(errors), "task.retries": task_result.retries})
+        record_outcome(task_result)
+        events.emit(events.EventType.CHUNK_PRODUCED, task_result, map_chunk=index, size=len(items),
+                    failed=len(errors), retries=task_result.retries)
+        await persist_task_result(task_result, self.durable)
+        return results, errors
+
+
+def map_node(task_func):
+    # The callable Workflow.add_map puts in the graph: maps task_func over
+    # the iterable it receives and returns (task_result, results) like a
+    # task, with one summary record for the whole map.
+    node = task_func.__dict__.get("_map_node")
+    if node is not None:
+        return node
+
+    async def node(items, chunk_size=100, concurrency=4, ordered=True):
+        task_result = TaskResult(f"{task_func.__name__}.map")
+        task_result.start(None)
+        run = task_func.map(items, chunk_size=chunk_size, concurrency=concurrency, ordered=ordered)
+        try:
+            results = await run
+        except MapError as e:
+            results = e.results
+            task_result.fail(str(e))
+        else:
+            task_result.complete(results)
+        task_result.output_data = results
+        task_result.input_data = {"items": run.count, "chunks": run.chunks}
+        task_result.retries = run.retries
+        return task_result, results
+
+    node.__module__ = task_func.__module__
+    node.__name__ = f"{task_func.__name__}.map"
+    node.__qualname__ = f"{task_func.__qualname__}.map"
+    task_func._map_node = node
+    return node
@@ -0,0 +1,54 @@
+import time
+from datetime import datetime
+
+from engine import db
+from engine.blobstore import load_payloads
+from engine.rollups import WINDOW, summarize, window_start
+
+
+def _epoch(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value)
+
+
+def _iso(value):
+    # Run records store start_time as local-time ISO strings.
+    epoch = _epoch(value)
+    return datetime.fromtimestamp(epoch).isoformat() if epoch is not None else None
+
+
+def last(seconds):
+    # since= helper: last(3600) is "the last hour".
+    return time.time() - seconds
+
+
+async def list_runs(name=None, state=None, since=None, until=None, limit=100):
+    # since/until are datetimes or epoch seconds; newest runs first, without tasks.
+    if state is not None and not isinstance(state, str):
+        state = state.name
+    return await db.get_backend().list_runs(name, state, _iso(since), _iso(until), limit)
+
+
+async def get_run(job_id, payloads=False):
+    # The workflow result with its task results and latest status, or None.
+    # Offloaded inputs/outputs stay references unless payloads=True.
+    run = await db.get_backend().get_run(job_id)
+    if run is not None and payloads:
+        load_payloads(run)
+    return run
+
+
+async def task_stats(name=None, since=None, until=None, percentiles=(50, 95, 99)):
+    # {task name: count, failures, failure_rate, retries, mean_duration, p50...}
+    # read from the per-window rollups, so the cost does not grow with history.
+    # Windows are whole; since/until are rounded to window boundaries.
+    since, until = _epoch(since), _epoch(until)
+    rollups = await db.get_backend().load_rollups(
+        name,
+        window_start(since) if since is not None else None,
+        window_start(until) + WINDOW if until is not None else None,
+    )
+    return summarize(rollups, percentiles)
@@ -0,0 +1,208 @@
+import asyncio
+import contextlib
+import time
+
+from engine.retry import retry_after
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+OVERLOAD_STATUS = (429, 503)
+
+# How a call made in a pool slot ended, for AdaptiveConcurrency.release.
+OK = "ok"
+ERROR = "error"
+OVERLOAD = "overload"
+CANCELLED = "cancelled"
+
+
+def _status(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def is_overload(error):
+    # 429/503 or an explicit back-off hint means "slow down", as opposed to
+    # an error in the request itself.
+    return _status(error) in OVERLOAD_STATUS or retry_after(error) is not None
+
+
+def outcome(error):
+    # Overload, a timeout or a server error says the dependency is
+    # struggling; anything else is an error in the call itself.
+    if is_overload(error) or isinstance(error, asyncio.TimeoutError):
+        return OVERLOAD
+    status = _status(error)
+    return OVERLOAD if isinstance(status, int) and status >= 500 else ERROR
+
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = float(capacity if capacity is not None else per_minute)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount=1):
+        # Requests larger than the bucket are let through once it is full.
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return waited
+            delay = (amount - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def adjust(self, amount):
+        # Settle the difference between estimated and actual usage; the
+        # balance may go negative, which delays the next callers.
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class AdaptiveConcurrency:
+    # AIMD: grow the limit by ~1 per limit's worth of successes, halve it on
+    # overload (timeouts and server errors included) or when latency goes
+    # above target, at most once per latency window. Other errors and
+    # cancelled calls leave it as it is.
+    def __init__(self, initial=4, min_limit=1, max_limit=64, target_latency=None,
+                 backoff=0.5):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._loop = None
+        self._cond = None
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._cond = asyncio.Condition()
+            self.in_flight = 0
+
+    async def acquire(self):
+        self._bind_loop()
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency, outcome=OK):
+        async with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            slow = outcome == OK and self.target_latency is not None and latency > self.target_latency
+            if outcome == OVERLOAD or slow:
+                if now - self._last_decrease > latency:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = now
+            elif outcome == OK:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+class Lease:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.waited = 0.0
+        self.actual_tokens = None
+
+    def report_tokens(self, tokens):
+        self.actual_tokens = tokens
+
+
+class RateLimitStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.overloads = 0
+        self.wait_time = 0.0
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "overloads": self.overloads,
+            "wait_time": self.wait_time,
+        }
+
+
+class RateLimitPool:
+    def __init__(self, name, requests_per_minute=None, tokens_per_minute=None, max_concurrency=16,
+                 min_concurrency=1, initial_concurrency=None, target_latency=None):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = AdaptiveConcurrency(initial_concurrency or max_concurrency, min_concurrency,
+                                               max_concurrency, target_latency)
+        self.stats = RateLimitStats()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens=1):
+        lease = Lease(tokens)
+        started = time.monotonic()
+        await self.concurrency.acquire()
+        try:
+            if self.requests:
+                await self.requests.acquire()
+            if self.tokens:
+                await self.tokens.acquire(tokens)
+        except BaseException:
+            # Never made the call, so there is nothing to learn from.
+            await self.concurrency.release(0.0, CANCELLED)
+            raise
+        lease.waited = time.monotonic() - started
+        self.stats.wait_time += lease.waited
+        self.stats.calls += 1
+        called = time.monotonic()
+        result = OK
+        try:
+            yield lease
+        except asyncio.CancelledError:
+            result = CANCELLED
+            raise
+        except Exception as e:
+            self.stats.errors += 1
+            result = outcome(e)
+            if result == OVERLOAD:
+                self.stats.overloads += 1
+                logger.debug(f"Rate limit pool {self.name}: overloaded, limit {self.concurrency.limit:.1f}")
+            raise
+        finally:
+            if self.tokens and lease.actual_tokens is not None:
+                self.tokens.adjust(lease.actual_tokens - lease.tokens)
+            await self.concurrency.release(time.monotonic() - called, result)
+
+    def snapshot(self):
+        stats = self.stats.to_dict()
+        stats["concurrency_limit"] = self.concurrency.limit
+        stats["in_flight"] = self.concurrency.in_flight
+        return stats
+
+
+_pools = {}
+
+
+def configure_limit(name, **kwargs):
+    _pools[name] = RateLimitPool(name, **kwargs)
+    return _pools[name]
+
+
+def get_limit(name):
+    pool = _pools.get(name)
+    if pool is None:
+        raise KeyError(f"No rate limit pool named {name!r}; call configure_limit({name!r}, ...) first")
+    return pool
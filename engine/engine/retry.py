@@ -0,0 +1,121 @@
+import contextvars
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+_workflow_budget = contextvars.ContextVar("engine_retry_budget", default=None)
+_process_budget = None
+
+
+class RetryBudget:
+    # Token bucket shared by many tasks. Every retry spends a token; when
+    # the bucket is empty failures are final instead of multiplying load
+    # on a dependency that is already struggling.
+    def __init__(self, capacity=100, refill_rate=10.0):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = float(capacity)
+        self.exhausted = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_rate)
+            self._updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            self.exhausted += 1
+            return False
+
+
+def configure_retry_budget(capacity=100, refill_rate=10.0):
+    global _process_budget
+    _process_budget = RetryBudget(capacity, refill_rate) if capacity is not None else None
+    return _process_budget
+
+
+def current_budget():
+    budget = _workflow_budget.get()
+    return budget if budget is not None else _process_budget
+
+
+def use_budget(budget):
+    # Returns a token for _workflow_budget.reset().
+    return _workflow_budget.set(budget)
+
+
+def reset_budget(token):
+    _workflow_budget.reset(token)
+
+
+def retry_after(error):
+    # Seconds the server asked us to wait, from a retry_after attribute or
+    # a Retry-After header on the error's HTTP response.
+    value = getattr(error, "retry_after", None)
+    if value is None:
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if headers is not None:
+            value = headers.get("retry-after") or headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=60.0, multiplier=2.0, jitter=True,
+                 max_total_time=None, retry_on=(Exception,), no_retry_on=(), respect_retry_after=True,
+                 budget=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_total_time = max_total_time
+        self.retry_on = tuple(retry_on)
+        self.no_retry_on = tuple(no_retry_on)
+        self.respect_retry_after = respect_retry_after
+        self.budget = budget
+
+    @classmethod
+    def fixed(cls, max_attempts, delay):
+        # The original @task(max_retries, delay) behaviour.
+        return cls(max_attempts, delay, delay, multiplier=1.0, jitter=False, respect_retry_after=False)
+
+    def is_retryable(self, error):
+        return isinstance(error, self.retry_on) and not isinstance(error, self.no_retry_on)
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1))
+        # Full jitter: spread concurrent retries over the whole window.
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def next_delay(self, error, attempt, elapsed):
+        # Seconds to wait before the next attempt, or None to give up.
+        if attempt >= self.max_attempts or not self.is_retryable(error):
+            return None
+        delay = self.backoff(attempt)
+        if self.respect_retry_after:
+            hint = retry_after(error)
+            if hint is not None:
+                delay = max(delay, hint)
+        if self.max_total_time is not None and elapsed + delay > self.max_total_time:
+            return None
+        budget = self.budget if self.budget is not None else current_budget()
+        if budget is not None and not budget.try_acquire():
+            return None
+        return delay
+
+
+NO_RETRY = RetryPolicy(max_attempts=1)
@@ -0,0 +1,123 @@
+import math
+import os
+
+# Durations go into log-scaled buckets: bucket i holds (MIN * GROWTH**(i-1),
+# MIN * GROWTH**i] seconds, so a percentile is off by at most ~5%.
+MIN_DURATION = 1e-4
+GROWTH = 1.1
+WINDOW = int(os.environ.get("ENGINE_ROLLUP_WINDOW", 60))
+
+
+def bucket_index(duration):
+    if duration <= MIN_DURATION:
+        return 0
+    return math.ceil(math.log(duration / MIN_DURATION) / math.log(GROWTH))
+
+
+def bucket_value(index):
+    # Geometric midpoint of the bucket.
+    return MIN_DURATION * GROWTH ** (index - 0.5) if index > 0 else MIN_DURATION
+
+
+def window_start(epoch_seconds, window=WINDOW):
+    return int(epoch_seconds // window * window)
+
+
+class Rollup:
+    # Per task name and time window: counts plus a duration histogram.
+    # Rollups for the same task and window are merged by adding.
+    def __init__(self, task, window_start, count=0, failures=0, retries=0, duration_sum=0.0, buckets=None,
+                 timeouts=0):
+        self.task = task
+        self.window_start = window_start
+        self.count = count
+        self.failures = failures
+        self.timeouts = timeouts
+        self.retries = retries
+        self.duration_sum = duration_sum
+        self.buckets = buckets if buckets is not None else {}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["task"], data["window_start"], data.get("count", 0), data.get("failures", 0),
+                   data.get("retries", 0), data.get("duration_sum", 0.0),
+                   {int(index): count for index, count in (data.get("buckets") or {}).items()},
+                   data.get("timeouts", 0))
+
+    def add(self, duration, failed, retries, timed_out=False):
+        # Timeouts also count as failures.
+        self.count += 1
+        self.failures += 1 if failed else 0
+        self.timeouts += 1 if timed_out else 0
+        self.retries += retries
+        if duration is not None:
+            self.duration_sum += duration
+            index = bucket_index(duration)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.failures += other.failures
+        self.timeouts += other.timeouts
+        self.retries += other.retries
+        self.duration_sum += other.duration_sum
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def to_dict(self):
+        return {
+            "task": self.task,
+            "window_start": self.window_start,
+            "count": self.count,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "duration_sum": self.duration_sum,
+            "buckets": {str(index): count for index, count in self.buckets.items()},
+        }
+
+
+def percentile(buckets, q):
+    total = sum(buckets.values())
+    if not total:
+        return None
+    rank = q / 100 * total
+    seen = 0
+    for index in sorted(buckets):
+        seen += buckets[index]
+        if seen >= rank:
+            return bucket_value(index)
+    return bucket_value(max(buckets))
+
+
+def rollup_key(task_result):
+    return task_result.name, window_start(task_result.started_at_ns / 1e9)
+
+
+def summarize(rollups, percentiles=(50, 95, 99)):
+    # {task name: stats} from any number of rollup dicts or Rollup objects.
+    merged = {}
+    for rollup in rollups:
+        if isinstance(rollup, dict):
+            rollup = Rollup.from_dict(rollup)
+        total = merged.get(rollup.task)
+        if total is None:
+            merged[rollup.task] = Rollup(rollup.task, None).merge(rollup)
+        else:
+            total.merge(rollup)
+    stats = {}
+    for task, total in merged.items():
+        timed = sum(total.buckets.values())
+        stats[task] = {
+            "count": total.count,
+            "failures": total.failures,
+            "failure_rate": total.failures / total.count if total.count else 0.0,
+            "timeouts": total.timeouts,
+            "timeout_rate": total.timeouts / total.count if total.count else 0.0,
+            "retries": total.retries,
+            "mean_duration": total.duration_sum / timed if timed else None,
+        }
+        for q in percentiles:
+            stats[task][f"p{q:g}"] = percentile(total.buckets, q)
+    return stats
@@ -0,0 +1,389 @@
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import random
+import signal
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from engine import writer
+from engine.utils import get_logger
+from engine.worker import Worker, load_workflow
+
+logger = get_logger(__name__)
+
+CATCH_UP_POLICIES = ("skip", "latest", "all")
+
+
+def new_job_id(prefix, at=None):
+    # Readable and unique: <prefix>-<scheduled time>-<random suffix>.
+    stamp = datetime.fromtimestamp(at if at is not None else time.time()).strftime("%Y%m%dT%H%M%S")
+    return f"{prefix}-{stamp}-{uuid.uuid4().hex[:8]}"
+
+
+class Interval:
+    # Every `seconds`, on a grid anchored at start_at (default: now), so
+    # runs do not drift however late each one fires.
+    def __init__(self, seconds, start_at=None):
+        if seconds <= 0:
+            raise ValueError("Interval must be positive")
+        self.seconds = seconds
+        self.start_at = start_at if start_at is not None else time.time()
+
+    def next_after(self, epoch):
+        if epoch < self.start_at:
+            return self.start_at
+        following = self.start_at + ((epoch - self.start_at) // self.seconds + 1) * self.seconds
+        # Float rounding can land back on `epoch` itself.
+        return following if following > epoch else following + self.seconds
+
+    def __repr__(self):
+        return f"Interval({self.seconds})"
+
+
+CRON_FIELDS = (("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7))
+CRON_NAMES = {
+    "month": {name: i for i, name in enumerate(
+        ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), 1)},
+    "weekday": {name: i for i, name in enumerate(("sun", "mon", "tue", "wed", "thu", "fri", "sat"))},
+}
+CRON_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+}
+
+
+def _cron_field(text, name, low, high):
+    def value(token):
+        token = CRON_NAMES.get(name, {}).get(token, token)
+        return int(token)
+
+    values = set()
+    for part in text.lower().split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError(f"Bad step in cron {name} field {text!r}")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (value(token) for token in part.split("-", 1))
+        else:
+            start = value(part)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high:
+            raise ValueError(f"Cron {name} field {text!r} is out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    if name == "weekday" and 7 in values:
+        values.discard(7)
+        values.add(0)
+    return sorted(values)
+
+
+class Cron:
+    # Standard five fields: minute hour day-of-month month day-of-week, with
+    # *, lists, ranges, steps and jan-dec/sun-sat names, in local time. As
+    # in cron, a restricted day-of-month and day-of-week match either.
+    def __init__(self, expression):
+        self.expression = expression
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression {expression!r} must have 5 fields")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            _cron_field(text, name, low, high) for text, (name, low, high) in zip(fields, CRON_FIELDS))
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+        self.next_after(time.time())
+
+    def _day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, epoch):
+        # Skips whole months, days and hours that cannot match instead of
+        # stepping minute by minute.
+        dt = datetime.fromtimestamp(epoch).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(10000):
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                later = [hour for hour in self.hours if hour > dt.hour]
+                dt = (dt.replace(hour=later[0], minute=0) if later
+                      else dt.replace(hour=0, minute=0) + timedelta(days=1))
+            elif dt.minute not in self.minutes:
+                later = [minute for minute in self.minutes if minute > dt.minute]
+                dt = dt.replace(minute=later[0]) if later else dt.replace(minute=0) + timedelta(hours=1)
+            else:
+                return dt.timestamp()
+        raise ValueError(f"Cron expression {self.expression!r} never matches")
+
+    def __repr__(self):
+        return f"Cron({self.expression!r})"
+
+
+class Schedule:
+    def __init__(self, name, workflow_name, trigger, kwargs, catch_up, overlap, jitter):
+        self.name = name
+        self.workflow_name = workflow_name
+        self.trigger = trigger
+        self.kwargs = kwargs
+        self.catch_up = catch_up
+        self.overlap = overlap
+        self.jitter = jitter
+        # Bumped on remove/replace so stale heap entries are ignored.
+        self.generation = 0
+        self.last_run = None
+        self.next_run = None
+        self.runs = 0
+        self.skipped = 0
+        self.missed = 0
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "workflow": self.workflow_name,
+            "trigger": repr(self.trigger),
+            "last_run": self.last_run,
+            "next_run": self.next_run,
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "missed": self.missed,
+        }
+
+
+class Scheduler:
+    # Starts @workflow runs on Interval/Cron triggers through a Worker.
+    # Upcoming runs sit in one heap ordered by fire time, so each run costs
+    # O(log n) however many schedules there are, and the loop sleeps until
+    # the earliest one.
+    #
+    # catch_up decides what happens to runs missed by more than
+    # misfire_grace seconds (a blocked loop, or downtime when state_path
+    # keeps the last run times across restarts): "skip" drops them,
+    # "latest" runs once for the most recent, "all" runs each of them, up
+    # to max_catch_up. With overlap=False a run is skipped while the same
+    # workflow is still running. jitter delays each run by a random
+    # 0..jitter seconds so schedules on the same tick do not start at once.
+    # catch_up="all" needs overlap=True, or the catch-up runs skip each other.
+    #
+    # Without a worker the scheduler creates one and runs it too; pass
+    # run_worker=True to have it run a worker you configured.
+    def __init__(self, worker=None, state_path=None, misfire_grace=1.0, max_catch_up=100, seed=None,
+                 run_worker=None):
+        self.worker = worker if worker is not None else Worker()
+        self.run_worker = worker is None if run_worker is None else run_worker
+        self.worker.add_done_callback(self._job_done)
+        self.state_path = state_path
+        self.misfire_grace = misfire_grace
+        self.max_catch_up = max_catch_up
+        self.schedules = {}
+        self._heap = []
+        self._seq = 0
+        self._active = {}
+        # job id -> workflow name of the runs this scheduler submitted; the
+        # worker may also run jobs of the same workflows submitted elsewhere.
+        self._submitted = {}
+        self._random = random.Random(seed)
+        self._last_runs = self._load_state()
+        self._dirty = False
+        self._stopping = False
+        self._wakeup = None
+
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path) as file:
+            return json.load(file)
+
+    def _save_state(self):
+        if not self.state_path or not self._dirty:
+            return
+        self._dirty = False
+        state = dict(self._last_runs)
+        state.update({name: schedule.last_run for name, schedule in self.schedules.items()
+                      if schedule.last_run is not None})
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp, self.state_path)
+
+    def add(self, workflow_func, every=None, cron=None, name=None, kwargs=None, catch_up="latest", overlap=False,
+            jitter=0.0, start_at=None):
+        # Adding a schedule under an existing name replaces it.
+        if (every is None) == (cron is None):
+            raise ValueError("Pass exactly one of every= or cron=")
+        if catch_up not in CATCH_UP_POLICIES:
+            raise ValueError(f"catch_up must be one of {CATCH_UP_POLICIES}, got {catch_up!r}")
+        workflow_name = workflow_func.workflow_name
+        if workflow_name not in self.worker.workflows:
+            self.worker.register(workflow_func)
+        name = name or workflow_name
+        # After a restart, continue from the last recorded run so the runs
+        # missed in between are caught up. An interval without its own
+        # start_at stays on the grid of that run rather than restarting now.
+        last = self._last_runs.get(name)
+        if every is not None:
+            trigger = Interval(every, start_at if start_at is not None else last)
+        else:
+            trigger = Cron(cron)
+        schedule = Schedule(name, workflow_name, trigger, dict(kwargs or {}), catch_up, overlap, jitter)
+        previous = self.schedules.get(name)
+        if previous is not None:
+            schedule.generation = previous.generation + 1
+        self.schedules[name] = schedule
+        schedule.last_run = last
+        self._push(schedule, trigger.next_after(last if last is not None else time.time()))
+        return schedule
+
+    def remove(self, name):
+        schedule = self.schedules.pop(name)
+        schedule.generation += 1
+
+    def _push(self, schedule, occurrence):
+        schedule.next_run = occurrence
+        fire_at = occurrence + (self._random.uniform(0, schedule.jitter) if schedule.jitter else 0.0)
+        self._seq += 1
+        heapq.heappush(self._heap, (fire_at, self._seq, schedule, schedule.generation, occurrence))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _fire(self, schedule, occurrence, now):
+        occurrences = [occurrence]
+        following = schedule.trigger.next_after(occurrence)
+        while following <= now:
+            occurrences.append(following)
+            following = schedule.trigger.next_after(following)
+            if len(occurrences) > self.max_catch_up:
+                # Jump past the rest rather than walking years of history.
+                following = schedule.trigger.next_after(now)
+        late = [at for at in occurrences if now - at > self.misfire_grace + schedule.jitter]
+        on_time = occurrences[len(late):]
+        if late:
+            schedule.missed += len(late)
+            if schedule.catch_up == "latest":
+                on_time = on_time or late[-1:]
+            elif schedule.catch_up == "all":
+                on_time = late[:self.max_catch_up] + on_time
+            logger.warning(f"Schedule {schedule.name}: {len(late)} missed runs, catch_up={schedule.catch_up}")
+        for at in on_time:
+            self._start(schedule, at)
+        schedule.last_run = occurrences[-1]
+        self._dirty = True
+        self._push(schedule, following)
+
+    def _start(self, schedule, at):
+        if not schedule.overlap and self._active.get(schedule.workflow_name):
+            schedule.skipped += 1
+            logger.info(f"Schedule {schedule.name}: skipped run at {at:.0f}, {schedule.workflow_name} is still running")
+            return
+        job_id = new_job_id(schedule.name, at)
+        try:
+            self.worker.submit_nowait(schedule.workflow_name, job_id, **schedule.kwargs)
+        except (asyncio.QueueFull, RuntimeError) as e:
+            schedule.skipped += 1
+            logger.error(f"Schedule {schedule.name}: could not submit {job_id}: {e!r}")
+            return
+        schedule.runs += 1
+        self._submitted[job_id] = schedule.workflow_name
+        self._active[schedule.workflow_name] = self._active.get(schedule.workflow_name, 0) + 1
+
+    def _job_done(self, job):
+        name = self._submitted.pop(job.job_id, None)
+        if name is None:
+            return
+        count = self._active.get(name, 0) - 1
+        if count > 0:
+            self._active[name] = count
+        else:
+            self._active.pop(name, None)
+
+    def stop(self):
+        if not self._stopping:
+            self._stopping = True
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    async def _sleep(self, seconds):
+        # Not wait_for(), which can swallow a cancel that lands as the
+        # event is set.
+        timer = asyncio.get_running_loop().call_later(seconds, self._wakeup.set)
+        try:
+            await self._wakeup.wait()
+        finally:
+            timer.cancel()
+            self._wakeup.clear()
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        worker = asyncio.ensure_future(self.worker.run()) if self.run_worker else None
+        logger.info(f"Scheduler started with {len(self.schedules)} schedules")
+        try:
+            while not self._stopping:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, schedule, generation, occurrence = heapq.heappop(self._heap)
+                    if generation == schedule.generation and self.schedules.get(schedule.name) is schedule:
+                        self._fire(schedule, occurrence, now)
+                self._save_state()
+                # Wake at least once a minute in case the wall clock jumped.
+                delay = min(self._heap[0][0] - time.time(), 60.0) if self._heap else 60.0
+                if delay > 0:
+                    await self._sleep(delay)
+        finally:
+            self._dirty = True
+            self._save_state()
+            if worker is not None:
+                self.worker.stop()
+                await worker
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+        try:
+            await self.run()
+        finally:
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(sig)
+            await writer.shutdown()
+
+
+async def _main(args):
+    # schedules file: a JSON list of {"workflow": "module:function", "every":
+    # seconds | "cron": "...", "name", "kwargs", "catch_up", "overlap", "jitter"}
+    with open(args.schedules) as file:
+        specs = json.load(file)
+    scheduler = Scheduler(Worker(concurrency=args.concurrency, job_timeout=args.job_timeout), args.state_path,
+                          args.misfire_grace, run_worker=True)
+    for spec in specs:
+        spec = dict(spec)
+        scheduler.add(load_workflow(spec.pop("workflow")), **spec)
+    await scheduler.serve()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run @workflow functions on interval and cron schedules")
+    parser.add_argument("schedules", help="JSON file with the list of schedules")
+    parser.add_argument("--state-path", default="scheduler_state.json",
+                        help="last run times, kept across restarts for catch-up")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--job-timeout", type=float, default=None)
+    parser.add_argument("--misfire-grace", type=float, default=1.0)
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+import json
+import math
+import os
+import struct
+
+from engine.task import TaskResult, TaskState, _timestamp
+from engine.workflow import WorkflowResult
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Field order of each schema version of the result records. A record
+# carries the version it was written with; fields that version does not
+# have come back as None, so old journals stay readable. Append new fields
+# and bump the version, never reorder.
+SCHEMA_VERSION = 2
+TASK_FIELDS = {
+    1: ("name", "id", "state", "started_at_ns", "ended_at_ns", "input_data", "output_data", "error_message",
+        "retries", "queue_wait", "run_time", "cache_hits", "cache_misses", "first_chunk_time", "chunk_count",
+        "coalesced", "usage"),
+}
+TASK_FIELDS[2] = TASK_FIELDS[1] + ("job_id",)
+WORKFLOW_FIELDS = {
+    1: ("name", "job_id", "state", "started_at_ns", "ended_at_ns", "error_message", "tasks"),
+}
+WORKFLOW_FIELDS[2] = WORKFLOW_FIELDS[1]
+
+
+def _ended_at_ns(record):
+    return record.started_at_ns + record.end_ns - record.start_ns if record.end_ns is not None else None
+
+
+def task_fields(task_result):
+    # Timestamps are epoch nanoseconds; payloads go through the blob store
+    # exactly as in TaskResult.to_dict().
+    return (task_result.name, task_result.id, task_result.state.value, task_result.started_at_ns,
+            _ended_at_ns(task_result), task_result._offloaded(0, task_result.input_data),
+            task_result._offloaded(1, task_result.output_data), task_result.error_message, task_result.retries,
+            task_result.queue_wait, task_result.run_time, task_result.cache_hits, task_result.cache_misses,
+            task_result.first_chunk_time, task_result.chunk_count, task_result.coalesced, task_result.usage,
+            task_result.job_id)
+
+
+def workflow_fields(workflow_result):
+    return (workflow_result.name, workflow_result.job_id, workflow_result.state.value,
+            workflow_result.started_at_ns, _ended_at_ns(workflow_result), workflow_result.error_message,
+            workflow_result.tasks)
+
+
+def _times(fields):
+    start, end = fields.get("started_at_ns"), fields.get("ended_at_ns")
+    duration = (end - start) / 1e9 if start and end is not None else None
+    return start, end, duration
+
+
+def task_dict(version, values):
+    # The to_dict() shape, plus the raw epoch-ns timestamps.
+    fields = dict(zip(TASK_FIELDS[version], values))
+    start, end, duration = _times(fields)
+    return {
+        "name": fields.get("name"),
+        "id": fields.get("id"),
+        "job_id": fields.get("job_id"),
+        "state": TaskState(fields["state"]).name,
+        "start_time": _timestamp(start),
+        "end_time": _timestamp(end),
+        "duration": duration,
+        "input_data": fields.get("input_data"),
+        "output_data": fields.get("output_data"),
+        "error_message": fields.get("error_message"),
+        "retries": fields.get("retries"),
+        "queue_wait": fields.get("queue_wait"),
+        "run_time": fields.get("run_time"),
+        "cache_hits": fields.get("cache_hits"),
+        "cache_misses": fields.get("cache_misses"),
+        "first_chunk_time": fields.get("first_chunk_time"),
+        "chunk_count": fields.get("chunk_count"),
+        "coalesced": fields.get("coalesced"),
+        "usage": fields.get("usage"),
+        "start_time_ns": start,
+        "end_time_ns": end,
+    }
+
+
+def workflow_dict(version, values):
+    fields = dict(zip(WORKFLOW_FIELDS[version], values))
+    start, end, duration = _times(fields)
+    return {
+        "name": fields.get("name"),
+        "job_id": fields.get("job_id"),
+        "state": TaskState(fields["state"]).name,
+        "start_time": _timestamp(start),
+        "end_time": _timestamp(end),
+        "duration": duration,
+        "tasks": fields.get("tasks") or [],
+        "error_message": fields.get("error_message"),
+        "start_time_ns": start,
+        "end_time_ns": end,
+    }
+
+
+class Serializer:
+    # dumps() output starts with `marker`, so decode() can tell the format
+    # of any stored payload. JSON has none: its payloads start with "{" or "[".
+    name = None
+    marker = b""
+    # Whether TaskResult / WorkflowResult objects are encoded directly from
+    # their fields rather than through to_dict().
+    records = False
+
+    def dump_parts(self, value):
+        # A list of buffers whose concatenation is dumps(value); large bytes
+        # payloads are passed through without being copied.
+        raise NotImplementedError
+
+    def dumps(self, value):
+        return b"".join(self.dump_parts(value))
+
+    def loads(self, data, zero_copy=False):
+        raise NotImplementedError
+
+
+def _as_plain(value):
+    # Objects that know their own record shape (TaskResult, the
+    # RemoteTaskResult of a dispatched task, ...) are stored as that;
+    # anything else as its str().
+    to_dict = getattr(value, "to_dict", None)
+    return to_dict() if callable(to_dict) else str(value)
+
+
+class JSONSerializer(Serializer):
+    # The historical format: compact JSON, with anything it cannot encode
+    # (bytes included) turned into its str().
+    name = "json"
+
+    def dump_parts(self, value):
+        return [json.dumps(value, separators=(",", ":"), default=_as_plain).encode()]
+
+    def loads(self, data, zero_copy=False):
+        return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+
+# Value tags of the binary format.
+NONE, TRUE, FALSE, INT, BIGINT, FLOAT, STR, BYTES, LIST, DICT, TASK, WORKFLOW = range(12)
+
+_TAG = struct.Struct(">B")
+_SIZED = struct.Struct(">BI")
+_INT = struct.Struct(">Bq")
+_FLOAT = struct.Struct(">Bd")
+_SIZE = struct.Struct(">I")
+# tag, version, state, started_at_ns, ended_at_ns, then the numeric task
+# fields; -1 and NaN stand for None.
+_TASK = struct.Struct(">BBBqqIIIIBddd")
+_WORKFLOW = struct.Struct(">BBBqqI")
+_NAN = float("nan")
+_CONSTANTS = {None: _TAG.pack(NONE), True: _TAG.pack(TRUE), False: _TAG.pack(FALSE)}
+
+
+def _optional_float(value):
+    return _NAN if value is None else value
+
+
+def _from_float(value):
+    return None if math.isnan(value) else value
+
+
+def _from_ns(value):
+    return None if value < 0 else value
+
+
+class BinarySerializer(Serializer):
+    # A tagged, length-prefixed format packed with struct. Result records are
+    # written as their schema fields with a fixed-size numeric part, and
+    # bytes travel as raw spans: loads(zero_copy=True) returns them as
+    # memoryviews into the input instead of copies.
+    name = "binary"
+    marker = b"\x01"
+    records = True
+
+    def dump_parts(self, value):
+        out = [self.marker]
+        self._encode(value, out)
+        return out
+
+    def _encode(self, value, out):
+        encoder = _ENCODERS.get(type(value))
+        if encoder is not None:
+            encoder(self, value, out)
+        elif isinstance(value, dict):
+            _encode_dict(self, value, out)
+        elif isinstance(value, (list, tuple)):
+            _encode_list(self, value, out)
+        elif isinstance(value, int):
+            _encode_int(self, int(value), out)
+        elif isinstance(value, str):
+            _encode_str(self, value, out)
+        else:
+            self._encode(_as_plain(value), out)
+
+    def loads(self, data, zero_copy=False):
+        view = memoryview(data)
+        if view[:1] != self.marker:
+            raise ValueError("not a binary-serialized payload")
+        value, _ = self._decode(view, 1, zero_copy)
+        return value
+
+    def _decode(self, view, pos, zero_copy):
+        tag = view[pos]
+        if tag == STR:
+            size, = _SIZE.unpack_from(view, pos + 1)
+            pos += 5
+            return str(view[pos:pos + size], "utf-8"), pos + size
+        if tag == INT:
+            return _INT.unpack_from(view, pos)[1], pos + 9
+        if tag == NONE:
+            return None, pos + 1
+        if tag == TRUE:
+            return True, pos + 1
+        if tag == FALSE:
+            return False, pos + 1
+        if tag == FLOAT:
+            return _FLOAT.unpack_from(view, pos)[1], pos + 9
+        if tag == DICT:
+            size, = _SIZE.unpack_from(view, pos + 1)
+            pos += 5
+            result = {}
+            for _ in range(size):
+                key, pos = self._decode(view, pos, zero_copy)
+                result[key], pos = self._decode(view, pos, zero_copy)
+            return result, pos
+        if tag == LIST:
+            size, = _SIZE.unpack_from(view, pos + 1)
+            pos += 5
+            result = []
+            for _ in range(size):
+                item, pos = self._decode(view, pos, zero_copy)
+                result.append(item)
+            return result, pos
+        if tag == BYTES:
+            size, = _SIZE.unpack_from(view, pos + 1)
+            pos += 5
+            span = view[pos:pos + size]
+            return (span if zero_copy else span.tobytes()), pos + size
+        if tag == BIGINT:
+            size, = _SIZE.unpack_from(view, pos + 1)
+            pos += 5
+            return int(str(view[pos:pos + size], "ascii")), pos + size
+        if tag == TASK:
+            return self._decode_task(view, pos, zero_copy)
+        if tag == WORKFLOW:
+            return self._decode_workflow(view, pos, zero_copy)
+        raise ValueError(f"Unknown value tag {tag} at offset {pos}")
+
+    def _decode_task(self, view, pos, zero_copy):
+        (_, version, state, started, ended, retries, hits, misses, chunks, coalesced, queue_wait, run_time,
+         first_chunk) = _TASK.unpack_from(view, pos)
+        if version not in TASK_FIELDS:
+            raise ValueError(f"Unknown task record schema version {version}")
+        pos += _TASK.size
+        name, pos = self._decode(view, pos, zero_copy)
+        id, pos = self._decode(view, pos, zero_copy)
+        input_data, pos = self._decode(view, pos, zero_copy)
+        output_data, pos = self._decode(view, pos, zero_copy)
+        error_message, pos = self._decode(view, pos, zero_copy)
+        usage, pos = self._decode(view, pos, zero_copy)
+        job_id = None
+        if version >= 2:
+            job_id, pos = self._decode(view, pos, zero_copy)
+        return task_dict(version, (name, id, state, _from_ns(started), _from_ns(ended), input_data, output_data,
+                                   error_message, retries, _from_float(queue_wait), _from_float(run_time), hits,
+                                   misses, _from_float(first_chunk), chunks, bool(coalesced), usage, job_id)), pos
+
+    def _decode_workflow(self, view, pos, zero_copy):
+        _, version, state, started, ended, count = _WORKFLOW.unpack_from(view, pos)
+        if version not in WORKFLOW_FIELDS:
+            raise ValueError(f"Unknown workflow record schema version {version}")
+        pos += _WORKFLOW.size
+        name, pos = self._decode(view, pos, zero_copy)
+        job_id, pos = self._decode(view, pos, zero_copy)
+        error_message, pos = self._decode(view, pos, zero_copy)
+        tasks = []
+        for _ in range(count):
+            task, pos = self._decode(view, pos, zero_copy)
+            tasks.append(task)
+        return workflow_dict(version, (name, job_id, state, _from_ns(started), _from_ns(ended), error_message,
+                                       tasks)), pos
+
+
+def _encode_constant(serializer, value, out):
+    out.append(_CONSTANTS[value])
+
+
+def _encode_int(serializer, value, out):
+    if -(1 << 63) <= value < (1 << 63):
+        out.append(_INT.pack(INT, value))
+    else:
+        data = str(value).encode()
+        out.append(_SIZED.pack(BIGINT, len(data)) + data)
+
+
+def _encode_float(serializer, value, out):
+    out.append(_FLOAT.pack(FLOAT, value))
+
+
+def _encode_str(serializer, value, out):
+    data = value.encode()
+    out.append(_SIZED.pack(STR, len(data)) + data)
+
+
+def _encode_bytes(serializer, value, out):
+    out.append(_SIZED.pack(BYTES, len(value) if not isinstance(value, memoryview) else value.nbytes))
+    out.append(value)
+
+
+def _encode_list(serializer, value, out):
+    out.append(_SIZED.pack(LIST, len(value)))
+    for item in value:
+        serializer._encode(item, out)
+
+
+def _encode_dict(serializer, value, out):
+    out.append(_SIZED.pack(DICT, len(value)))
+    for key, item in value.items():
+        serializer._encode(key, out)
+        serializer._encode(item, out)
+
+
+def _encode_task(serializer, task_result, out):
+    (name, id, state, started, ended, input_data, output_data, error_message, retries, queue_wait, run_time,
+     hits, misses, first_chunk, chunks, coalesced, usage, job_id) = task_fields(task_result)
+    out.append(_TASK.pack(TASK, SCHEMA_VERSION, state, -1 if started is None else started,
+                          -1 if ended is None else ended, retries, hits, misses, chunks, coalesced,
+                          _optional_float(queue_wait), _optional_float(run_time), _optional_float(first_chunk)))
+    for value in (name, id, input_data, output_data, error_message, usage, job_id):
+        serializer._encode(value, out)
+
+
+def _encode_workflow(serializer, workflow_result, out):
+    name, job_id, state, started, ended, error_message, tasks = workflow_fields(workflow_result)
+    out.append(_WORKFLOW.pack(WORKFLOW, SCHEMA_VERSION, state, -1 if started is None else started,
+                              -1 if ended is None else ended, len(tasks)))
+    for value in (name, job_id, error_message):
+        serializer._encode(value, out)
+    for task in tasks:
+        serializer._encode(task, out)
+
+
+_ENCODERS = {
+    type(None): _encode_constant,
+    bool: _encode_constant,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    bytearray: _encode_bytes,
+    memoryview: _encode_bytes,
+    list: _encode_list,
+    tuple: _encode_list,
+    dict: _encode_dict,
+    TaskResult: _encode_task,
+    WorkflowResult: _encode_workflow,
+}
+
+
+# msgpack extension type codes for the result records.
+EXT_TASK = 1
+EXT_WORKFLOW = 2
+EXT_BIGINT = 3
+
+
+class MsgpackSerializer(Serializer):
+    # msgpack, with result records as extension types holding
+    # [schema version, *fields]. bytes are always copied out on load.
+    name = "msgpack"
+    marker = b"\x02"
+    records = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed; install it or use the 'binary' serializer")
+
+    def _default(self, value):
+        if isinstance(value, TaskResult):
+            return msgpack.ExtType(EXT_TASK, self._pack((SCHEMA_VERSION,) + task_fields(value)))
+        if isinstance(value, WorkflowResult):
+            return msgpack.ExtType(EXT_WORKFLOW, self._pack((SCHEMA_VERSION,) + workflow_fields(value)))
+        if isinstance(value, int):
+            return msgpack.ExtType(EXT_BIGINT, str(value).encode())
+        return _as_plain(value)
+
+    def _pack(self, value):
+        return msgpack.packb(value, default=self._default, use_bin_type=True)
+
+    def _ext_hook(self, code, data):
+        if code == EXT_BIGINT:
+            return int(data)
+        if code == EXT_TASK:
+            values = self._unpack(data)
+            return task_dict(values[0], values[1:])
+        if code == EXT_WORKFLOW:
+            values = self._unpack(data)
+            return workflow_dict(values[0], values[1:])
+        return msgpack.ExtType(code, data)
+
+    def _unpack(self, data):
+        return msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False, strict_map_key=False)
+
+    def dump_parts(self, value):
+        return [self.marker, self._pack(value)]
+
+    def loads(self, data, zero_copy=False):
+        view = memoryview(data)
+        if view[:1] != self.marker:
+            raise ValueError("not a msgpack-serialized payload")
+        return self._unpack(view[1:])
+
+
+SERIALIZERS = {"json": JSONSerializer, "binary": BinarySerializer, "msgpack": MsgpackSerializer}
+_MARKERS = {cls.marker[0]: name for name, cls in SERIALIZERS.items() if cls.marker}
+_default_name = os.environ.get("ENGINE_SERIALIZER", "json")
+_instances = {}
+
+
+def get_serializer(name=None):
+    # Takes a name, a Serializer, or None for the configured default.
+    if isinstance(name, Serializer):
+        return name
+    name = name or _default_name
+    serializer = _instances.get(name)
+    if serializer is None:
+        if name not in SERIALIZERS:
+            raise ValueError(f"Unknown serializer {name!r}, expected one of {tuple(SERIALIZERS)}")
+        serializer = _instances[name] = SERIALIZERS[name]()
+    return serializer
+
+
+def configure_serializer(name):
+    # Sets the default for backends created without an explicit serializer.
+    global _default_name
+    serializer = get_serializer(name)
+    _instances[serializer.name] = serializer
+    _default_name = serializer.name
+    return serializer
+
+
+def decode(data, zero_copy=False):
+    # Reads a payload written by any serializer; str is taken as JSON text.
+    if isinstance(data, str):
+        return json.loads(data)
+    name = _MARKERS.get(data[0]) if len(data) else None
+    return get_serializer(name or "json").loads(data, zero_copy)
@@ -0,0 +1,241 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from engine.db import StorageBackend
+from engine.serializers import decode, get_serializer
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+SQLITE_PATH = os.environ.get("ENGINE_SQLITE_PATH", "engine.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS task_results (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    state TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    duration REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS task_results_name ON task_results (name, start_time);
+CREATE INDEX IF NOT EXISTS task_results_state ON task_results (state, start_time);
+CREATE INDEX IF NOT EXISTS task_results_start ON task_results (start_time);
+
+CREATE TABLE IF NOT EXISTS workflow_results (
+    job_id TEXT PRIMARY KEY,
+    name TEXT,
+    state TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    duration REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS workflow_results_name ON workflow_results (name, start_time);
+CREATE INDEX IF NOT EXISTS workflow_results_state ON workflow_results (state, start_time);
+CREATE INDEX IF NOT EXISTS workflow_results_start ON workflow_results (start_time);
+
+CREATE TABLE IF NOT EXISTS workflow_status (
+    job_id TEXT PRIMARY KEY,
+    status TEXT,
+    updated_at INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS task_rollups (
+    task TEXT NOT NULL,
+    window_start INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    timeouts INTEGER NOT NULL DEFAULT 0,
+    retries INTEGER NOT NULL,
+    duration_sum REAL NOT NULL,
+    PRIMARY KEY (task, window_start)
+);
+CREATE INDEX IF NOT EXISTS task_rollups_window ON task_rollups (window_start);
+
+CREATE TABLE IF NOT EXISTS task_rollup_buckets (
+    task TEXT NOT NULL,
+    window_start INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (task, window_start, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS checkpoints (
+    job_id TEXT NOT NULL,
+    step INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (job_id, step)
+);
+"""
+
+# Constant SQL text, so sqlite3's statement cache prepares each one once.
+INSERT_TASK_RESULT = ("INSERT OR REPLACE INTO task_results (id, name, state, start_time, end_time, duration, data) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?)")
+INSERT_WORKFLOW_RESULT = ("INSERT OR REPLACE INTO workflow_results "
+                          "(job_id, name, state, start_time, end_time, duration, data) VALUES (?, ?, ?, ?, ?, ?, ?)")
+INSERT_STATUS = "INSERT OR REPLACE INTO workflow_status (job_id, status, updated_at) VALUES (?, ?, ?)"
+INSERT_CHECKPOINT = "INSERT OR REPLACE INTO checkpoints (job_id, step, data) VALUES (?, ?, ?)"
+SELECT_CHECKPOINTS = "SELECT data FROM checkpoints WHERE job_id = ? ORDER BY step"
+# Rollups are added in place, so several writer processes can share the file.
+UPSERT_ROLLUP = ("INSERT INTO task_rollups (task, window_start, count, failures, timeouts, retries, duration_sum) "
+                 "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (task, window_start) DO UPDATE SET "
+                 "count = count + excluded.count, failures = failures + excluded.failures, "
+                 "timeouts = timeouts + excluded.timeouts, "
+                 "retries = retries + excluded.retries, duration_sum = duration_sum + excluded.duration_sum")
+UPSERT_ROLLUP_BUCKET = ("INSERT INTO task_rollup_buckets (task, window_start, bucket, count) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (task, window_start, bucket) DO UPDATE SET count = count + excluded.count")
+
+
+def _dumps(record):
+    return json.dumps(record, separators=(",", ":"), default=str)
+
+
+class SQLiteBackend(StorageBackend):
+    # sqlite3 blocks, so every call runs on one dedicated thread that owns
+    # the connection. WAL lets readers in other processes work alongside it.
+    def __init__(self, path=SQLITE_PATH, synchronous="NORMAL", busy_timeout=5.0, serializer=None):
+        self.path = path
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        # The data column holds JSON text by default, or a BLOB from any other
+        # serializer; rows written either way read back the same.
+        self.serializer = get_serializer(serializer)
+        self._dumps = _dumps if self.serializer.name == "json" else self.serializer.dumps
+        self._conn = None
+        self._executor = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                               cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.executescript(SCHEMA)
+        logger.debug(f"Opened SQLite store {self.path}")
+        return conn
+
+    async def _submit(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="engine-sqlite")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = self._connect()
+        return self._conn
+
+    def _write(self, task_results, statuses, workflow_results, checkpoints, rollups):
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            if task_results:
+                conn.executemany(INSERT_TASK_RESULT, [
+                    (r["id"], r.get("name"), r.get("state"), r.get("start_time"), r.get("end_time"),
+                     r.get("duration"), self._dumps(r)) for r in task_results])
+            if statuses:
+                now = time.time_ns()
+                conn.executemany(INSERT_STATUS, [(job_id, status, now) for job_id, status in statuses.items()])
+            if workflow_results:
+                conn.executemany(INSERT_WORKFLOW_RESULT, [
+                    (r["job_id"], r.get("name"), r.get("state"), r.get("start_time"), r.get("end_time"),
+                     r.get("duration"), self._dumps(r)) for r in workflow_results])
+            if checkpoints:
+                conn.executemany(INSERT_CHECKPOINT, [(c["job_id"], c["step"], self._dumps(c)) for c in checkpoints])
+            if rollups:
+                conn.executemany(UPSERT_ROLLUP, [
+                    (r["task"], r["window_start"], r["count"], r["failures"], r.get("timeouts", 0), r["retries"],
+                     r["duration_sum"])
+                    for r in rollups])
+                conn.executemany(UPSERT_ROLLUP_BUCKET, [
+                    (r["task"], r["window_start"], int(index), count)
+                    for r in rollups for index, count in r["buckets"].items()])
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _read_checkpoints(self, job_id):
+        rows = self._connection().execute(SELECT_CHECKPOINTS, (job_id,)).fetchall()
+        return [decode(data) for data, in rows]
+
+    def _query(self, sql, params):
+        return self._connection().execute(sql, params).fetchall()
+
+    def _list_runs(self, name, state, since, until, limit):
+        filters = {"name = ?": name, "state = ?": state, "start_time >= ?": since, "start_time < ?": until}
+        where = [condition for condition, value in filters.items() if value is not None]
+        sql = ("SELECT job_id, name, state, start_time, end_time, duration, CASE typeof(data) "
+               "WHEN 'text' THEN json_extract(data, '$.error_message') ELSE data END FROM workflow_results")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY start_time DESC LIMIT ?"
+        params = [value for value in filters.values() if value is not None] + [limit]
+        columns = ("job_id", "name", "state", "start_time", "end_time", "duration", "error_message")
+        runs = [dict(zip(columns, row)) for row in self._query(sql, params)]
+        for run in runs:
+            if isinstance(run["error_message"], bytes):
+                run["error_message"] = decode(run["error_message"]).get("error_message")
+        return runs
+
+    def _get_run(self, job_id):
+        rows = self._query("SELECT data FROM workflow_results WHERE job_id = ?", (job_id,))
+        if not rows:
+            return None
+        run = decode(rows[0][0])
+        status = self._query("SELECT status FROM workflow_status WHERE job_id = ?", (job_id,))
+        run["status"] = status[0][0] if status else None
+        return run
+
+    def _load_rollups(self, task, since, until):
+        filters = {"task = ?": task, "window_start >= ?": since, "window_start < ?": until}
+        where = [condition for condition, value in filters.items() if value is not None]
+        where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+        params = [value for value in filters.values() if value is not None]
+        rollups = {}
+        for row in self._query("SELECT task, window_start, count, failures, timeouts, retries, duration_sum "
+                               "FROM task_rollups" + where_sql, params):
+            rollups[row[:2]] = {"task": row[0], "window_start": row[1], "count": row[2], "failures": row[3],
+                                "timeouts": row[4], "retries": row[5], "duration_sum": row[6], "buckets": {}}
+        for task_name, start, bucket, count in self._query(
+                "SELECT task, window_start, bucket, count FROM task_rollup_buckets" + where_sql, params):
+            rollup = rollups.get((task_name, start))
+            if rollup is not None:
+                rollup["buckets"][str(bucket)] = count
+        return list(rollups.values())
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def write_batch(self, task_results=(), statuses=None, workflow_results=(), checkpoints=(),
+                          rollups=(), batch_id=None):
+        if task_results or statuses or workflow_results or checkpoints or rollups:
+            await self._submit(self._write, list(task_results), dict(statuses or {}),
+                               list(workflow_results), list(checkpoints), list(rollups))
+
+    async def load_checkpoints(self, job_id):
+        return await self._submit(self._read_checkpoints, job_id)
+
+    async def list_runs(self, name=None, state=None, since=None, until=None, limit=100):
+        return await self._submit(self._list_runs, name, state, since, until, limit)
+
+    async def get_run(self, job_id):
+        return await self._submit(self._get_run, job_id)
+
+    async def load_rollups(self, task=None, since=None, until=None):
+        return await self._submit(self._load_rollups, task, since, until)
+
+    async def query(self, sql, params=()):
+        return await self._submit(self._query, sql, params)
+
+    async def close(self):
+        if self._executor is not None:
+            await self._submit(self._close)
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -0,0 +1,49 @@
+import asyncio
+
+_END = object()
+
+
+class _StreamError:
+    def __init__(self, error):
+        self.error = error
+
+
+class TaskStream:
+    # Bounded channel from a streaming task to one consumer. A full buffer
+    # makes the producer wait, so backpressure runs along the whole chain.
+    def __init__(self, maxsize=16):
+        self._queue = asyncio.Queue(maxsize)
+        self._closed = False
+        self._abandoned = False
+
+    async def put(self, chunk):
+        if self._closed:
+            raise RuntimeError("put() on a closed TaskStream")
+        if not self._abandoned:
+            await self._queue.put(chunk)
+
+    async def close(self, error=None):
+        if self._closed:
+            return
+        self._closed = True
+        if not self._abandoned:
+            await self._queue.put(_END if error is None else _StreamError(error))
+
+    def abandon(self):
+        # The consumer will never read; let the producer run to completion.
+        self._abandoned = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is _END:
+            self._queue.put_nowait(_END)
+            raise StopAsyncIteration
+        if isinstance(item, _StreamError):
+            self._queue.put_nowait(item)
+            raise item.error
+        return item
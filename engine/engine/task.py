@@ -1,94 +1,507 @@
 import asyncio
+import contextvars
 import functools
-import traceback
-from datetime import datetime
+import inspect
+import logging
+import time
+from datetime import datetime, timedelta
 from enum import Enum, auto
 import uuid
 
-from engine.db import save_task_result, save_workflow_result
+from engine import deadline, events, tracing
+from engine.blobstore import SCALARS, offload, offload_async
+from engine.cache import cache_key as make_cache_key, get_cache
+from engine.retry import NO_RETRY, RetryPolicy
+from engine.stream import TaskStream
+from engine.executors import EXECUTOR_MODES, call_task_body, run_in_executor
+from engine.ratelimit import get_limit
+from engine.utils import get_logger
+from engine.writer import persist_task_result, record_outcome
+
+logger = get_logger(__name__)
+
+_in_flight = {}
+_current_task = contextvars.ContextVar("engine_current_task", default=None)
+_cancelled = contextvars.ContextVar("engine_cancelled_tasks", default=None)
 
 class TaskState(Enum):
     PENDING = auto()
     RUNNING = auto()
     SUCCESS = auto()
     FAILED = auto()
+    TIMED_OUT = auto()
+
+def _timestamp(epoch_ns):
+    return datetime.fromtimestamp(epoch_ns / 1e9).isoformat() if epoch_ns else None
+
+
+class TimedRecord:
+    # Wall-clock start for reporting, perf_counter_ns for the duration.
+    __slots__ = ("state", "started_at_ns", "start_ns", "end_ns")
+
+    def _begin(self):
+        self.started_at_ns = time.time_ns()
+        self.start_ns = time.perf_counter_ns()
+        self.end_ns = None
+
+    def _finish(self):
+        self.end_ns = time.perf_counter_ns()
+
+    @property
+    def start_time(self):
+        return datetime.fromtimestamp(self.started_at_ns / 1e9) if self.started_at_ns else None
+
+    @property
+    def end_time(self):
+        if self.end_ns is None:
+            return None
+        return datetime.fromtimestamp((self.started_at_ns + self.end_ns - self.start_ns) / 1e9)
+
+    @property
+    def duration(self):
+        if self.end_ns is None:
+            return None
+        return timedelta(microseconds=(self.end_ns - self.start_ns) / 1000)
+
+    @property
+    def duration_seconds(self):
+        return (self.end_ns - self.start_ns) / 1e9 if self.end_ns is not None else None
+
+    def _times(self):
+        end_at_ns = self.started_at_ns + self.end_ns - self.start_ns if self.end_ns is not None else None
+        return _timestamp(self.started_at_ns), _timestamp(end_at_ns), self.duration_seconds
+
+
+class TaskResult(TimedRecord):
+    __slots__ = ("name", "id", "job_id", "input_data", "output_data", "error_message", "retries",
+                 "queue_wait", "run_time", "cache_hits", "cache_misses",
+                 "first_chunk_time", "chunk_count", "coalesced", "usage", "_refs")
 
-class TaskResult:
     def __init__(self, name, id=None):
         self.name = name
         self.id = id or str(uuid.uuid4())
+        # The workflow run this call belongs to, if any.
+        self.job_id = events.current_job()
         self.state = TaskState.PENDING
-        self.start_time = None
-        self.end_time = None
-        self.duration = None
+        self.started_at_ns = None
+        self.start_ns = None
+        self.end_ns = None
         self.input_data = None
         self.output_data = None
         self.error_message = None
         self.retries = 0
+        self.queue_wait = None
+        self.run_time = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.first_chunk_time = None
+        self.chunk_count = 0
+        self.coalesced = False
+        self.usage = None
+        self._refs = None
 
     def start(self, input_data):
         self.state = TaskState.RUNNING
-        self.start_time = datetime.now()
+        self._begin()
         self.input_data = input_data
-        print(f"{self.name} state: {self.state}, Input: {self.input_data}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("task=%s id=%s state=RUNNING", self.name, self.id)
 
     def complete(self, output_data):
         self.state = TaskState.SUCCESS
-        self.end_time = datetime.now()
-        self.duration = self.end_time - self.start_time
+        self._finish()
         self.output_data = output_data
-        print(f"{self.name} state: {self.state}, Duration: {self.duration}, Output: {self.output_data}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("task=%s id=%s state=SUCCESS duration=%.6f", self.name, self.id, self.duration_seconds)
 
     def fail(self, error_message):
         self.state = TaskState.FAILED
-        self.end_time = datetime.now()
-        self.duration = self.end_time - self.start_time
+        self._finish()
+        self.error_message = error_message
+        if logger.isEnabledFor(logging.WARNING):
+            logger.warning("task=%s id=%s state=FAILED retries=%d error=%s",
+                           self.name, self.id, self.retries, error_message)
+
+    def time_out(self, error_message):
+        self.state = TaskState.TIMED_OUT
+        self._finish()
         self.error_message = error_message
-        print(f"{self.name} state: {self.state}, Error: {self.error_message}, Retries: {self.retries}")
+        if logger.isEnabledFor(logging.WARNING):
+            logger.warning("task=%s id=%s state=TIMED_OUT retries=%d error=%s",
+                           self.name, self.id, self.retries, error_message)
 
     def increment_retries(self):
         self.retries += 1
-        print(f"{self.name} retrying, attempt {self.retries}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("task=%s id=%s attempt=%d", self.name, self.id, self.retries)
+
+    def _cached_ref(self, slot, value):
+        if self._refs is None:
+            self._refs = [None, None]
+        cached = self._refs[slot]
+        return cached if cached is not None and cached[0] is value else None
+
+    def _offloaded(self, slot, value):
+        # Large payloads go to the blob store once; the task record and the
+        # workflow record that embeds it then share the same reference.
+        if isinstance(value, SCALARS):
+            return value
+        cached = self._cached_ref(slot, value)
+        if cached is not None:
+            return cached[1]
+        # Arguments are offloaded one by one, so a large upstream output passed
+        # on as an argument maps to the blob already stored for that output.
+        ref = [offload(arg) for arg in value] if isinstance(value, tuple) else offload(value)
+        self._refs[slot] = (value, ref)
+        return ref
+
+    async def offload_payloads(self):
+        # Stores large payloads with the blob store's hashing and writes off
+        # the event loop; to_dict() then reuses the references.
+        for slot, value in ((0, self.input_data), (1, self.output_data)):
+            if isinstance(value, SCALARS) or self._cached_ref(slot, value) is not None:
+                continue
+            if isinstance(value, tuple):
+                ref = [await offload_async(arg) for arg in value]
+            else:
+                ref = await offload_async(value)
+            self._refs[slot] = (value, ref)
 
     def to_dict(self):
+        # Only called when the record is persisted.
+        start_time, end_time, duration = self._times()
         return {
             "name": self.name,
             "id": self.id,
+            "job_id": self.job_id,
             "state": self.state.name,
-            "start_time": self.start_time.isoformat() if self.start_time else None,
-            "end_time": self.end_time.isoformat() if self.end_time else None,
-            "duration": self.duration.total_seconds() if self.duration else None,
-            "input_data": self.input_data,
-            "output_data": self.output_data,
+            "start_time": start_time,
+            "end_time": end_time,
+            "duration": duration,
+            "input_data": self._offloaded(0, self.input_data),
+            "output_data": self._offloaded(1, self.output_data),
             "error_message": self.error_message,
-            "retries": self.retries
+            "retries": self.retries,
+            "queue_wait": self.queue_wait,
+            "run_time": self.run_time,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "first_chunk_time": self.first_chunk_time,
+            "chunk_count": self.chunk_count,
+            "coalesced": self.coalesced,
+            "usage": self.usage
         }
 
-def task(max_retries=3, delay=1, id=None):
+async def _call(func, wrapper, executor, timeout, task_result, args, kwargs):
+    if executor == "async":
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await asyncio.wait_for(result, timeout)
+        task_result.queue_wait = 0.0
+        task_result.run_time = time.perf_counter() - started
+        return result
+    if executor == "process":
+        func = functools.partial(call_task_body, wrapper)
+    result, task_result.queue_wait, task_result.run_time = await run_in_executor(
+        executor, func, args, kwargs, timeout)
+    return result
+
+def current_task():
+    # The TaskResult of the async task running in this context, so code
+    # inside a task body can report on it (e.g. token usage while streaming).
+    return _current_task.get()
+
+def collect_cancelled(results):
+    # Task calls cancelled in this context (not ones nested in another
+    # task's body) append their TaskResult to `results`, so a workflow
+    # cancelled by its deadline still reports them. Returns a token for
+    # reset_cancelled().
+    return _cancelled.set(results)
+
+def reset_cancelled(token):
+    _cancelled.reset(token)
+
+def _record_usage(task_result, result):
+    usage = result.get("usage") if isinstance(result, dict) else getattr(result, "usage", None)
+    if usage is not None and not isinstance(usage, dict):
+        usage = {name: getattr(usage, name, None)
+                 for name in ("prompt_tokens", "completion_tokens", "total_tokens")}
+    if usage is not None:
+        task_result.usage = usage
+
+async def _limited(pool, tokens, run, task_result):
+    # Waiting for the pool counts as queue time, not run time.
+    async with pool.slot(tokens) as lease:
+        result = await run()
+        _record_usage(task_result, result)
+        if task_result.usage:
+            lease.report_tokens(task_result.usage.get("total_tokens"))
+    task_result.queue_wait = (task_result.queue_wait or 0.0) + lease.waited
+    return result
+
+async def _single_flight(key, task_result, run, durable):
+    # Identical concurrent calls share one execution. If the leader is
+    # cancelled the waiters go round again and one of them takes over.
+    # Each waiter still gets its own record, ending as the leader's did.
+    while True:
+        shared = _in_flight.get(key)
+        if shared is None:
+            break
+        try:
+            leader, result = await asyncio.shield(shared)
+        except asyncio.CancelledError:
+            if not shared.cancelled():
+                raise
+            continue
+        task_result.coalesced = True
+        if leader.state == TaskState.SUCCESS:
+            task_result.complete(result)
+        elif leader.state == TaskState.TIMED_OUT:
+            task_result.time_out(leader.error_message)
+        else:
+            task_result.fail(leader.error_message)
+        record_outcome(task_result)
+        await persist_task_result(task_result, durable)
+        return task_result, result
+
+    future = asyncio.get_running_loop().create_future()
+    _in_flight[key] = future
+    try:
+        outcome = await run()
+    except BaseException:
+        future.cancel()
+        raise
+    finally:
+        if _in_flight.get(key) is future:
+            del _in_flight[key]
+    future.set_result(outcome)
+    return outcome
+
+async def _stream(func, task_result, sinks, collect, args, kwargs):
+    chunks = [] if collect else None
+    started = time.perf_counter()
+    async for chunk in func(*args, **kwargs):
+        if task_result.chunk_count == 0:
+            task_result.first_chunk_time = time.perf_counter() - started
+        task_result.chunk_count += 1
+        if events.listening():
+            events.emit(events.EventType.CHUNK_PRODUCED, task_result, index=task_result.chunk_count - 1, chunk=chunk)
+        for sink in sinks:
+            await sink.put(chunk)
+        if chunks is not None:
+            chunks.append(chunk)
+    task_result.queue_wait = 0.0
+    task_result.run_time = time.perf_counter() - started
+    return chunks
+
+async def _persist(task_result, durable, span):
+    started = time.perf_counter()
+    await persist_task_result(task_result, durable)
+    if span.recording:
+        span.set_attributes({
+            "task.retries": task_result.retries,
+            "task.queue_wait": task_result.queue_wait,
+            "task.execution_time": task_result.run_time,
+            "task.persistence_time": time.perf_counter() - started,
+            "task.input_size": tracing.payload_size(task_result.input_data),
+            "task.output_size": tracing.payload_size(task_result.output_data),
+            "task.chunk_count": task_result.chunk_count,
+        })
+
+def _timed_out(error, attempt_timeout):
+    return isinstance(error, deadline.DeadlineExceeded) or (
+        attempt_timeout is not None and isinstance(error, asyncio.TimeoutError))
+
+def _describe_input(args, kwargs):
+    if any(isinstance(arg, TaskStream) for arg in args):
+        args = tuple("<stream>" if isinstance(arg, TaskStream) else arg for arg in args)
+    return args if args else kwargs
+
+def task(max_retries=3, delay=1, id=None, durable=False, executor="async", timeout=None,
+         cache=None, cache_key=None, cache_ttl=None, stream_input=False, retry=None, limit=None,
+         limit_tokens=None, single_flight=False):
+    # retry=RetryPolicy(...) replaces the fixed max_retries/delay schedule.
+    # limit="name" runs every call inside the engine.ratelimit pool of that
+    # name; limit_tokens(*args, **kwargs) estimates the tokens a call uses.
+    # single_flight=True makes identical concurrent calls (same cache key)
+    # wait for one execution; each caller still gets its own TaskResult.
+    # cache=True uses the shared engine.cache store, or pass a TaskCache.
+    # cache_key(*args, **kwargs) overrides which arguments identify a call.
+    # stream_input=True lets the task take an upstream streaming task's
+    # chunks as an async iterator instead of waiting for the whole output.
+    # executor="thread" or "process" runs the body off the event loop. A
+    # timeout or cancel there only stops waiting for it: the body keeps
+    # running, and holding its worker, until it returns or calls
+    # engine.deadline.check(), which raises once the call is abandoned.
+    if executor not in EXECUTOR_MODES:
+        raise ValueError(f"executor must be one of {EXECUTOR_MODES}, got {executor!r}")
+    retry_policy = retry if retry is not None else RetryPolicy.fixed(max_retries, delay)
+
     def decorator(func):
-        @functools.wraps(func)
-        async def wrapper(*args, **kwargs):
+        streams = inspect.isasyncgenfunction(func)
+        if streams and (executor != "async" or cache or single_flight):
+            raise ValueError("Streaming tasks run on the event loop and cannot be cached or coalesced")
+
+        span_name = f"task {func.__name__}"
+
+        async def execute(sinks, collect, args, kwargs):
             task_result = TaskResult(func.__name__)
-            input_data = args if args else kwargs
-            task_result.start(input_data)
-            
-            for attempt in range(max_retries):
-                try:
-                    # Execute the task
-                    result = await func(*args, **kwargs)
-                    
-                    # Capture the output data and mark task as complete
-                    task_result.complete(result)
-                    await save_task_result(task_result.to_dict())
-                    return task_result, result
-                except Exception as e:
-                    task_result.increment_retries()
-                    task_result.fail(str(e))
-                    await save_task_result(task_result.to_dict())
-                    traceback.print_exc()
-                    if attempt < max_retries - 1:
-                        await asyncio.sleep(delay)  # Delay before retrying
-                        task_result.state = TaskState.RUNNING
+            task_result.start(_describe_input(args, kwargs))
+            events.emit(events.EventType.TASK_STARTED, task_result)
+            try:
+                store = get_cache() if cache is True else cache
+                key = None
+                if store:
+                    key = make_cache_key(func, args, kwargs, cache_key)
+                    hit, result = await store.get(key)
+                    if hit:
+                        # Served from cache: no call, no retries, nothing persisted.
+                        task_result.cache_hits += 1
+                        task_result.complete(result)
+                        return task_result, result
+                    task_result.cache_misses += 1
+
+                if single_flight and not sinks and not any(isinstance(arg, TaskStream) for arg in args):
+                    if key is None:
+                        key = make_cache_key(func, args, kwargs, cache_key)
+                    return await _single_flight(key, task_result, lambda: attempts(
+                        task_result, store, key, sinks, collect, args, kwargs), durable)
+                return await attempts(task_result, store, key, sinks, collect, args, kwargs)
+            finally:
+                events.emit_task_finished(task_result)
+
+        async def attempts(task_result, store, key, sinks, collect, args, kwargs):
+            # A consumed stream cannot be replayed, so stream consumers get one attempt.
+            policy = NO_RETRY if any(isinstance(arg, TaskStream) for arg in args) else retry_policy
+            pool = get_limit(limit) if limit is not None else None
+            started = time.monotonic()
+            attempt = 0
+            finished = False
+            nested = _current_task.get() is not None
+            current = _current_task.set(task_result)
+            try:
+                while True:
+                    attempt += 1
+                    with tracing.start_span(span_name) as span:
+                        if span.recording:
+                            span.set_attributes({"task.name": func.__name__, "task.id": task_result.id,
+                                                 "task.attempt": attempt, "task.executor": executor})
+                        # The attempt runs under the tighter of the task's own
+                        # timeout and whatever is left of the workflow deadline.
+                        attempt_timeout = deadline.effective_timeout(timeout)
+                        scope = deadline.use_deadline(attempt_timeout) if attempt_timeout is not None else None
+                        try:
+                            if attempt_timeout is not None and attempt_timeout <= 0:
+                                raise deadline.DeadlineExceeded("Deadline exceeded before the task started")
+                            # Execute the task
+                            if streams:
+                                run = lambda: asyncio.wait_for(
+                                    _stream(func, task_result, sinks, collect, args, kwargs), attempt_timeout)
+                            else:
+                                run = lambda: _call(func, wrapper, executor, attempt_timeout, task_result, args,
+                                                    kwargs)
+                            if pool is not None:
+                                tokens = limit_tokens(*args, **kwargs) if limit_tokens else 1
+                                result = await _limited(pool, tokens, run, task_result)
+                            else:
+                                result = await run()
+                                _record_usage(task_result, result)
+
+                            # Capture the output data and mark task as complete
+                            task_result.complete(result)
+                            if store:
+                                await store.set(key, result, cache_ttl)
+                            record_outcome(task_result)
+                            finished = True
+                            await _persist(task_result, durable, span)
+                            for sink in sinks:
+                                await sink.close()
+                            span.set_status(tracing.STATUS_OK)
+                            return task_result, result
+                        except Exception as e:
+                            error = e
+                            task_result.increment_retries()
+                            # Only a timeout the engine imposed counts as TIMED_OUT; a
+                            # TimeoutError from inside the body is an ordinary failure.
+                            if _timed_out(e, attempt_timeout):
+                                message = str(e) or (f"Timed out after {attempt_timeout:.3f}s"
+                                                     if attempt_timeout is not None else "Deadline exceeded")
+                                task_result.time_out(message)
+                            else:
+                                message = str(e) or type(e).__name__
+                                task_result.fail(message)
+                                logger.debug("task=%s attempt=%d raised", func.__name__, attempt, exc_info=True)
+                            span.set_status(tracing.STATUS_ERROR, message)
+                            await _persist(task_result, durable, span)
+                        finally:
+                            if scope is not None:
+                                deadline.reset_deadline(scope)
+                    if task_result.chunk_count:
+                        # Chunks already went downstream; a retry would duplicate them.
+                        break
+                    retry_delay = policy.next_delay(error, attempt, time.monotonic() - started)
+                    left = deadline.remaining()
+                    if retry_delay is None or (left is not None and retry_delay >= left):
+                        break
+                    events.emit(events.EventType.TASK_RETRYING, task_result, attempt=attempt, delay=retry_delay,
+                                error=task_result.error_message)
+                    await asyncio.sleep(retry_delay)  # Delay before retrying
+                    task_result.state = TaskState.RUNNING
+                record_outcome(task_result)
+                finished = True
+                for sink in sinks:
+                    await sink.close(error)
+            except asyncio.CancelledError:
+                # Cancelled from outside, e.g. by a workflow deadline or a
+                # failed sibling: record how the call ended before unwinding.
+                for sink in sinks:
+                    sink.abandon()
+                collected = _cancelled.get()
+                if collected is not None and not nested:
+                    collected.append(task_result)
+                if not finished:
+                    # Cancelled mid-attempt, or while backing off before a
+                    # retry, where the state is the last attempt's.
+                    if task_result.state == TaskState.RUNNING:
+                        left = deadline.remaining()
+                        if left is not None and left <= 0:
+                            task_result.time_out("Workflow deadline exceeded")
+                        else:
+                            task_result.fail("Cancelled")
+                        record_outcome(task_result)
+                        await persist_task_result(task_result)
+                    else:
+                        # Its last attempt already persisted it.
+                        record_outcome(task_result)
+                raise
+            except BaseException:
+                for sink in sinks:
+                    sink.abandon()
+                raise
+            finally:
+                _current_task.reset(current)
             return task_result, None
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await execute((), True, args, kwargs)
+
+        async def run_streaming(sinks, collect, *args, **kwargs):
+            return await execute(sinks, collect, args, kwargs)
+
+        def run_map(iterable, chunk_size=100, concurrency=4, ordered=True, return_exceptions=False):
+            # One call per element, persisted and retried per chunk; see
+            # engine.mapping.MapRun.
+            from engine.mapping import MapRun
+            if streams:
+                raise ValueError("Streaming tasks cannot be mapped")
+            return MapRun(func, wrapper, executor, timeout, retry_policy, limit, limit_tokens, durable, iterable,
+                          chunk_size, concurrency, ordered, return_exceptions)
+
+        wrapper.streams = streams
+        wrapper.accepts_stream = stream_input
+        wrapper.run_streaming = run_streaming
+        wrapper.map = run_map
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,299 @@
+import atexit
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current_span = contextvars.ContextVar("engine_current_span", default=None)
+
+
+class Span:
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "start_ns",
+                 "_start_perf_ns", "end_ns", "attributes", "status", "status_message", "_token")
+
+    recording = True
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self._start_perf_ns = time.perf_counter_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes) if attributes else {}
+        self.status = STATUS_UNSET
+        self.status_message = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def set_status(self, status, message=None):
+        self.status = status
+        self.status_message = message
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = self.start_ns + time.perf_counter_ns() - self._start_perf_ns
+            self.tracer._on_end(self)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        if exc is not None and self.status == STATUS_UNSET:
+            self.set_status(STATUS_ERROR, repr(exc))
+        self.end()
+
+
+class _NoopSpan:
+    # Returned whenever tracing is off or the trace was not sampled.
+    # Entering it still marks the context so child spans are skipped too.
+    __slots__ = ("_token",)
+
+    recording = False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def set_status(self, status, message=None):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+
+
+class _DisabledSpan(_NoopSpan):
+    # Tracing is off: skip the context variable as well.
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NOOP_SPAN = _DisabledSpan()
+
+
+class InMemoryExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+    def shutdown(self):
+        pass
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def span_to_otlp(span):
+    data = {
+        "traceId": f"{span.trace_id:032x}",
+        "spanId": f"{span.span_id:016x}",
+        "name": span.name,
+        "kind": 1,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+        "status": {"code": span.status},
+    }
+    if span.parent_id is not None:
+        data["parentSpanId"] = f"{span.parent_id:016x}"
+    if span.status_message:
+        data["status"]["message"] = span.status_message
+    return data
+
+
+class OTLPJsonFileExporter:
+    # One OTLP/JSON ExportTraceServiceRequest per line, one line per batch.
+    def __init__(self, path="traces.jsonl", service_name="engine"):
+        self.path = path
+        self.service_name = service_name
+
+    def export(self, spans):
+        request = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "engine"}, "spans": [span_to_otlp(span) for span in spans]}],
+            }]
+        }
+        with open(self.path, "a") as file:
+            file.write(json.dumps(request, separators=(",", ":")) + "\n")
+
+    def shutdown(self):
+        pass
+
+
+class Tracer:
+    def __init__(self, exporter=None, sample_rate=1.0, max_batch=512, export_interval=5.0, max_queued=8):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.max_batch = max_batch
+        self.export_interval = export_interval
+        self.enabled = exporter is not None
+        self._batch = []
+        self._last_export = time.monotonic()
+        self._lock = threading.Lock()
+        # Full batches are exported on a thread of their own, so a slow
+        # exporter never holds up the code that ends a span. Past
+        # max_queued waiting batches new ones are dropped.
+        self._queue = queue.Queue(max_queued)
+        self._exporter_thread = None
+        self.dropped = 0
+
+    def start_span(self, name, attributes=None):
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = _current_span.get()
+        if parent is None:
+            if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+                return _NoopSpan()
+            return Span(self, name, random.getrandbits(128), None, attributes)
+        if not parent.recording:
+            return _NoopSpan()
+        return Span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    def _on_end(self, span):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._batch.append(span)
+            if (len(self._batch) < self.max_batch
+                    and time.monotonic() - self._last_export < self.export_interval):
+                return
+            batch, self._batch = self._batch, []
+            self._last_export = time.monotonic()
+            self._start_exporter()
+        try:
+            self._queue.put_nowait(batch)
+        except queue.Full:
+            self.dropped += len(batch)
+            logger.error(f"Dropped {len(batch)} spans, the export queue is full")
+
+    def _start_exporter(self):
+        if self._exporter_thread is None:
+            self._exporter_thread = threading.Thread(target=self._export_loop, name="engine-trace-export",
+                                                     daemon=True)
+            self._exporter_thread.start()
+
+    def _export_loop(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                self._export(batch)
+            finally:
+                self._queue.task_done()
+
+    def _export(self, batch):
+        try:
+            self.exporter.export(batch)
+        except Exception as e:
+            logger.error(f"Dropped {len(batch)} spans, export failed: {e}")
+
+    def flush(self):
+        # Exports everything ended so far and waits until it is written.
+        with self._lock:
+            batch, self._batch = self._batch, []
+            self._last_export = time.monotonic()
+            self._start_exporter()
+        if batch:
+            self._queue.put(batch)
+        self._queue.join()
+
+    def shutdown(self):
+        if self.enabled:
+            self.flush()
+            self._queue.put(None)
+            self._exporter_thread.join()
+            self._exporter_thread = None
+            self.exporter.shutdown()
+            self.enabled = False
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    return _tracer
+
+
+def configure_tracing(exporter=None, sample_rate=1.0, **kwargs):
+    global _tracer
+    _tracer.shutdown()
+    _tracer = Tracer(exporter, sample_rate, **kwargs)
+    return _tracer
+
+
+def start_span(name, attributes=None):
+    return _tracer.start_span(name, attributes)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def detach():
+    # Background tasks inherit the creator's context; start their own traces.
+    _current_span.set(None)
+
+
+def payload_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return len(repr(value))
+
+
+if os.environ.get("ENGINE_TRACE_FILE"):
+    configure_tracing(OTLPJsonFileExporter(os.environ["ENGINE_TRACE_FILE"]),
+                      float(os.environ.get("ENGINE_TRACE_SAMPLE_RATE", 1.0)))
+
+atexit.register(lambda: _tracer.shutdown())
@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import importlib
+import json
+import signal
+import sys
+import threading
+import uuid
+from collections import deque
+
+from engine import deadline, writer
+from engine.task import TaskState
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+class Job:
+    def __init__(self, name, kwargs, job_id=None):
+        self.name = name
+        self.kwargs = kwargs
+        self.job_id = job_id or uuid.uuid4().hex
+
+
+class WorkerStats:
+    def __init__(self):
+        self.submitted = 0
+        self.rejected = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    def to_dict(self):
+        return {
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+class Worker:
+    def __init__(self, concurrency=100, queue_size=1000, limits=None, drain_timeout=None, job_timeout=None):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.limits = dict(limits or {})
+        self.drain_timeout = drain_timeout
+        # Deadline for each job, inherited by its workflow and tasks, so a
+        # hung call cannot hold a slot forever.
+        self.job_timeout = job_timeout
+        self.workflows = {}
+        self.stats = WorkerStats()
+        self._loop = None
+        self._running = set()
+        self._stopping = False
+        self._done_callbacks = []
+
+    def register(self, workflow_func, limit=None):
+        name = workflow_func.workflow_name
+        self.workflows[name] = workflow_func
+        if limit is not None:
+            self.limits[name] = limit
+            if self._loop is not None:
+                self._name_slots[name] = asyncio.Semaphore(limit)
+        return workflow_func
+
+    def add_done_callback(self, callback):
+        # callback(job) runs once each job has finished, however it ended.
+        self._done_callbacks.append(callback)
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue(self.queue_size)
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._name_slots = {name: asyncio.Semaphore(limit) for name, limit in self.limits.items()}
+            self._stopped = asyncio.Event()
+            self._released = asyncio.Event()
+            # Jobs taken off the queue while their workflow was at its limit.
+            self._parked = {}
+            self._parked_count = 0
+
+    def _job(self, name, job_id, kwargs):
+        if self._stopping:
+            raise RuntimeError("Worker is draining and no longer accepts jobs")
+        if name not in self.workflows:
+            raise KeyError(f"Unknown workflow {name!r}")
+        return Job(name, kwargs, job_id)
+
+    async def submit(self, name, job_id=None, **kwargs):
+        # Waits while the queue is full, which pushes back on the producer.
+        self._bind()
+        job = self._job(name, job_id, kwargs)
+        await self._queue.put(job)
+        self.stats.submitted += 1
+        return job.job_id
+
+    def submit_nowait(self, name, job_id=None, **kwargs):
+        self._bind()
+        job = self._job(name, job_id, kwargs)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.stats.rejected += 1
+            raise
+        self.stats.submitted += 1
+        return job.job_id
+
+    def qsize(self):
+        return self._queue.qsize() + self._parked_count if self._loop else 0
+
+    def stop(self):
+        if not self._stopping:
+            logger.info("Worker draining: no new jobs accepted")
+            self._stopping = True
+            self._stopped.set()
+
+    def _saturated(self, name):
+        name_slots = self._name_slots.get(name)
+        return name_slots is not None and name_slots.locked()
+
+    def _unpark(self):
+        for name, jobs in self._parked.items():
+            if jobs and not self._saturated(name):
+                self._parked_count -= 1
+                return jobs.popleft()
+        return None
+
+    async def _next_job(self):
+        # The next job whose workflow has room under its own limit, or None
+        # once draining and nothing is left. A job at its limit is set aside
+        # instead of holding a global slot, so it cannot starve other
+        # workflows; at most queue_size jobs are set aside at a time.
+        while True:
+            self._released.clear()
+            job = self._unpark()
+            if job is not None:
+                return job
+            if self._stopping and self._queue.empty():
+                if not self._parked_count:
+                    return None
+                take = False
+            else:
+                take = self._parked_count < self.queue_size
+            waits = {asyncio.ensure_future(self._released.wait())}
+            if take:
+                get = asyncio.ensure_future(self._queue.get())
+                waits |= {get, asyncio.ensure_future(self._stopped.wait())}
+            await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            for future in waits:
+                future.cancel()
+            if not take or not get.done() or get.cancelled():
+                continue
+            job = get.result()
+            if not self._saturated(job.name):
+                return job
+            self._parked.setdefault(job.name, deque()).append(job)
+            self._parked_count += 1
+
+    async def run(self):
+        self._bind()
+        while True:
+            # Only take a job off the queue once there is a slot to run it,
+            # so a saturated worker lets the queue fill up.
+            await self._slots.acquire()
+            job = await self._next_job()
+            if job is None:
+                self._slots.release()
+                break
+            name_slots = self._name_slots.get(job.name)
+            if name_slots is not None:
+                # Never waits: _next_job only returns jobs whose name has room.
+                await name_slots.acquire()
+            future = asyncio.ensure_future(self._execute(job))
+            self._running.add(future)
+            future.add_done_callback(self._running.discard)
+        await self._drain()
+
+    async def _drain(self):
+        if not self._running:
+            return
+        logger.info(f"Waiting for {len(self._running)} running workflows")
+        done, pending = await asyncio.wait(set(self._running), timeout=self.drain_timeout)
+        for future in pending:
+            future.cancel()
+        if pending:
+            logger.warning(f"Cancelled {len(pending)} workflows after drain timeout")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _execute(self, job):
+        # Runs holding a global slot and, for limited workflows, a slot of
+        # its name; both were taken in run().
+        name_slots = self._name_slots.get(job.name)
+        try:
+            self.stats.running += 1
+            scope = deadline.use_deadline(self.job_timeout) if self.job_timeout is not None else None
+            try:
+                result = await self.workflows[job.name](job_id=job.job_id, **job.kwargs)
+                # A workflow that fails or times out returns its result
+                # rather than raising.
+                state = getattr(result, "state", None)
+                if state in (TaskState.FAILED, TaskState.TIMED_OUT):
+                    self.stats.failed += 1
+                    logger.error(f"Workflow {job.name} (ID: {job.job_id}) {state.name}: {result.error_message}")
+                else:
+                    self.stats.completed += 1
+            except Exception as e:
+                self.stats.failed += 1
+                logger.error(f"Workflow {job.name} (ID: {job.job_id}) raised: {e}")
+            finally:
+                if scope is not None:
+                    deadline.reset_deadline(scope)
+                self.stats.running -= 1
+                if name_slots is not None:
+                    name_slots.release()
+                    self._released.set()
+        finally:
+            self._slots.release()
+            for callback in self._done_callbacks:
+                callback(job)
+
+    async def serve(self):
+        self._bind()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            self._loop.add_signal_handler(sig, self.stop)
+        try:
+            await self.run()
+        finally:
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                self._loop.remove_signal_handler(sig)
+            await writer.shutdown()
+
+
+def load_workflow(path):
+    module_name, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def _read_stdin(loop, lines):
+    # On a daemon thread, so a readline blocked on an open stdin does not
+    # keep the process alive once the worker has drained.
+    try:
+        for line in sys.stdin:
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+        loop.call_soon_threadsafe(lines.put_nowait, None)
+    except RuntimeError:
+        # The loop has already closed.
+        pass
+
+
+async def _feed_stdin(worker):
+    # One JSON object per line: {"workflow": ..., "job_id": ..., "kwargs": {...}}
+    lines = asyncio.Queue()
+    threading.Thread(target=_read_stdin, args=(asyncio.get_running_loop(), lines), name="engine-stdin",
+                     daemon=True).start()
+    while True:
+        line = await lines.get()
+        if line is None:
+            break
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            await worker.submit(request["workflow"], request.get("job_id"), **request.get("kwargs", {}))
+        except RuntimeError:
+            return
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.error(f"Skipping job line {line.strip()!r}: {e}")
+    worker.stop()
+
+
+async def _main(args):
+    worker = Worker(concurrency=args.concurrency, queue_size=args.queue_size,
+                    drain_timeout=args.drain_timeout, job_timeout=args.job_timeout)
+    for path in args.workflows:
+        worker.register(load_workflow(path))
+    feeder = asyncio.ensure_future(_feed_stdin(worker))
+    await worker.serve()
+    feeder.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run registered workflows from jobs read on stdin")
+    parser.add_argument("workflows", nargs="+", help="module:function of @workflow functions")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--drain-timeout", type=float, default=None)
+    parser.add_argument("--job-timeout", type=float, default=None)
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
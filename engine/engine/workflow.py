@@ -1,115 +1,245 @@
-import logging
 import functools
-from datetime import datetime
+import logging
+import os
+import time
 
-logger = logging.getLogger(__name__)
+import asyncio
 
-from engine.db import (
-    save_workflow_result,
-    create_workflow_status,
-    update_workflow_status
+from engine import deadline, events, retry, tracing
+from engine.writer import (
+    persist_workflow_result,
+    persist_workflow_status
 )
-from engine.task import TaskState
+from engine.checkpoint import load_checkpoints, save_checkpoint, workflow_version
+from engine.flowengine import FlowEngine, TaskNode
+from engine.task import TaskResult, TaskState, TimedRecord, collect_cancelled, reset_cancelled
 from engine.utils import get_logger
 
-logger = get_logger()
+logger = get_logger(__name__)
+
+# Progress goes out as events as it happens; the workflow_status row is
+# written at most this often (seconds) per run, plus once at the end.
+STATUS_INTERVAL = float(os.environ.get("ENGINE_STATUS_INTERVAL", 1.0))
+
+class WorkflowResult(TimedRecord):
+    __slots__ = ("name", "job_id", "tasks", "error_message")
 
-class WorkflowResult:
     def __init__(self, name, job_id):
         self.name = name
         self.job_id = job_id
         self.state = TaskState.PENDING
-        self.start_time = None
-        self.end_time = None
-        self.duration = None
+        self.started_at_ns = None
+        self.start_ns = None
+        self.end_ns = None
         self.tasks = []
         self.error_message = None
 
     def start(self):
         self.state = TaskState.RUNNING
-        self.start_time = datetime.now()
-        print(f"Workflow {self.name} (ID: {self.job_id}) state: {self.state}")
+        self._begin()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("workflow=%s job_id=%s state=RUNNING", self.name, self.job_id)
 
     def complete(self):
         self.state = TaskState.SUCCESS
-        self.end_time = datetime.now()
-        self.duration = self.end_time - self.start_time
-        print(f"Workflow {self.name} (ID: {self.job_id}) state: {self.state}, Duration: {self.duration}")
+        self._finish()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("workflow=%s job_id=%s state=SUCCESS duration=%.6f",
+                        self.name, self.job_id, self.duration_seconds)
 
     def fail(self, error_message):
         self.state = TaskState.FAILED
-        self.end_time = datetime.now()
-        self.duration = self.end_time - self.start_time
+        self._finish()
         self.error_message = error_message
-        print(f"Workflow {self.name} (ID: {self.job_id}) state: {self.state}, Error: {self.error_message}")
+        if logger.isEnabledFor(logging.WARNING):
+            logger.warning("workflow=%s job_id=%s state=FAILED error=%s", self.name, self.job_id, error_message)
+
+    def time_out(self, error_message):
+        self.state = TaskState.TIMED_OUT
+        self._finish()
+        self.error_message = error_message
+        if logger.isEnabledFor(logging.WARNING):
+            logger.warning("workflow=%s job_id=%s state=TIMED_OUT error=%s", self.name, self.job_id, error_message)
 
     def add_task_result(self, task_result):
-        self.tasks.append(task_result.to_dict())
+        # Serialized together with the workflow in to_dict().
+        self.tasks.append(task_result)
+
+    async def offload_payloads(self):
+        for task_result in self.tasks:
+            if isinstance(task_result, TaskResult):
+                await task_result.offload_payloads()
 
     def to_dict(self):
+        start_time, end_time, duration = self._times()
         return {
             "name": self.name,
             "job_id": self.job_id,
             "state": self.state.name,
-            "start_time": self.start_time.isoformat() if self.start_time else None,
-            "end_time": self.end_time.isoformat() if self.end_time else None,
-            "duration": self.duration.total_seconds() if self.duration else None,
-            "tasks": self.tasks,
+            "start_time": start_time,
+            "end_time": end_time,
+            "duration": duration,
+            "tasks": [task_result.to_dict() for task_result in self.tasks],
             "error_message": self.error_message
         }
 
 class Workflow:
-    def __init__(self, name, workflow_id):
+    def __init__(self, name, workflow_id, durable=False, concurrency=None, stream_buffer=16,
+                 checkpoint=False, retry_budget=None, timeout=None, dispatcher=None, status_interval=None):
         self.name = name
         self.workflow_result = WorkflowResult(name, workflow_id)
         self.tasks = []
+        self.durable = durable
+        self.concurrency = concurrency
+        self.stream_buffer = stream_buffer
+        self.checkpoint = checkpoint
+        # Shared by every task of this run unless a task's policy has its own.
+        self.retry_budget = retry_budget
+        # Seconds for the whole run; tasks get what is left of it.
+        self.timeout = timeout
+        # Runs tasks elsewhere instead of on this loop; see FlowEngine.
+        self.dispatcher = dispatcher
+        self.status_interval = STATUS_INTERVAL if status_interval is None else status_interval
+        self._status_at = None
+        self._status_pending = None
+
+    def add_task(self, task_func, *args, depends_on=None, key=None, **kwargs):
+        # Without depends_on a task consumes the output of the task added
+        # before it; pass depends_on=[] for an independent task.
+        if key is None:
+            key = len(self.tasks)
+        if depends_on is None:
+            depends_on = [self.tasks[-1].key] if self.tasks else []
+        self.tasks.append(TaskNode(key, task_func, args, kwargs, depends_on))
+        return key
+
+    def add_map(self, task_func, items=None, chunk_size=100, concurrency=4, ordered=True, depends_on=None, key=None):
+        # One graph node that runs task_func over every element of `items`,
+        # or of the upstream task's output when items is None; its output
+        # is the list of results. See engine.mapping.
+        from engine.mapping import map_node
+        args = ()
+        if items is not None:
+            if depends_on:
+                raise ValueError("add_map takes items or an upstream task, not both")
+            depends_on, args = [], (items,)
+        return self.add_task(map_node(task_func), *args, depends_on=depends_on, key=key, chunk_size=chunk_size,
+                             concurrency=concurrency, ordered=ordered)
 
-    def add_task(self, task_func, *args):
-        self.tasks.append((task_func, args))
+    async def _update_status(self, progress, final=False):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("workflow=%s job_id=%s progress=%s", self.name, self.workflow_result.job_id, progress)
+        now = time.monotonic()
+        if not final and self._status_at is not None and now - self._status_at < self.status_interval:
+            self._status_pending = progress
+            return
+        self._status_at = now
+        self._status_pending = None
+        try:
+            await persist_workflow_status(self.workflow_result.job_id, progress, self.durable)
+        except Exception as e:
+            logger.error(f"Failed to update workflow status: {e}")
 
     async def run(self):
+        with tracing.start_span(f"workflow {self.name}") as span:
+            await self._run()
+            if span.recording:
+                span.set_attributes({"workflow.name": self.name, "workflow.job_id": self.workflow_result.job_id,
+                                     "workflow.tasks": len(self.tasks),
+                                     "workflow.state": self.workflow_result.state.name})
+                span.set_status(tracing.STATUS_OK if self.workflow_result.state == TaskState.SUCCESS
+                                else tracing.STATUS_ERROR, self.workflow_result.error_message)
+
+    async def _run(self):
+        budget_token = retry.use_budget(self.retry_budget) if self.retry_budget is not None else None
+        deadline_token = deadline.use_deadline(self.timeout) if self.timeout is not None else None
+        job_id = self.workflow_result.job_id
+        job_token = events.use_job(job_id)
+        # Tasks cancelled by the deadline or a failed sibling never reach
+        # on_complete; they are added to the record at the end.
+        cancelled = []
+        cancelled_token = collect_cancelled(cancelled)
         try:
             self.workflow_result.start()
-            await create_workflow_status(self.workflow_result.job_id, "Starting workflow")
             num_tasks = len(self.tasks)
-            previous_result = None
-            for i, (task_func, args) in enumerate(self.tasks):
-                if previous_result is not None:
-                    args = (previous_result, *args)
-                progress = f"{i + 1} of {num_tasks} task. Running"
-                logger.info(f"Progress: {progress}")
-                try:
-                    await update_workflow_status(self.workflow_result.job_id, progress)
-                except Exception as e:
-                    logger.error(f"Failed to update workflow status: {e}")
-                task_result, result = await task_func(*args)
-                progress = f"{i + 1} of {num_tasks} task. Completed"
-                try:
-                    await update_workflow_status(self.workflow_result.job_id, progress)
-                except Exception as e:
-                    logger.error(f"Failed to update workflow status: {e}")
+            events.emit(events.EventType.WORKFLOW_STARTED, job_id=job_id, name=self.name, total=num_tasks)
+            await self._update_status("Starting workflow", final=True)
+            index = {node.key: i for i, node in enumerate(self.tasks)}
+
+            async def on_start(node):
+                await self._update_status(f"{index[node.key] + 1} of {num_tasks} task. Running")
+
+            async def on_complete(node, task_result):
+                await self._update_status(f"{index[node.key] + 1} of {num_tasks} task. Completed")
                 self.workflow_result.add_task_result(task_result)
-                if task_result.state == TaskState.FAILED:
-                    self.workflow_result.fail(task_result.error_message)
-                    break
-                previous_result = result["response"]
-            else:
+                events.emit(events.EventType.WORKFLOW_PROGRESS, job_id=job_id,
+                            completed=len(self.workflow_result.tasks), total=num_tasks, task=task_result.name,
+                            state=task_result.state.name)
+                if self.checkpoint and task_result.state == TaskState.SUCCESS and engine.restorable(node.key):
+                    await save_checkpoint(self.workflow_result.job_id, index[node.key], node, version,
+                                          task_result, self.durable)
+
+            restored = {}
+            if self.checkpoint:
+                # Rerunning a job resumes after the steps it already finished.
+                version = workflow_version(self.name, self.tasks)
+                restored = await load_checkpoints(self.workflow_result.job_id, version, self.tasks)
+                if restored:
+                    logger.info(f"Job {self.workflow_result.job_id}: resuming, {len(restored)} of "
+                                f"{num_tasks} tasks restored from checkpoints")
+            engine = FlowEngine(self.tasks, self.concurrency, on_start, on_complete, self.stream_buffer,
+                                {key: result.output_data for key, result in restored.items()}, self.dispatcher)
+            # The skipped steps stay in the run's record, so a resumed run
+            # does not overwrite the history of the one it resumes.
+            for node in self.tasks:
+                if node.key in engine.completed:
+                    self.workflow_result.add_task_result(restored[node.key])
+            # On timeout wait_for cancels the engine, which cancels every
+            # running task; they record themselves as TIMED_OUT.
+            await asyncio.wait_for(engine.run(), deadline.effective_timeout())
+            left = deadline.remaining()
+            if engine.failed is None:
                 self.workflow_result.complete()
+            elif left is not None and left <= 0:
+                self.workflow_result.time_out(engine.failed[1])
+            else:
+                self.workflow_result.fail(engine.failed[1])
+        except asyncio.TimeoutError:
+            self.workflow_result.time_out(f"Workflow deadline exceeded after {self.timeout}s"
+                                          if self.timeout is not None else "Workflow deadline exceeded")
         except Exception as e:
             self.workflow_result.fail(str(e))
         finally:
+            if deadline_token is not None:
+                deadline.reset_deadline(deadline_token)
+            if budget_token is not None:
+                retry.reset_budget(budget_token)
+            events.reset_job(job_token)
+            reset_cancelled(cancelled_token)
+            for task_result in cancelled:
+                self.workflow_result.add_task_result(task_result)
+            if self._status_pending is not None:
+                await self._update_status(self._status_pending, final=True)
             try:
-                await save_workflow_result(self.workflow_result.to_dict())
+                await persist_workflow_result(self.workflow_result, self.durable)
             except Exception as e:
                 logger.error(f"Failed to save workflow result: {e}")
+            events.emit(events.EventType.WORKFLOW_FINISHED, job_id=job_id, name=self.name,
+                        state=self.workflow_result.state.name, error_message=self.workflow_result.error_message,
+                        duration=self.workflow_result.duration_seconds)
 
-def workflow(name):
+def workflow(name, durable=False, concurrency=None, checkpoint=False, retry_budget=None, timeout=None,
+             dispatcher=None, status_interval=None):
     def decorator(func):
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
             job_id = kwargs.get('job_id')
-            wf = Workflow(name, job_id)
+            wf = Workflow(name, job_id, durable=durable, concurrency=concurrency, checkpoint=checkpoint,
+                          retry_budget=retry_budget, timeout=timeout, dispatcher=dispatcher,
+                          status_interval=status_interval)
             await func(wf, *args, **kwargs)
             await wf.run()
+            return wf.workflow_result
+        wrapper.workflow_name = name
         return wrapper
     return decorator
@@ -0,0 +1,307 @@
+import asyncio
+import itertools
+import json
+import os
+import uuid
+
+from engine import db, tracing
+from engine.rollups import Rollup, rollup_key
+from engine.utils import get_logger
+
+logger = get_logger(__name__)
+
+# Where records that could not be written at shutdown are kept until the
+# next start. Resolved once, so it does not move with the working directory.
+DATA_DIR = os.path.abspath(os.path.expanduser(os.environ.get("ENGINE_DATA_DIR", "~/.engine")))
+SPILL_PATH = os.path.abspath(os.environ.get("ENGINE_SPILL_PATH", os.path.join(DATA_DIR, "write_behind_spill.jsonl")))
+
+
+def _key(record, field):
+    return record[field] if isinstance(record, dict) else getattr(record, field)
+
+
+def _as_dict(record):
+    # TaskResult / WorkflowResult objects are queued as-is and serialized
+    # only here, so a record updated several times is converted once.
+    return record if isinstance(record, dict) else record.to_dict()
+
+
+def _as_is(record):
+    return record
+
+
+class WriteBehindQueue:
+    def __init__(self, max_batch=500, flush_interval=0.2, max_retries=5,
+                 retry_delay=0.5, spill_path=SPILL_PATH):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.spill_path = spill_path
+        # Keyed so that a newer write for the same record replaces the older
+        # one before it ever reaches the database.
+        self._task_results = {}
+        self._statuses = {}
+        self._workflow_results = {}
+        self._checkpoints = {}
+        # Per (task name, window) aggregates of finished calls, merged into
+        # the stored rollups by the backend on flush.
+        self._rollups = {}
+        # (batch id, rollups) of a failed flush. They are sent again as they
+        # were, under the same id, so a backend can tell whether the failed
+        # write was applied after all.
+        self._unacked = None
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._closed = False
+
+    def pending(self):
+        return (len(self._task_results) + len(self._statuses) + len(self._workflow_results)
+                + len(self._checkpoints) + len(self._rollups) + len(self._unacked[1] if self._unacked else ()))
+
+    def start(self):
+        if self._flusher is None:
+            self._recover_spill()
+            self._flusher = self._loop.create_task(self._run())
+
+    def put_task_result(self, record):
+        self._task_results[_key(record, "id")] = record
+        self._notify()
+
+    def put_workflow_status(self, job_id, status):
+        self._statuses[job_id] = status
+        self._notify()
+
+    def put_workflow_result(self, record):
+        self._workflow_results[_key(record, "job_id")] = record
+        self._notify()
+
+    def put_checkpoint(self, record):
+        self._checkpoints[(record["job_id"], record["step"])] = record
+        self._notify()
+
+    def put_outcome(self, task_result):
+        key = rollup_key(task_result)
+        rollup = self._rollups.get(key)
+        if rollup is None:
+            rollup = self._rollups[key] = Rollup(*key)
+        state = task_result.state.name
+        rollup.add(task_result.duration_seconds, state != "SUCCESS", task_result.retries, state == "TIMED_OUT")
+        self._notify()
+
+    def _notify(self):
+        if self._closed:
+            raise RuntimeError("write-behind queue is closed")
+        self.start()
+        if self.pending() >= self.max_batch:
+            self._wakeup.set()
+
+    async def _run(self):
+        tracing.detach()
+        try:
+            while True:
+                # Not wait_for(): it can swallow a cancel that arrives as the
+                # event is set, and close() would then wait forever.
+                timer = self._loop.call_later(self.flush_interval, self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    timer.cancel()
+                self._wakeup.clear()
+                if self.pending():
+                    try:
+                        await self.flush()
+                    except Exception as e:
+                        logger.error(f"Write-behind flush failed, will retry: {e}")
+                        await asyncio.sleep(self.retry_delay)
+        except asyncio.CancelledError:
+            # asyncio.run() cancels leftover tasks on exit and waits for them,
+            # so this is the last chance to persist what is still queued.
+            await self._drain()
+            raise
+
+    async def flush(self):
+        # Everything queued before this call is written once it returns.
+        async with self._flush_lock:
+            while self.pending():
+                task_results, self._task_results = self._task_results, {}
+                statuses, self._statuses = self._statuses, {}
+                workflow_results, self._workflow_results = self._workflow_results, {}
+                checkpoints, self._checkpoints = self._checkpoints, {}
+                if self._unacked is not None:
+                    # Newer rollups wait for the next batch rather than being
+                    # merged into one that may already be applied.
+                    (batch_id, rollups), self._unacked = self._unacked, None
+                else:
+                    batch_id, (rollups, self._rollups) = uuid.uuid4().hex, (self._rollups, {})
+                with tracing.start_span("db.write_batch") as span:
+                    span.set_attributes({"db.task_results": len(task_results), "db.statuses": len(statuses),
+                                         "db.workflow_results": len(workflow_results),
+                                         "db.checkpoints": len(checkpoints), "db.rollups": len(rollups)})
+                    convert = _as_is if db.get_backend().accepts_records else _as_dict
+                    try:
+                        # Large payloads go to the blob store off the loop first.
+                        for record in itertools.chain(task_results.values(), workflow_results.values()):
+                            if not isinstance(record, dict):
+                                await record.offload_payloads()
+                        await db.write_batch([convert(r) for r in task_results.values()], statuses,
+                                             [convert(r) for r in workflow_results.values()],
+                                             list(checkpoints.values()),
+                                             [r.to_dict() for r in rollups.values()], batch_id)
+                    except BaseException:
+                        self._requeue(task_results, statuses, workflow_results, checkpoints, rollups, batch_id)
+                        raise
+
+    def _requeue(self, task_results, statuses, workflow_results, checkpoints, rollups, batch_id):
+        if rollups:
+            self._unacked = (batch_id, rollups)
+        # Anything written while the flush was in flight is newer and wins.
+        for pending, failed in ((self._task_results, task_results),
+                                (self._statuses, statuses),
+                                (self._workflow_results, workflow_results),
+                                (self._checkpoints, checkpoints)):
+            for key, value in failed.items():
+                pending.setdefault(key, value)
+
+    async def _drain(self):
+        for attempt in range(self.max_retries):
+            try:
+                await self.flush()
+                return
+            except Exception as e:
+                logger.error(f"Write-behind drain attempt {attempt + 1} failed: {e}")
+                await asyncio.sleep(self.retry_delay * (attempt + 1))
+        self._spill()
+
+    def _spill(self):
+        if not self.spill_path:
+            logger.error(f"Dropping {self.pending()} unwritten records: no spill_path configured")
+            self._clear()
+            return
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        with open(self.spill_path, "a") as file:
+            for record in self._task_results.values():
+                file.write(json.dumps({"kind": "task_result", "record": _as_dict(record)}, default=str) + "\n")
+            for job_id, status in self._statuses.items():
+                file.write(json.dumps({"kind": "workflow_status", "job_id": job_id, "status": status}) + "\n")
+            for record in self._workflow_results.values():
+                file.write(json.dumps({"kind": "workflow_result", "record": _as_dict(record)}, default=str) + "\n")
+            for record in self._checkpoints.values():
+                file.write(json.dumps({"kind": "checkpoint", "record": record}, default=str) + "\n")
+            for rollup in self._spilled_rollups():
+                file.write(json.dumps({"kind": "rollup", "record": rollup.to_dict()}) + "\n")
+        logger.error(f"Spilled {self.pending()} unwritten records to {self.spill_path}")
+        self._clear()
+
+    def _spilled_rollups(self):
+        # Recovered rollups get a new batch id, so counts from a batch that
+        # failed ambiguously can be applied twice after a restart.
+        rollups = dict(self._rollups)
+        for key, rollup in (self._unacked[1] if self._unacked else {}).items():
+            rollups[key] = rollup.merge(rollups[key]) if key in rollups else rollup
+        return rollups.values()
+
+    def _clear(self):
+        self._task_results, self._statuses, self._workflow_results, self._checkpoints = {}, {}, {}, {}
+        self._rollups = {}
+        self._unacked = None
+
+    def _recover_spill(self):
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        with open(self.spill_path) as file:
+            for line in file:
+                entry = json.loads(line)
+                if entry["kind"] == "task_result":
+                    self._task_results.setdefault(entry["record"]["id"], entry["record"])
+                elif entry["kind"] == "workflow_status":
+                    self._statuses.setdefault(entry["job_id"], entry["status"])
+                elif entry["kind"] == "checkpoint":
+                    record = entry["record"]
+                    self._checkpoints.setdefault((record["job_id"], record["step"]), record)
+                elif entry["kind"] == "rollup":
+                    rollup = Rollup.from_dict(entry["record"])
+                    key = (rollup.task, rollup.window_start)
+                    self._rollups[key] = rollup.merge(self._rollups[key]) if key in self._rollups else rollup
+                else:
+                    self._workflow_results.setdefault(entry["record"]["job_id"], entry["record"])
+        os.remove(self.spill_path)
+        logger.info(f"Recovered {self.pending()} records from {self.spill_path}")
+
+    async def close(self):
+        self._closed = True
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        # A flusher cancelled before it first ran never reaches its drain.
+        if self.pending():
+            await self._drain()
+
+
+_writer = None
+_writer_options = {}
+
+
+def configure_writer(**kwargs):
+    global _writer
+    _writer_options.clear()
+    _writer_options.update(kwargs)
+    _writer = None
+
+
+def get_writer():
+    global _writer
+    if _writer is None or _writer._loop is not asyncio.get_running_loop():
+        _writer = WriteBehindQueue(**_writer_options)
+    return _writer
+
+
+async def persist_task_result(record, durable=False):
+    writer = get_writer()
+    writer.put_task_result(record)
+    if durable:
+        await writer.flush()
+
+
+async def persist_workflow_status(job_id, status, durable=False):
+    writer = get_writer()
+    writer.put_workflow_status(job_id, status)
+    if durable:
+        await writer.flush()
+
+
+async def persist_workflow_result(record, durable=False):
+    writer = get_writer()
+    writer.put_workflow_result(record)
+    if durable:
+        await writer.flush()
+
+
+async def persist_checkpoint(record, durable=False):
+    writer = get_writer()
+    writer.put_checkpoint(record)
+    if durable:
+        await writer.flush()
+
+
+def record_outcome(task_result):
+    # Called once per task call with its final state; no I/O of its own.
+    get_writer().put_outcome(task_result)
+
+
+async def flush():
+    if _writer is not None and _writer._loop is asyncio.get_running_loop():
+        await _writer.flush()
+
+
+async def shutdown():
+    global _writer
+    if _writer is not None and _writer._loop is asyncio.get_running_loop():
+        await _writer.close()
+        _writer = None
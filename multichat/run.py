@@ -1,7 +1,7 @@
 from engine.workflow import workflow
-from engine.utils import get_logger, save_to_node, upload_to_ipfs
+from engine.scheduler import new_job_id
+from engine.utils import get_logger
 import asyncio
-from engine.workflow import workflow
 from chat.run import run as chat_run
 from dotenv import load_dotenv
 
@@ -17,8 +17,16 @@ async def multichat(wf, prompt, job_id):
 
     return wf
 
+@workflow(name="multichat_fanout", concurrency=8)
+async def multichat_fanout(wf, prompts, job_id):
+    logger.info("multichat_fanout")
+    for prompt in prompts:
+        wf.add_task(chat_run, prompt, depends_on=[])
+
+    return wf
+
 def main():
-    asyncio.run(multichat(prompt="hello", job_id="456"))
+    asyncio.run(multichat(prompt="hello", job_id=new_job_id("multichat")))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
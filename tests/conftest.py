@@ -0,0 +1,60 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "engine"), os.path.join(ROOT, "chat")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+os.environ.setdefault("ENGINE_LOG_LEVEL", "WARNING")
+
+from engine import db, writer
+
+from benchmarks.fakes import MemoryBackend
+
+
+@pytest.fixture
+def backend():
+    backend = MemoryBackend()
+    previous = db._backend
+    db.set_backend(backend)
+    yield backend
+    db._backend = previous
+
+
+@pytest.fixture
+def run(backend):
+    # Runs a coroutine in a fresh loop against the in-memory backend and
+    # flushes the write-behind queue before returning its result.
+    def run(coro, timeout=10):
+        async def main():
+            writer.configure_writer(spill_path=None)
+            try:
+                return await asyncio.wait_for(coro, timeout)
+            finally:
+                await writer.shutdown()
+        return asyncio.run(main())
+    return run
+
+
+@pytest.fixture
+def llm_server(run):
+    # with_llm(test, **server_options) runs `await test(server)` with
+    # chat.llm pointed at a FakeOpenAIServer.
+    from chat import llm
+    from benchmarks.fakes import FakeOpenAIServer
+
+    def with_llm(test, **server_options):
+        async def main():
+            server = await FakeOpenAIServer(**server_options).start()
+            llm.configure_client(base_url=server.base_url, api_key="test")
+            try:
+                return await test(server)
+            finally:
+                await llm.close_client()
+                await server.close()
+        return run(main())
+    yield with_llm
+    llm.configure_client()
@@ -0,0 +1,72 @@
+import threading
+import uuid
+
+import pytest
+
+from engine.blobstore import LocalBlobStore, configure_blobstore, is_ref, load
+from engine.retry import NO_RETRY
+from engine.task import task
+from engine.workflow import Workflow
+
+
+class RecordingStore(LocalBlobStore):
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.threads = []
+        self.get_threads = []
+
+    def put(self, data):
+        self.threads.append(threading.current_thread())
+        return super().put(data)
+
+    def get(self, digest):
+        self.get_threads.append(threading.current_thread())
+        return super().get(digest)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = RecordingStore(str(tmp_path))
+    configure_blobstore(store, threshold=1024)
+    yield store
+    configure_blobstore()
+
+
+@task()
+async def render(size):
+    return "x" * size
+
+
+def test_large_payloads_are_stored_off_the_event_loop(run, backend, store):
+    task_result, output = run(render(10_000))
+    record = backend.task_results[task_result.id]
+    assert is_ref(record["output_data"])
+    assert record["output_data"]["size"] == 10_000
+    assert load(record["output_data"]) == output
+    assert record["input_data"] == [10_000]
+    assert store.threads and threading.main_thread() not in store.threads
+
+
+def test_restored_checkpoint_outputs_are_loaded_off_the_event_loop(run, backend, store):
+    failures = []
+
+    @task(retry=NO_RETRY)
+    async def fails_once(text):
+        if not failures:
+            failures.append(text)
+            raise ValueError("first run fails")
+        return len(text)
+
+    job_id = str(uuid.uuid4())
+
+    async def attempt():
+        workflow = Workflow("blob-resume", job_id, checkpoint=True)
+        workflow.add_task(render, 10_000)
+        workflow.add_task(fails_once)
+        await workflow.run()
+        return workflow.workflow_result
+
+    assert run(attempt()).state.name == "FAILED"
+    assert run(attempt()).state.name == "SUCCESS"
+    assert backend.workflow_results[job_id]["tasks"][1]["output_data"] == 10_000
+    assert store.get_threads and threading.main_thread() not in store.get_threads
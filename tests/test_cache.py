@@ -0,0 +1,61 @@
+import threading
+
+from engine.cache import TaskCache
+from engine.task import task
+
+calls = []
+
+
+class RecordingCache(TaskCache):
+    # Notes which thread the disk tier runs on.
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.threads = set()
+
+    def _disk_get(self, key, now):
+        self.threads.add(threading.current_thread().name)
+        return super()._disk_get(key, now)
+
+    def _disk_set(self, key, data):
+        self.threads.add(threading.current_thread().name)
+        return super()._disk_set(key, data)
+
+
+def cached_task(store):
+    @task(cache=store)
+    async def square(value):
+        calls.append(value)
+        return {"square": value * value}
+    return square
+
+
+def test_disk_tier_runs_off_the_event_loop(run, tmp_path):
+    calls.clear()
+    first = RecordingCache(directory=str(tmp_path))
+    second = RecordingCache(directory=str(tmp_path))
+
+    async def main():
+        square = cached_task(first)
+        results = [await square(3), await square(3)]
+        results.append(await cached_task(second)(3))
+        return results
+
+    results = run(main())
+    assert [output for _, output in results] == [{"square": 9}] * 3
+    assert calls == [3]
+    assert [task_result.cache_hits for task_result, _ in results] == [0, 1, 1]
+    assert (first.stats.memory_hits, second.stats.disk_hits) == (1, 1)
+    assert {name.split("_")[0] for name in first.threads | second.threads} == {"engine-cache"}
+
+
+def test_unpicklable_results_are_not_cached(run, tmp_path):
+    store = TaskCache(directory=str(tmp_path))
+
+    @task(cache=store)
+    async def make_lock():
+        return threading.Lock()
+
+    task_result, _ = run(make_lock())
+    assert task_result.state.name == "SUCCESS"
+    assert not store._memory
+    assert not list(tmp_path.iterdir())
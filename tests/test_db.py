@@ -0,0 +1,102 @@
+import asyncio
+
+from engine.db import SurrealBackend, SurrealPool
+from engine.rollups import Rollup
+
+from benchmarks.fakes import FakeSurrealClient, FakeSurrealServer
+
+
+def with_server(test, **pool_options):
+    async def main():
+        server = await FakeSurrealServer().start()
+        pool = SurrealPool(url=server.url, client_factory=FakeSurrealClient, **pool_options)
+        try:
+            return await test(server, pool)
+        finally:
+            await pool.close()
+            await server.close()
+    return asyncio.run(asyncio.wait_for(main(), 10))
+
+
+def select(db):
+    return db.query("SELECT * FROM workflow_results;", {})
+
+
+def test_reconnects_after_the_server_drops_connections():
+    async def test(server, pool):
+        await pool.run(select)
+        server.disconnect()
+        await asyncio.sleep(0.01)
+        await pool.run(select)
+        assert server.connections == 2
+        assert pool.stats()["size"] == 1
+
+    with_server(test)
+
+
+def test_idle_connections_expire():
+    async def test(server, pool):
+        await asyncio.gather(pool.run(select), pool.run(select))
+        assert pool.stats()["idle"] == 2
+        await asyncio.sleep(0.1)
+        await pool.run(select)
+        await asyncio.sleep(0.01)
+        assert pool.metrics.closed_idle == 2
+        assert server.connections == 3
+        assert server.open == 1
+
+    with_server(test, idle_timeout=0.05)
+
+
+def test_callers_wait_for_a_free_connection():
+    async def test(server, pool):
+        server.latency = 0.02
+        await asyncio.gather(*(pool.run(select) for _ in range(5)))
+        assert server.peak_open == 1
+        assert server.connections == 1
+        assert pool.metrics.waits == 4
+        assert pool.metrics.checkouts == 5
+
+    with_server(test, max_size=1)
+
+
+
+def rollup_dict():
+    rollup = Rollup("fetch", 0)
+    rollup.add(0.5, False, 0, False)
+    return rollup.to_dict()
+
+
+def test_replayed_batch_applies_rollups_once():
+    async def test(server, pool):
+        server.drop_after = 1
+        await SurrealBackend(pool).write_batch(statuses={"job": "done"}, rollups=[rollup_dict()])
+        assert len(server.queries) == 2
+        assert pool.metrics.reconnects == 1
+        assert server.rollups == {("fetch", 0): 1}
+
+    with_server(test)
+
+
+def test_a_resent_batch_id_applies_rollups_once():
+    async def test(server, pool):
+        backend = SurrealBackend(pool)
+        await backend.write_batch(rollups=[rollup_dict()], batch_id="b1")
+        await backend.write_batch(rollups=[rollup_dict()], batch_id="b1")
+        await backend.write_batch(rollups=[rollup_dict()], batch_id="b2")
+        assert server.rollups == {("fetch", 0): 2}
+
+    with_server(test)
+
+
+def test_old_batch_ids_are_pruned_at_most_once_per_interval():
+    async def test(server, pool):
+        backend = SurrealBackend(pool, batch_ttl=0.5)
+        for _ in range(3):
+            await backend.write_batch(rollups=[rollup_dict()])
+        await asyncio.sleep(0.06)
+        await backend.write_batch(rollups=[rollup_dict()])
+        pruned = [query for query in server.queries if "DELETE write_batches" in query]
+        assert len(pruned) == 2
+
+    with_server(test)
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import time
+import uuid
+
+import pytest
+
+from engine.distributed import (Coordinator, DispatchError, DistributedWorker, RemoteTaskResult, TaskQueue,
+                                resolve_task, task_path)
+from engine.retry import NO_RETRY
+from engine.task import task
+from engine.workflow import Workflow
+
+
+@task(retry=NO_RETRY)
+async def double(value):
+    return value * 2
+
+
+@task(retry=NO_RETRY)
+async def broken(value):
+    raise ValueError(f"cannot handle {value}")
+
+
+@task(retry=NO_RETRY)
+async def opaque(value):
+    return object()
+
+
+def with_worker(path, test, **worker_options):
+    async def main():
+        coordinator = Coordinator(str(path), lease_ttl=2.0)
+        worker = DistributedWorker(str(path), concurrency=4, **worker_options)
+        serving = asyncio.ensure_future(worker.run())
+        try:
+            return await test(coordinator, worker)
+        finally:
+            worker.stop()
+            await serving
+            await coordinator.close()
+    return main()
+
+
+def test_coordinator_runs_tasks_on_a_worker(run, tmp_path):
+    async def test(coordinator, worker):
+        results = await asyncio.gather(*(coordinator.run(double, i) for i in range(10)))
+        assert [output for _, output in results] == [i * 2 for i in range(10)]
+        task_result, _ = results[3]
+        assert isinstance(task_result, RemoteTaskResult)
+        assert (task_result.name, task_result.state.name) == ("double", "SUCCESS")
+        task_result, output = await coordinator.run(broken, 1)
+        assert (task_result.state.name, task_result.error_message, output) == ("FAILED", "cannot handle 1", None)
+        with pytest.raises(DispatchError, match="not JSON-serializable"):
+            await coordinator.run(opaque, 1)
+        assert (worker.stats.completed, worker.stats.failed) == (11, 1)
+        assert (await coordinator.stats())["tasks"] == {}
+
+    run(with_worker(tmp_path / "dispatch.db", test))
+
+
+def test_dispatched_workflow_is_persisted(run, backend, tmp_path):
+    async def test(coordinator, worker):
+        workflow = Workflow("dispatched", str(uuid.uuid4()), dispatcher=coordinator)
+        workflow.add_task(double, 5)
+        workflow.add_task(double)
+        await workflow.run()
+        return workflow.workflow_result
+
+    workflow_result = run(with_worker(tmp_path / "dispatch.db", test))
+    assert workflow_result.state.name == "SUCCESS"
+    record = backend.workflow_results[workflow_result.job_id]
+    assert [(task["name"], task["output_data"]) for task in record["tasks"]] == [("double", 10), ("double", 20)]
+
+
+def enqueue(queue, count, worker_ttl=10.0):
+    ids = [uuid.uuid4().hex for _ in range(count)]
+    payload = json.dumps({"args": [1], "kwargs": {}})
+    queue.enqueue([(task_id, "test_distributed:double", payload, None) for task_id in ids], worker_ttl)
+    return ids
+
+
+def test_queue_assigns_the_least_loaded_worker(tmp_path):
+    queue = TaskQueue(str(tmp_path / "dispatch.db"))
+    queue.heartbeat("small", 1, [], 10.0)
+    queue.heartbeat("large", 3, [], 10.0)
+    enqueue(queue, 8)
+    small, _ = queue.claim("small", 10, steal_after=60.0, lease_ttl=10.0)
+    large, _ = queue.claim("large", 10, steal_after=60.0, lease_ttl=10.0)
+    assert (len(small), len(large)) == (2, 6)
+    queue.close()
+
+
+def test_queue_steals_tasks_that_waited_too_long(tmp_path):
+    queue = TaskQueue(str(tmp_path / "dispatch.db"))
+    queue.heartbeat("busy", 1, [], 10.0)
+    enqueue(queue, 3)
+    rows, stolen = queue.claim("idle", 10, steal_after=60.0, lease_ttl=10.0)
+    assert (rows, stolen) == ([], 0)
+    time.sleep(0.05)
+    rows, stolen = queue.claim("idle", 2, steal_after=0.01, lease_ttl=10.0)
+    assert (len(rows), stolen) == (2, 2)
+    queue.close()
+
+
+def test_expired_leases_are_redispatched_then_failed(tmp_path):
+    queue = TaskQueue(str(tmp_path / "dispatch.db"))
+    [task_id] = enqueue(queue, 1)
+    for dispatch in (1, 2):
+        [row], _ = queue.claim(f"worker{dispatch}", 1, steal_after=0.0, lease_ttl=0.01)
+        assert row[4] == dispatch
+        time.sleep(0.02)
+        assert queue.expire(max_dispatches=2) == ((1, 0) if dispatch == 1 else (0, 1))
+    # The first worker's late report is fenced off by its dispatch number.
+    queue.complete(task_id, "worker1", 1, "DONE", json.dumps({"output": 2}))
+    [(_, state, result)] = queue.finished([task_id])
+    assert state == "FAILED"
+    assert json.loads(result) == {"error": "Worker lost 2 times"}
+    queue.close()
+
+
+def test_heartbeat_reports_cancelled_tasks(tmp_path):
+    queue = TaskQueue(str(tmp_path / "dispatch.db"))
+    kept, cancelled = enqueue(queue, 2)
+    rows, _ = queue.claim("worker", 2, steal_after=0.0, lease_ttl=10.0)
+    queue.cancel([cancelled])
+    running = [(row[0], row[4]) for row in rows]
+    assert queue.heartbeat("worker", 2, running, 10.0) == [cancelled]
+    queue.complete(cancelled, "worker", 1, None, None)
+    queue.complete(kept, "worker", 1, "DONE", json.dumps({"output": 2}))
+    assert [row[:2] for row in queue.finished([kept, cancelled])] == [(kept, "DONE")]
+    assert queue.stats(10.0)["tasks"] == {}
+    queue.close()
+
+
+def test_only_importable_tasks_can_be_dispatched():
+    @task(retry=NO_RETRY)
+    async def local(value):
+        return value
+
+    assert task_path(double) == f"{__name__}:double"
+    assert resolve_task(task_path(double)) is double
+    with pytest.raises(ValueError, match="module level"):
+        task_path(local)
+
+
+def test_a_leaving_worker_frees_its_queue_and_hands_back_leases(tmp_path):
+    queue = TaskQueue(str(tmp_path / "dispatch.db"))
+    queue.heartbeat("leaving", 4, [], 10.0)
+    ids = enqueue(queue, 2)
+    [row], _ = queue.claim("leaving", 1, steal_after=60.0, lease_ttl=10.0)
+    held = row[0]
+    [queued] = [task_id for task_id in ids if task_id != held]
+    # Tasks assigned to a worker that left are free for anyone at once.
+    queue.leave("leaving")
+    rows, stolen = queue.claim("other", 10, steal_after=60.0, lease_ttl=10.0)
+    assert ([row[0] for row in rows], stolen) == ([queued], 0)
+    # A lease handed back unfinished is queued again for the next claim.
+    queue.complete(held, "leaving", 1, None, None)
+    [row], _ = queue.claim("other", 10, steal_after=60.0, lease_ttl=10.0)
+    assert (row[0], row[4]) == (held, 2)
+    queue.close()
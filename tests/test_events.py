@@ -0,0 +1,150 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+from engine import events
+from engine.events import DISCONNECT, DROP_NEWEST, DROP_OLDEST, Event, EventBus, EventServer, EventType
+from engine.retry import NO_RETRY
+from engine.task import task
+from engine.workflow import Workflow
+
+
+def publish(bus, count, job_id="job"):
+    for i in range(count):
+        bus.publish(Event(EventType.TASK_STARTED, job_id, data={"i": i}))
+
+
+def drain(subscription):
+    events = []
+    while subscription._queue:
+        events.append(subscription._queue.popleft().data["i"])
+    return events
+
+
+@pytest.mark.parametrize("policy, kept, closed", [
+    (DROP_OLDEST, [2, 3, 4], False),
+    (DROP_NEWEST, [0, 1, 2], False),
+    (DISCONNECT, [], True),
+])
+def test_full_queue_policies(policy, kept, closed):
+    bus = EventBus()
+    subscription = bus.subscribe(maxsize=3, policy=policy)
+    publish(bus, 5)
+    assert drain(subscription) == kept
+    assert subscription.closed is closed
+    assert subscription.dropped == (1 if closed else 2)
+    assert bus.subscribers == (0 if closed else 1)
+
+
+def test_subscriptions_filter_by_type_and_job():
+    bus = EventBus()
+    mine = bus.subscribe(types=[EventType.TASK_STARTED], job_id="mine")
+    publish(bus, 2, "mine")
+    publish(bus, 2, "other")
+    bus.publish(Event(EventType.TASK_FAILED, "mine", data={"i": 9}))
+    assert drain(mine) == [0, 1]
+
+
+def test_get_times_out_and_ends_when_closed():
+    async def main():
+        bus = EventBus()
+        subscription = bus.subscribe()
+        assert await subscription.get(timeout=0.01) is None
+        asyncio.get_running_loop().call_later(0.01, subscription.close)
+        return [event async for event in subscription]
+
+    assert asyncio.run(main()) == []
+
+
+def test_snapshots_follow_workflow_events():
+    bus = EventBus(max_snapshots=2)
+    bus.publish(Event(EventType.WORKFLOW_STARTED, "a", data={"name": "etl", "total": 3}))
+    bus.publish(Event(EventType.WORKFLOW_PROGRESS, "a", data={"completed": 2}))
+    bus.publish(Event(EventType.TASK_STARTED, "a", task="load"))
+    snapshot = bus.snapshot("a")
+    assert (snapshot["name"], snapshot["state"], snapshot["completed"], snapshot["total"], snapshot["task"]) == (
+        "etl", "RUNNING", 2, 3, "load")
+    bus.publish(Event(EventType.WORKFLOW_FINISHED, "a", data={"state": "FAILED", "error_message": "boom"}))
+    assert bus.snapshot("a")["state"] == "FAILED"
+    bus.publish(Event(EventType.TASK_STARTED, "b"))
+    bus.publish(Event(EventType.TASK_STARTED, "c"))
+    assert bus.snapshot("a") is None
+
+
+async def read_sse(reader, count):
+    # The first `count` SSE events as (event, data) pairs.
+    received = []
+    event = None
+    while len(received) < count:
+        line = (await reader.readline()).decode().rstrip("\n")
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            received.append((event, json.loads(line[len("data: "):])))
+    return received
+
+
+async def get(server, path):
+    reader, writer = await asyncio.open_connection(server.host, server.port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: test\r\n\r\n".encode())
+    await writer.drain()
+    status = (await reader.readline()).decode()
+    while (await reader.readline()).strip():
+        pass
+    return status, reader, writer
+
+
+def test_server_streams_a_workflow_with_its_snapshot(run):
+    @task(retry=NO_RETRY)
+    async def step():
+        return "ok"
+
+    job_id = str(uuid.uuid4())
+
+    async def main():
+        bus = events.configure_bus()
+        bus.publish(Event(EventType.WORKFLOW_STARTED, job_id, data={"name": "sse", "total": 1}))
+        async with EventServer(bus, port=0) as server:
+            status, reader, writer = await get(server, f"/events?job_id={job_id}&types=workflow.finished")
+            assert status.startswith("HTTP/1.1 200")
+            workflow = Workflow("sse", job_id)
+            workflow.add_task(step)
+            await workflow.run()
+            received = await asyncio.wait_for(read_sse(reader, 2), 5)
+            writer.close()
+            snapshot_status, snapshot_reader, _ = await get(server, f"/snapshots?job_id={job_id}")
+            snapshot = json.loads(await snapshot_reader.read())
+            missing_status, _, _ = await get(server, "/snapshots?job_id=missing")
+            bad_status, _, _ = await get(server, "/events?types=nope")
+        return received, snapshot_status, snapshot, missing_status, bad_status
+
+    try:
+        received, snapshot_status, snapshot, missing_status, bad_status = run(main())
+    finally:
+        events._bus = None
+    (first, snapshot_event), (second, finished) = received
+    assert first == "snapshot" and snapshot_event["name"] == "sse"
+    assert second == "workflow.finished"
+    assert finished["job_id"] == job_id and finished["data"]["state"] == "SUCCESS"
+    assert snapshot_status.startswith("HTTP/1.1 200") and snapshot["state"] == "SUCCESS"
+    assert missing_status.startswith("HTTP/1.1 404")
+    assert bad_status.startswith("HTTP/1.1 400")
+
+
+def test_server_tells_a_slow_client_what_it_dropped(run):
+    async def main():
+        bus = EventBus()
+        async with EventServer(bus, port=0, maxsize=2, policy=DROP_OLDEST) as server:
+            status, reader, writer = await get(server, "/events")
+            while not bus.subscribers:
+                await asyncio.sleep(0.005)
+            publish(bus, 5)
+            received = await asyncio.wait_for(read_sse(reader, 3), 5)
+            writer.close()
+        return received
+
+    (dropped, count), (_, first), (_, second) = run(main())
+    assert dropped == "dropped" and count == {"count": 3}
+    assert (first["data"]["i"], second["data"]["i"]) == (3, 4)
@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+from engine import deadline
+from engine.executors import configure_executors, shutdown_executors
+from engine.retry import NO_RETRY
+from engine.task import TaskState, task
+
+
+@pytest.fixture(autouse=True)
+def executors():
+    # Forked workers already have this module imported, so module-level
+    # tasks unpickle in them without it being importable by name.
+    configure_executors(max_threads=4, max_processes=2, mp_context=multiprocessing.get_context("fork"))
+    yield
+    shutdown_executors()
+
+
+@task(retry=NO_RETRY, executor="thread")
+def on_thread():
+    return threading.current_thread().name
+
+
+@task(retry=NO_RETRY, executor="process")
+def in_process(value):
+    return os.getpid(), value * 2
+
+
+@task(retry=NO_RETRY, executor="process", timeout=0.1)
+def checks_in_process(marker):
+    try:
+        while True:
+            deadline.check()
+            time.sleep(0.01)
+    except deadline.DeadlineExceeded:
+        with open(marker, "w") as file:
+            file.write("stopped")
+        raise
+
+
+def wait_for(condition, timeout=2):
+    stop = time.time() + timeout
+    while not condition() and time.time() < stop:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_thread_mode_runs_off_the_loop(run):
+    task_result, name = run(on_thread())
+    assert task_result.state == TaskState.SUCCESS
+    assert name.startswith("engine-task")
+    assert task_result.run_time is not None
+
+
+def test_process_mode_pickles_the_wrapped_body(run):
+    task_result, (pid, doubled) = run(in_process(21))
+    assert task_result.state == TaskState.SUCCESS
+    assert doubled == 42
+    assert pid != os.getpid()
+
+
+def test_a_closure_cannot_run_in_a_process(run):
+    @task(retry=NO_RETRY, executor="process")
+    def local(value):
+        return value
+
+    task_result, result = run(local(1))
+    assert task_result.state == TaskState.FAILED
+    assert "pickle" in task_result.error_message.lower()
+    assert result is None
+
+
+def test_a_timed_out_thread_body_keeps_running_unless_it_checks(run):
+    ignored_done = threading.Event()
+    checked_stop = threading.Event()
+
+    @task(retry=NO_RETRY, executor="thread", timeout=0.05)
+    def ignores():
+        time.sleep(0.3)
+        ignored_done.set()
+
+    @task(retry=NO_RETRY, executor="thread", timeout=0.05)
+    def checks():
+        try:
+            while True:
+                deadline.check()
+                time.sleep(0.01)
+        except deadline.DeadlineExceeded:
+            checked_stop.set()
+            raise
+
+    task_result, _ = run(ignores())
+    assert task_result.state == TaskState.TIMED_OUT
+    assert not ignored_done.is_set()
+    assert ignored_done.wait(2)
+
+    task_result, _ = run(checks())
+    assert task_result.state == TaskState.TIMED_OUT
+    assert checked_stop.wait(2)
+
+
+def test_a_timed_out_process_body_sees_its_timeout(run, tmp_path):
+    marker = str(tmp_path / "stopped")
+    task_result, _ = run(checks_in_process(marker))
+    assert task_result.state == TaskState.TIMED_OUT
+    assert wait_for(lambda: os.path.exists(marker))
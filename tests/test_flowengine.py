@@ -0,0 +1,116 @@
+import asyncio
+import uuid
+
+import pytest
+
+from engine.flowengine import FlowEngine, TaskNode
+
+from engine.task import TaskState, task
+from engine.workflow import Workflow
+
+
+@task(max_retries=0)
+async def produce(count):
+    for i in range(count):
+        yield i
+
+
+@task(max_retries=0, stream_input=True)
+async def consume(chunks):
+    return sum([chunk async for chunk in chunks])
+
+
+@task(max_retries=0)
+async def independent():
+    await asyncio.sleep(0.01)
+    return "done"
+
+
+def test_stream_consumer_does_not_wait_behind_a_node_without_a_slot(run):
+    # producer fills its channel and blocks until the consumer runs; the
+    # independent node ahead of the consumer waits for the only slot.
+    wf = Workflow("stream", str(uuid.uuid4()), concurrency=1, stream_buffer=2)
+    producer = wf.add_task(produce, 50, depends_on=[])
+    wf.add_task(independent, depends_on=[])
+    wf.add_task(consume, depends_on=[producer])
+    run(wf.run(), timeout=5)
+    assert wf.workflow_result.state == TaskState.SUCCESS
+    outputs = {task_result.name: task_result.output_data for task_result in wf.workflow_result.tasks}
+    assert outputs["consume"] == sum(range(50))
+    assert outputs["independent"] == "done"
+
+
+def test_concurrency_limit_still_applies(run):
+    running = 0
+    peak = 0
+
+    @task(max_retries=0)
+    async def step():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    wf = Workflow("limited", str(uuid.uuid4()), concurrency=2)
+    for _ in range(6):
+        wf.add_task(step, depends_on=[])
+    run(wf.run())
+    assert wf.workflow_result.state == TaskState.SUCCESS
+    assert peak == 2
+
+
+def test_fan_out_runs_in_parallel_and_fan_in_waits_for_all(run):
+    @task(max_retries=0)
+    async def branch(delay):
+        await asyncio.sleep(delay)
+        return delay
+
+    @task(max_retries=0)
+    async def join(*values):
+        return sorted(values)
+
+    wf = Workflow("fan", str(uuid.uuid4()))
+    branches = [wf.add_task(branch, 0.1, depends_on=[]) for _ in range(5)]
+    wf.add_task(join, depends_on=branches)
+    loop_time = []
+
+    async def main():
+        start = asyncio.get_running_loop().time()
+        await wf.run()
+        loop_time.append(asyncio.get_running_loop().time() - start)
+
+    run(main())
+    assert wf.workflow_result.state == TaskState.SUCCESS
+    outputs = {task_result.name: task_result.output_data for task_result in wf.workflow_result.tasks}
+    assert outputs["join"] == [0.1] * 5
+    # Five 0.1s branches side by side, not one after another.
+    assert loop_time[0] < 0.3
+
+
+def test_a_dependency_cycle_is_rejected():
+    first = TaskNode("first", independent, upstream=["second"])
+    second = TaskNode("second", independent, upstream=["first"])
+    with pytest.raises(ValueError, match="cycle"):
+        FlowEngine([first, second])
+
+
+def test_a_failure_cancels_running_siblings(run):
+    @task(max_retries=0)
+    async def fails():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    @task(max_retries=0)
+    async def slow():
+        await asyncio.sleep(5)
+
+    wf = Workflow("failing", str(uuid.uuid4()))
+    wf.add_task(fails, depends_on=[])
+    wf.add_task(slow, depends_on=[])
+    run(wf.run(), timeout=2)
+    assert wf.workflow_result.state == TaskState.FAILED
+    tasks = {task_result.name: task_result for task_result in wf.workflow_result.tasks}
+    assert tasks["fails"].state == TaskState.FAILED
+    assert tasks["slow"].state == TaskState.FAILED
+    assert tasks["slow"].error_message == "Cancelled"
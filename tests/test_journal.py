@@ -0,0 +1,42 @@
+import asyncio
+import uuid
+
+import pytest
+
+from engine import db
+from engine.journal import JournalBackend
+from engine.serializers import msgpack
+from engine.task import task
+from engine.workflow import Workflow
+
+SERIALIZERS = ["json", "binary"] + (["msgpack"] if msgpack is not None else [])
+
+
+@task()
+async def fetch(value):
+    return value * 2
+
+
+@task()
+async def summarize(value):
+    return f"total {value}"
+
+
+@pytest.mark.parametrize("name", SERIALIZERS)
+def test_task_records_are_indexed_by_job(run, tmp_path, name):
+    backend = db.set_backend(JournalBackend(directory=str(tmp_path), serializer=name))
+    job_ids = [str(uuid.uuid4()) for _ in range(2)]
+
+    async def main():
+        for job_id in job_ids:
+            workflow = Workflow("indexed", job_id)
+            workflow.add_task(fetch, 21)
+            workflow.add_task(summarize)
+            await workflow.run()
+
+    run(main())
+    for job_id in job_ids:
+        tasks = [entry["record"] for entry in backend.journal.job_entries(job_id) if entry["kind"] == "task_result"]
+        assert [(record["name"], record["job_id"]) for record in tasks] == [("fetch", job_id), ("summarize", job_id)]
+        assert tasks[1]["output_data"] == "total 42"
+    asyncio.run(backend.close())
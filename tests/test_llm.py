@@ -0,0 +1,110 @@
+import asyncio
+import threading
+
+from chat import llm
+
+
+def test_complete(llm_server):
+    async def test(server):
+        result = await llm.complete("hello there", temperature=0.0)
+        assert result["response"] == "echo: hello there"
+        assert result["usage"] == {"prompt_tokens": 2, "completion_tokens": 3, "total_tokens": 5}
+        [(path, body)] = server.requests
+        assert path == "/v1/chat/completions"
+        assert body["model"] == llm.DEFAULT_MODEL
+        assert body["messages"][0] == {"role": "system", "content": llm.SYSTEM_PROMPT}
+
+    llm_server(test)
+
+
+def test_stream_records_usage_on_the_task(llm_server):
+    async def test(server):
+        task_result, chunks = await llm.chat_stream("one two three")
+        assert "".join(chunks) == "echo: one two three "
+        assert task_result.chunk_count == 4
+        assert task_result.usage == {"prompt_tokens": 3, "completion_tokens": 4, "total_tokens": 7}
+        assert server.requests[0][1]["stream"] is True
+
+    llm_server(test)
+
+
+def test_batcher_maps_results_back_to_prompts(llm_server):
+    async def test(server):
+        batcher = llm.PromptBatcher(max_batch=10, max_wait=0.05, limit=None)
+        prompts = [f"prompt {i}" for i in range(6)]
+        results = await asyncio.gather(*(batcher.submit(prompt) for prompt in prompts))
+        assert [result["response"] for result in results] == [f"echo: {prompt}" for prompt in prompts]
+        [(path, body)] = server.requests
+        assert path == "/v1/completions"
+        assert body["prompt"] == prompts
+        # 12 prompt and 18 completion tokens for the request, split evenly.
+        assert all(result["usage"] == {"prompt_tokens": 2, "completion_tokens": 3, "total_tokens": 5}
+                   and result["batch_size"] == 6 for result in results)
+
+    llm_server(test)
+
+
+def test_batcher_splits_at_max_batch(llm_server):
+    async def test(server):
+        batcher = llm.PromptBatcher(max_batch=4, max_wait=0.05, limit=None)
+        prompts = [f"p{i}" for i in range(10)]
+        results = await asyncio.gather(*(batcher.submit(prompt) for prompt in prompts))
+        assert [result["response"] for result in results] == [f"echo: {prompt}" for prompt in prompts]
+        assert sorted(len(body["prompt"]) for _, body in server.requests) == [2, 4, 4]
+
+    llm_server(test)
+
+
+def test_batcher_fails_every_prompt_of_a_failed_request(llm_server):
+    async def test(server):
+        batcher = llm.PromptBatcher(max_batch=10, max_wait=0.01, limit=None)
+        results = await asyncio.gather(batcher.submit("a"), batcher.submit("b"), return_exceptions=True)
+        assert [type(result) for result in results] == [llm.openai.RateLimitError] * 2
+        assert len(server.requests) == 1
+
+    llm_server(test, overload=1)
+
+
+def test_batcher_splits_usage_into_whole_tokens(llm_server):
+    async def test(server):
+        batcher = llm.PromptBatcher(max_batch=10, max_wait=0.05, limit=None)
+        prompts = ["a", "b c", "d e f", "g"]
+        results = await asyncio.gather(*(batcher.submit(prompt) for prompt in prompts))
+        # 7 prompt and 11 completion tokens over four prompts; the first
+        # prompt takes the remainder.
+        assert [result["usage"] for result in results] == [
+            {"prompt_tokens": 4, "completion_tokens": 5, "total_tokens": 9},
+            {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+            {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+            {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+        ]
+
+    llm_server(test)
+
+
+def test_each_event_loop_gets_its_own_client():
+    async def clients():
+        return llm.get_client(), llm.get_client()
+
+    llm.configure_client(api_key="test")
+    try:
+        first, again = asyncio.run(clients())
+        assert first is again
+        second, _ = asyncio.run(clients())
+        assert second is not first
+        # The first loop has closed, so its client is not kept around.
+        assert list(llm._clients.values()) == [second]
+
+        # A loop in another thread does not take the running loop's client.
+        async def alongside():
+            mine = llm.get_client()
+            other = []
+            thread = threading.Thread(target=lambda: other.extend(asyncio.run(clients())))
+            thread.start()
+            thread.join()
+            return mine, other[0], llm.get_client()
+
+        mine, other, still = asyncio.run(alongside())
+        assert other is not mine and still is mine
+    finally:
+        llm.configure_client()
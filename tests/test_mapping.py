@@ -0,0 +1,121 @@
+import asyncio
+import uuid
+
+import pytest
+
+from engine.mapping import MapError
+from engine.retry import NO_RETRY, RetryPolicy
+from engine.task import TaskState, task
+from engine.workflow import Workflow
+
+
+def test_chunks_are_persisted_as_one_record_each(run, backend):
+    @task(retry=NO_RETRY)
+    async def double(value):
+        return value * 2
+
+    async def main():
+        mapped = double.map(range(10), chunk_size=4)
+        return await mapped, mapped
+
+    results, mapped = run(main())
+    assert results == [value * 2 for value in range(10)]
+    assert (mapped.count, mapped.chunks) == (10, 3)
+    records = [record for record in backend.task_results.values() if record["name"] == "double.map"]
+    assert sorted(len(record["output_data"]) for record in records) == [2, 4, 4]
+    [rollup] = [rollup for rollup in backend.rollups.values() if rollup.task == "double.map"]
+    assert rollup.count == 3
+
+
+def test_only_failed_elements_are_retried(run, backend):
+    calls = {}
+
+    @task(retry=RetryPolicy.fixed(3, 0))
+    async def flaky(value):
+        calls[value] = calls.get(value, 0) + 1
+        if value % 3 == 0 and calls[value] < 3:
+            raise ValueError(f"flaky {value}")
+        return value
+
+    async def main():
+        mapped = flaky.map(range(6), chunk_size=6)
+        return await mapped, mapped
+
+    results, mapped = run(main())
+    assert results == list(range(6))
+    assert calls == {0: 3, 1: 1, 2: 1, 3: 3, 4: 1, 5: 1}
+    assert mapped.retries == 4
+    [record] = [record for record in backend.task_results.values() if record["name"] == "flaky.map"]
+    assert (record["state"], record["retries"]) == ("SUCCESS", 4)
+
+
+@task(retry=NO_RETRY)
+async def checked(value):
+    if value in (2, 7):
+        raise ValueError(f"bad {value}")
+    return value
+
+
+def test_failed_elements_raise_a_map_error_with_the_other_results(run, backend):
+    with pytest.raises(MapError) as raised:
+        run(checked.map(range(10), chunk_size=3))
+    assert set(raised.value.errors) == {2, 7}
+    assert str(raised.value).startswith("2 elements failed; element 2: ValueError: bad 2")
+    assert raised.value.results == [0, 1, None, 3, 4, 5, 6, None, 8, 9]
+    states = sorted(record["state"] for record in backend.task_results.values() if record["name"] == "checked.map")
+    assert states == ["FAILED", "FAILED", "SUCCESS", "SUCCESS"]
+
+
+def test_return_exceptions_keeps_them_in_place(run):
+    results = run(checked.map(range(4), return_exceptions=True))
+    assert results[:2] == [0, 1] and results[3] == 3
+    assert isinstance(results[2], ValueError)
+
+
+def test_ordered_and_unordered_streaming(run):
+    @task(retry=NO_RETRY)
+    async def slow_first(value):
+        # The first chunk finishes last.
+        await asyncio.sleep(0.1 if value < 2 else 0.0)
+        return value
+
+    async def collect(ordered):
+        return [index async for index, _ in slow_first.map(range(6), chunk_size=2, concurrency=3,
+                                                            ordered=ordered)]
+
+    assert run(collect(True)) == [0, 1, 2, 3, 4, 5]
+    unordered = run(collect(False))
+    assert sorted(unordered) == [0, 1, 2, 3, 4, 5]
+    assert unordered[-2:] == [0, 1]
+
+
+def test_concurrency_bounds_chunks_in_flight(run):
+    running = 0
+    peak = 0
+
+    @task(retry=NO_RETRY)
+    async def tracked(value):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return value
+
+    assert run(tracked.map(range(20), chunk_size=2, concurrency=3)) == list(range(20))
+    assert peak == 3
+
+
+def test_add_map_node_summarises_the_map(run):
+    @task(retry=NO_RETRY)
+    async def square(value):
+        return value * value
+
+    wf = Workflow("mapped", str(uuid.uuid4()))
+    wf.add_map(square, list(range(5)), chunk_size=2)
+    run(wf.run())
+    assert wf.workflow_result.state == TaskState.SUCCESS
+    [summary] = wf.workflow_result.tasks
+    assert summary.name == "square.map"
+    assert summary.output_data == [0, 1, 4, 9, 16]
+    assert summary.input_data == {"items": 5, "chunks": 3}
@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+from chat import llm
+from engine import ratelimit
+from engine.ratelimit import configure_limit
+from engine.retry import retry_after
+
+
+@pytest.fixture
+def pools():
+    saved = dict(ratelimit._pools)
+    yield
+    ratelimit._pools.clear()
+    ratelimit._pools.update(saved)
+
+
+async def limited(pool, prompt):
+    async with pool.slot() as lease:
+        result = await llm.complete(prompt)
+        lease.report_tokens(result["usage"]["total_tokens"])
+        return result
+
+
+def test_overload_halves_concurrency_and_successes_grow_it(llm_server, pools):
+    async def test(server):
+        pool = configure_limit("mock", max_concurrency=8)
+        with pytest.raises(llm.openai.RateLimitError) as raised:
+            await limited(pool, "first")
+        assert retry_after(raised.value) == 0.5
+        assert pool.concurrency.limit == 4
+        assert pool.snapshot()["overloads"] == 1
+
+        server.latency = 0.02
+        await asyncio.gather(*(limited(pool, f"prompt {i}") for i in range(12)))
+        # Additive increase: about one more slot per limit's worth of successes.
+        assert server.peak_in_flight <= 5
+        assert 4 < pool.concurrency.limit < 8
+        assert pool.snapshot()["in_flight"] == 0
+
+    llm_server(test, overload=1, retry_after=0.5)
+
+
+def test_concurrency_never_drops_below_the_minimum(llm_server, pools):
+    async def test(server):
+        pool = configure_limit("mock", max_concurrency=4, min_concurrency=2)
+        for _ in range(5):
+            with pytest.raises(llm.openai.RateLimitError):
+                await limited(pool, "busy")
+            # Decreases happen at most once per latency window.
+            await asyncio.sleep(0.01)
+        assert pool.concurrency.limit == 2
+        assert pool.stats.errors == pool.stats.overloads == 5
+
+    llm_server(test, overload=5)
+
+
+def test_token_estimates_are_settled_with_reported_usage(llm_server, pools):
+    async def test(server):
+        # estimate_tokens() puts each prompt at 5012 of the 6000 tokens a
+        # minute; the server reports 3. Without settling the second call
+        # would wait about 40s for the bucket to refill.
+        configure_limit("openai", tokens_per_minute=6000, max_concurrency=4)
+        first, _ = await llm.chat("x" * 18000)
+        second, _ = await llm.chat("y" * 18000)
+        assert first.usage["total_tokens"] == second.usage["total_tokens"] == 3
+        assert second.queue_wait < 1.0
+
+    llm_server(test)
+
+
+async def call_with(pool, error=None, pause=0.0):
+    try:
+        async with pool.slot():
+            if pause:
+                await asyncio.sleep(pause)
+            if error is not None:
+                raise error
+    except BaseException as e:
+        if e is not error:
+            raise
+    # Decreases happen at most once per latency window.
+    await asyncio.sleep(0.01)
+
+
+def test_timeouts_lower_the_limit(run, pools):
+    async def main():
+        pool = configure_limit("mock", max_concurrency=16)
+        for _ in range(3):
+            await call_with(pool, asyncio.TimeoutError())
+        return pool
+
+    pool = run(main())
+    assert pool.concurrency.limit == 2
+    assert pool.stats.overloads == 3
+
+
+def test_only_successes_raise_the_limit(run, pools):
+    class ServerError(Exception):
+        status_code = 502
+
+    class BadRequest(Exception):
+        status_code = 400
+
+    async def main():
+        pool = configure_limit("mock", max_concurrency=16, initial_concurrency=4)
+        await call_with(pool, BadRequest())
+        assert pool.concurrency.limit == 4
+        await call_with(pool, ServerError())
+        assert pool.concurrency.limit == 2
+        call = asyncio.ensure_future(call_with(pool, pause=1.0))
+        await asyncio.sleep(0.01)
+        call.cancel()
+        await asyncio.gather(call, return_exceptions=True)
+        assert pool.concurrency.limit == 2
+        await call_with(pool)
+        assert pool.concurrency.limit == 2.5
+        assert pool.concurrency.in_flight == 0
+
+    run(main())
+
+
+def test_failed_acquire_leaves_the_limit(run, pools):
+    async def main():
+        pool = configure_limit("mock", tokens_per_minute=60, max_concurrency=4, initial_concurrency=2)
+        # Larger than what is left in the bucket, so the slot waits for tokens.
+        async with pool.slot(60):
+            pass
+        waiting = asyncio.ensure_future(pool.slot(30).__aenter__())
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        return pool
+
+    pool = run(main())
+    assert pool.concurrency.limit == 2.5
+    assert pool.concurrency.in_flight == 0
@@ -0,0 +1,91 @@
+import random
+import time
+from email.utils import formatdate
+
+from engine import retry
+from engine.retry import RetryBudget, RetryPolicy, retry_after
+from engine.task import TaskState, task
+
+
+class RateLimited(Exception):
+    def __init__(self, headers=None, retry_after=None):
+        super().__init__("rate limited")
+        self.response = type("Response", (), {"headers": headers or {}})()
+        if retry_after is not None:
+            self.retry_after = retry_after
+
+
+def test_full_jitter_stays_within_the_capped_window(monkeypatch):
+    monkeypatch.setattr(retry, "random", random.Random(1234))
+    policy = RetryPolicy(max_attempts=10, base_delay=0.5, max_delay=4.0)
+    for attempt, ceiling in [(1, 0.5), (2, 1.0), (3, 2.0), (4, 4.0), (8, 4.0)]:
+        delays = [policy.backoff(attempt) for _ in range(200)]
+        assert all(0 <= delay <= ceiling for delay in delays)
+        # Spread over the whole window, not bunched at its top.
+        assert min(delays) < ceiling * 0.1 and max(delays) > ceiling * 0.9
+
+
+def test_without_jitter_backoff_is_exponential():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0, jitter=False)
+    assert [policy.backoff(attempt) for attempt in range(1, 5)] == [1.0, 2.0, 4.0, 5.0]
+
+
+def test_retry_after_is_read_from_the_error_or_its_response():
+    assert retry_after(RateLimited(retry_after=3)) == 3.0
+    assert retry_after(RateLimited({"retry-after": "7"})) == 7.0
+    assert retry_after(RateLimited({"Retry-After": "-2"})) == 0.0
+    date = formatdate(time.time() + 30, usegmt=True)
+    assert 25 < retry_after(RateLimited({"retry-after": date})) <= 30
+    assert retry_after(RateLimited({"retry-after": "soon"})) is None
+    assert retry_after(ValueError()) is None
+
+
+def test_retry_after_only_lengthens_the_delay():
+    policy = RetryPolicy(max_attempts=3, base_delay=1.0, jitter=False)
+    assert policy.next_delay(RateLimited({"retry-after": "10"}), 1, 0) == 10.0
+    assert policy.next_delay(RateLimited({"retry-after": "0.1"}), 1, 0) == 1.0
+    ignoring = RetryPolicy(max_attempts=3, base_delay=1.0, jitter=False, respect_retry_after=False)
+    assert ignoring.next_delay(RateLimited({"retry-after": "10"}), 1, 0) == 1.0
+    # A hint past the total time allowed ends the retries.
+    bounded = RetryPolicy(max_attempts=3, base_delay=1.0, jitter=False, max_total_time=5)
+    assert bounded.next_delay(RateLimited({"retry-after": "10"}), 1, 0) is None
+
+
+def test_an_empty_budget_refuses_retries():
+    budget = RetryBudget(capacity=2, refill_rate=0.0)
+    policy = RetryPolicy(max_attempts=10, base_delay=0.0, jitter=False, budget=budget)
+    delays = [policy.next_delay(ValueError(), attempt, 0) for attempt in range(1, 5)]
+    assert delays == [0.0, 0.0, None, None]
+    assert budget.exhausted == 2
+
+
+def test_budget_refills_over_time(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(retry.time, "monotonic", lambda: now[0])
+    budget = RetryBudget(capacity=1, refill_rate=2.0)
+    assert budget.try_acquire()
+    assert not budget.try_acquire()
+    now[0] += 0.5
+    assert budget.try_acquire()
+    assert not budget.try_acquire()
+
+
+def test_workflow_budget_stops_task_retries(run):
+    calls = 0
+
+    @task(retry=RetryPolicy(max_attempts=5, base_delay=0.0, jitter=False))
+    async def flaky():
+        nonlocal calls
+        calls += 1
+        raise ValueError("down")
+
+    async def main():
+        token = retry.use_budget(RetryBudget(capacity=1, refill_rate=0.0))
+        try:
+            return await flaky()
+        finally:
+            retry.reset_budget(token)
+
+    task_result, _ = run(main())
+    assert task_result.state == TaskState.FAILED
+    assert calls == 2
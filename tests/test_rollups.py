@@ -0,0 +1,69 @@
+import random
+import time
+
+import pytest
+
+from engine import query
+from engine.rollups import GROWTH, MIN_DURATION, WINDOW, Rollup, bucket_index, bucket_value, percentile, summarize
+
+
+def test_bucket_value_is_within_half_a_bucket_of_the_duration():
+    for duration in (0.001, 0.0234, 0.5, 1.0, 17.3, 600.0):
+        value = bucket_value(bucket_index(duration))
+        assert GROWTH ** -0.5 <= value / duration <= GROWTH ** 0.5
+    assert bucket_value(bucket_index(MIN_DURATION / 2)) == MIN_DURATION
+
+
+def test_percentiles_from_buckets_match_exact_ones():
+    rng = random.Random(7)
+    durations = [rng.lognormvariate(-2, 1) for _ in range(5000)]
+    rollup = Rollup("fetch", 0)
+    for duration in durations:
+        rollup.add(duration, False, 0)
+    ordered = sorted(durations)
+    for q in (50, 90, 95, 99):
+        exact = ordered[int(q / 100 * len(ordered)) - 1]
+        assert percentile(rollup.buckets, q) == pytest.approx(exact, rel=GROWTH - 1)
+
+
+def test_percentile_of_nothing_is_none():
+    assert percentile({}, 50) is None
+
+
+def test_summarize_merges_windows_and_dicts():
+    first = Rollup("fetch", 0)
+    for duration in (0.1, 0.1, 0.1):
+        first.add(duration, False, 0)
+    second = Rollup("fetch", WINDOW)
+    second.add(1.0, True, 2, timed_out=True)
+    untimed = Rollup("fetch", 2 * WINDOW)
+    untimed.add(None, True, 0)
+    other = Rollup("store", 0)
+    other.add(0.5, False, 1)
+
+    stats = summarize([first, second.to_dict(), untimed, other], percentiles=(50, 99))
+    fetch = stats["fetch"]
+    assert (fetch["count"], fetch["failures"], fetch["timeouts"], fetch["retries"]) == (5, 2, 1, 2)
+    assert fetch["failure_rate"] == 0.4
+    assert fetch["timeout_rate"] == 0.2
+    # Calls without a duration count but are left out of the timings.
+    assert fetch["mean_duration"] == pytest.approx(1.3 / 4)
+    assert fetch["p50"] == pytest.approx(0.1, rel=GROWTH - 1)
+    assert fetch["p99"] == pytest.approx(1.0, rel=GROWTH - 1)
+    assert stats["store"]["count"] == 1
+
+
+def test_task_stats_reads_whole_windows(run, backend):
+    now = time.time()
+    current = int(now // WINDOW * WINDOW)
+    for start, duration in ((current - 10 * WINDOW, 5.0), (current - WINDOW, 0.2), (current, 0.4)):
+        rollup = Rollup("fetch", start)
+        rollup.add(duration, False, 0)
+        backend.rollups[("fetch", start)] = rollup
+
+    recent = run(query.task_stats("fetch", since=query.last(WINDOW), percentiles=(50, 100)))["fetch"]
+    assert recent["count"] == 2
+    assert recent["p100"] == pytest.approx(0.4, rel=GROWTH - 1)
+    everything = run(query.task_stats())["fetch"]
+    assert everything["count"] == 3
+    assert everything["p99"] == pytest.approx(5.0, rel=GROWTH - 1)
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import time
+
+from engine.scheduler import Interval, Scheduler
+from engine.worker import Worker
+from engine.workflow import workflow
+
+runs = []
+
+
+@workflow("tick")
+async def tick(wf, job_id=None):
+    runs.append(job_id)
+
+
+def test_interval_grid_is_anchored_at_start_at():
+    interval = Interval(10, start_at=100.0)
+    assert interval.next_after(50.0) == 100.0
+    assert interval.next_after(100.0) == 110.0
+    assert interval.next_after(125.0) == 130.0
+
+
+def test_restart_catches_up_runs_missed_while_down(run, tmp_path):
+    state_path = tmp_path / "state.json"
+    last_run = time.time() - 100.5
+    state_path.write_text(json.dumps({"tick": last_run}))
+    runs.clear()
+    scheduler = Scheduler(state_path=str(state_path), misfire_grace=1.0)
+    schedule = scheduler.add(tick, every=10, catch_up="all", overlap=True)
+
+    async def main():
+        running = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(0.2)
+        scheduler.stop()
+        await running
+
+    run(main())
+    # Ten occurrences since the last run; all but the newest are past the grace.
+    assert schedule.runs == 10
+    assert schedule.missed == 9
+    assert len(runs) == 10
+    assert schedule.last_run == last_run + 100
+    assert json.loads(state_path.read_text())["tick"] == schedule.last_run
+
+
+@workflow("nap")
+async def nap(wf, job_id=None, seconds=0.0):
+    await asyncio.sleep(seconds)
+
+
+def test_jobs_submitted_elsewhere_do_not_end_a_scheduled_run(run):
+    worker = Worker()
+    worker.register(nap)
+    scheduler = Scheduler(worker, run_worker=True)
+    schedule = scheduler.add(nap, every=0.05, kwargs={"seconds": 0.5}, start_at=time.time())
+
+    async def main():
+        running = asyncio.ensure_future(scheduler.run())
+        while not schedule.runs:
+            await asyncio.sleep(0.005)
+        # Same workflow, submitted directly: it ends while the scheduled
+        # run is still going, and must not free the schedule's overlap slot.
+        await worker.submit("nap", "direct", seconds=0.01)
+        await asyncio.sleep(0.3)
+        scheduler.stop()
+        await running
+
+    run(main())
+    assert schedule.runs == 1
+    assert schedule.skipped >= 3
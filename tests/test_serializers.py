@@ -0,0 +1,60 @@
+import asyncio
+import uuid
+
+import pytest
+
+from engine.blobstore import configure_blobstore
+from engine.distributed import RemoteTaskResult
+from engine.journal import JournalBackend
+from engine.serializers import decode, get_serializer, msgpack
+from engine.task import TaskResult
+from engine.workflow import WorkflowResult
+
+SERIALIZERS = ["json", "binary"] + (["msgpack"] if msgpack is not None else [])
+
+
+@pytest.fixture(autouse=True)
+def inline_payloads():
+    configure_blobstore(threshold=None)
+
+
+def dispatched_workflow():
+    # A run whose first task ran here and whose second was dispatched to a
+    # worker, which only sent back its record.
+    workflow_result = WorkflowResult("wf", str(uuid.uuid4()))
+    workflow_result.start()
+    local = TaskResult("local")
+    local.start((1,))
+    local.complete({"response": "here"})
+    remote = TaskResult("remote")
+    remote.start(("here",))
+    remote.complete({"response": "there"})
+    workflow_result.add_task_result(local)
+    workflow_result.add_task_result(RemoteTaskResult(remote.to_dict(), {"response": "there"}))
+    workflow_result.complete()
+    return workflow_result, remote.to_dict()
+
+
+@pytest.mark.parametrize("name", SERIALIZERS)
+def test_dispatched_workflow_result_round_trips(name):
+    workflow_result, remote = dispatched_workflow()
+    decoded = decode(get_serializer(name).dumps(workflow_result))
+    assert [task["name"] for task in decoded["tasks"]] == ["local", "remote"]
+    assert decoded["tasks"][1] == remote
+    assert decoded["tasks"][0]["output_data"] == {"response": "here"}
+
+
+@pytest.mark.parametrize("name", SERIALIZERS)
+def test_journal_backend_keeps_dispatched_task_records(name, tmp_path):
+    workflow_result, remote = dispatched_workflow()
+
+    async def main():
+        backend = JournalBackend(directory=str(tmp_path), serializer=name)
+        records = [workflow_result] if backend.accepts_records else [workflow_result.to_dict()]
+        await backend.write_batch(workflow_results=records)
+        run = await backend.get_run(workflow_result.job_id)
+        await backend.close()
+        return run
+
+    run = asyncio.run(main())
+    assert run["tasks"][1] == remote
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from engine.rollups import Rollup
+from engine.sqlite_store import SQLiteBackend
+
+
+def with_store(test, path, **options):
+    async def main():
+        store = SQLiteBackend(str(path), **options)
+        try:
+            return await test(store)
+        finally:
+            await store.close()
+    return asyncio.run(main())
+
+
+def run_record(job_id, name, state, start_time, error_message=None):
+    return {"job_id": job_id, "name": name, "state": state, "start_time": start_time, "end_time": start_time,
+            "duration": 1.0, "error_message": error_message, "tasks": [{"id": f"{job_id}-t", "name": "step"}]}
+
+
+def test_the_store_uses_wal(tmp_path):
+    async def test(store):
+        await store.write_batch(statuses={"job": "RUNNING"})
+        return await store.query("PRAGMA journal_mode")
+
+    assert with_store(test, tmp_path / "engine.db") == [("wal",)]
+
+
+def test_a_failing_batch_writes_nothing(tmp_path):
+    async def test(store):
+        with pytest.raises(KeyError):
+            # The checkpoint has no step, so the batch fails after the
+            # task result and status were inserted.
+            await store.write_batch(task_results=[{"id": "a", "name": "fetch"}], statuses={"job": "RUNNING"},
+                                    checkpoints=[{"job_id": "job"}])
+        return (await store.query("SELECT count(*) FROM task_results"),
+                await store.query("SELECT count(*) FROM workflow_status"))
+
+    assert with_store(test, tmp_path / "engine.db") == ([(0,)], [(0,)])
+
+
+@pytest.mark.parametrize("serializer", [None, "msgpack"])
+def test_records_round_trip(tmp_path, serializer):
+    if serializer:
+        pytest.importorskip(serializer)
+    rollup = Rollup("fetch", 60)
+    rollup.add(0.2, False, 1)
+    rollup.add(2.0, True, 0, timed_out=True)
+    checkpoint = {"job_id": "job", "step": 0, "output": {"value": [1, 2]}}
+
+    async def test(store):
+        await store.write_batch(task_results=[{"id": "a", "name": "fetch", "state": "SUCCESS", "output_data": 3}],
+                                statuses={"job": "COMPLETED"},
+                                workflow_results=[run_record("job", "flow", "SUCCESS", "2026-01-01T00:00:00")],
+                                checkpoints=[checkpoint], rollups=[rollup.to_dict()])
+        await store.write_batch(rollups=[rollup.to_dict()])
+        return (await store.get_run("job"), await store.load_checkpoints("job"), await store.load_rollups("fetch"),
+                await store.get_run("missing"))
+
+    run, checkpoints, rollups, missing = with_store(test, tmp_path / "engine.db", serializer=serializer)
+    assert run["status"] == "COMPLETED"
+    assert run["tasks"] == [{"id": "job-t", "name": "step"}]
+    assert checkpoints == [checkpoint]
+    # Rollups written twice for the same window are added together.
+    [stored] = rollups
+    doubled = Rollup.from_dict(rollup.to_dict()).merge(rollup)
+    assert stored == doubled.to_dict()
+    assert missing is None
+
+
+def test_list_runs_filters_and_orders(tmp_path):
+    records = [run_record("a", "etl", "SUCCESS", "2026-01-01T00:00:00"),
+               run_record("b", "etl", "FAILED", "2026-01-02T00:00:00", "boom"),
+               run_record("c", "report", "SUCCESS", "2026-01-03T00:00:00"),
+               run_record("d", "etl", "SUCCESS", "2026-01-04T00:00:00")]
+
+    async def test(store):
+        await store.write_batch(workflow_results=records)
+        return {
+            "all": await store.list_runs(),
+            "name": await store.list_runs(name="etl"),
+            "state": await store.list_runs(state="FAILED"),
+            "window": await store.list_runs(since="2026-01-02T00:00:00", until="2026-01-04T00:00:00"),
+            "limit": await store.list_runs(name="etl", limit=2),
+        }
+
+    found = with_store(test, tmp_path / "engine.db")
+    ids = {key: [run["job_id"] for run in runs] for key, runs in found.items()}
+    assert ids == {"all": ["d", "c", "b", "a"], "name": ["d", "b", "a"], "state": ["b"], "window": ["c", "b"],
+                   "limit": ["d", "b"]}
+    assert found["state"][0]["error_message"] == "boom"
+    assert "tasks" not in found["all"][0]
@@ -0,0 +1,101 @@
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+
+from engine.retry import RetryPolicy
+from engine.task import TaskResult, TaskState, TimedRecord, task
+
+
+def test_timeout_raised_by_the_body_is_an_ordinary_failure(run, backend):
+    calls = 0
+
+    @task(retry=RetryPolicy.fixed(2, 0))
+    async def waits():
+        nonlocal calls
+        calls += 1
+        await asyncio.wait_for(asyncio.sleep(1), 0.001)
+
+    task_result, result = run(waits())
+    assert task_result.state == TaskState.FAILED
+    assert task_result.error_message == "TimeoutError"
+    assert calls == 2
+    assert backend.task_results[task_result.id]["state"] == "FAILED"
+
+
+def test_task_timeout_is_timed_out(run):
+    @task(max_retries=0, timeout=0.01)
+    async def slow():
+        await asyncio.sleep(1)
+
+    task_result, _ = run(slow())
+    assert task_result.state == TaskState.TIMED_OUT
+    assert task_result.error_message.startswith("Timed out after")
+
+
+def test_coalesced_calls_each_get_a_record(run, backend):
+    calls = 0
+
+    @task(single_flight=True)
+    async def lookup(value):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return value * 2
+
+    async def main():
+        return await asyncio.gather(*(lookup(21) for _ in range(5)))
+
+    results = run(main())
+    assert calls == 1
+    assert [output for _, output in results] == [42] * 5
+    records = [backend.task_results[task_result.id] for task_result, _ in results]
+    assert [record["state"] for record in records] == ["SUCCESS"] * 5
+    assert sorted(record["coalesced"] for record in records) == [False] + [True] * 4
+    [rollup] = [rollup for rollup in backend.rollups.values() if rollup.task == "lookup"]
+    assert (rollup.count, rollup.failures) == (5, 0)
+
+
+def test_coalesced_calls_keep_a_timed_out_state(run, backend):
+    @task(single_flight=True, max_retries=1, timeout=0.02)
+    async def stuck(value):
+        await asyncio.sleep(1)
+
+    async def main():
+        return await asyncio.gather(*(stuck(1) for _ in range(3)))
+
+    results = run(main())
+    assert [task_result.state for task_result, _ in results] == [TaskState.TIMED_OUT] * 3
+    assert [backend.task_results[task_result.id]["state"] for task_result, _ in results] == ["TIMED_OUT"] * 3
+    [rollup] = [rollup for rollup in backend.rollups.values() if rollup.task == "stuck"]
+    assert (rollup.count, rollup.timeouts) == (3, 3)
+
+
+def test_task_result_layout_and_record_shape():
+    # Records are built on every call and persisted as to_dict(); a new
+    # field must be added to __slots__ and to the stored shape on purpose.
+    assert TimedRecord.__slots__ == ("state", "started_at_ns", "start_ns", "end_ns")
+    assert TaskResult.__slots__ == ("name", "id", "job_id", "input_data", "output_data", "error_message", "retries",
+                                    "queue_wait", "run_time", "cache_hits", "cache_misses",
+                                    "first_chunk_time", "chunk_count", "coalesced", "usage", "_refs")
+    task_result = TaskResult("fetch", id="abc")
+    assert not hasattr(task_result, "__dict__")
+    with pytest.raises(AttributeError):
+        task_result.unknown = 1
+
+    pending = task_result.to_dict()
+    assert list(pending) == ["name", "id", "job_id", "state", "start_time", "end_time", "duration", "input_data",
+                             "output_data", "error_message", "retries", "queue_wait", "run_time", "cache_hits",
+                             "cache_misses", "first_chunk_time", "chunk_count", "coalesced", "usage"]
+    assert (pending["state"], pending["start_time"], pending["duration"]) == ("PENDING", None, None)
+
+    task_result.start((1, "two"))
+    task_result.complete({"value": 3})
+    record = task_result.to_dict()
+    assert record["state"] == "SUCCESS"
+    assert record["input_data"] == [1, "two"]
+    assert record["output_data"] == {"value": 3}
+    assert datetime.fromisoformat(record["end_time"]) >= datetime.fromisoformat(record["start_time"])
+    assert isinstance(record["duration"], float) and record["duration"] >= 0
+    json.dumps(record)
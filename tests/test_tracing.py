@@ -0,0 +1,138 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from engine import tracing
+from engine.tracing import InMemoryExporter, OTLPJsonFileExporter, Tracer
+
+
+class SlowExporter(InMemoryExporter):
+    def __init__(self, delay=0.0):
+        super().__init__()
+        self.delay = delay
+        self.threads = []
+        self.exporting = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def export(self, spans):
+        self.threads.append(threading.current_thread())
+        self.exporting.set()
+        self.release.wait()
+        time.sleep(self.delay)
+        super().export(spans)
+
+
+@pytest.fixture
+def tracer():
+    tracers = []
+
+    def make(exporter=None, **options):
+        tracer = Tracer(exporter or InMemoryExporter(), **options)
+        tracers.append(tracer)
+        return tracer
+    yield make
+    for tracer in tracers:
+        tracer.shutdown()
+
+
+def test_batches_are_exported_off_the_calling_thread(tracer):
+    exporter = SlowExporter(delay=0.2)
+    spans = tracer(exporter, max_batch=1)
+    started = time.perf_counter()
+    with spans.start_span("work"):
+        pass
+    assert time.perf_counter() - started < 0.1
+    spans.flush()
+    assert [span.name for span in exporter.spans] == ["work"]
+    assert exporter.threads and threading.current_thread() not in exporter.threads
+
+
+def test_batches_past_the_queue_limit_are_dropped(tracer):
+    exporter = SlowExporter()
+    exporter.release.clear()
+    spans = tracer(exporter, max_batch=1, max_queued=1)
+    try:
+        spans.start_span("work").end()
+        assert exporter.exporting.wait(2)
+        for _ in range(3):
+            spans.start_span("work").end()
+        # One batch is being exported, one waits in the queue, the rest are dropped.
+        assert spans.dropped == 2
+    finally:
+        exporter.release.set()
+    spans.flush()
+    assert len(exporter.spans) == 2
+
+
+def test_sampling_decides_per_trace(tracer, monkeypatch):
+    spans = tracer(sample_rate=0.5)
+    draws = iter([0.7, 0.2])
+    monkeypatch.setattr(tracing.random, "random", lambda: next(draws))
+    with spans.start_span("skipped") as root:
+        assert not root.recording
+        with spans.start_span("child") as child:
+            assert not child.recording
+    with spans.start_span("kept") as root:
+        with spans.start_span("child"):
+            pass
+    spans.flush()
+    assert sorted(span.name for span in spans.exporter.spans) == ["child", "kept"]
+
+
+def test_sample_rate_zero_records_nothing(tracer):
+    spans = tracer(sample_rate=0.0)
+    for _ in range(10):
+        with spans.start_span("work"):
+            pass
+    spans.flush()
+    assert spans.exporter.spans == []
+
+
+def test_children_join_the_parent_trace_across_tasks(tracer):
+    spans = tracer()
+
+    async def child(name):
+        with spans.start_span(name):
+            await asyncio.sleep(0)
+
+    async def main():
+        with spans.start_span("root") as root:
+            await asyncio.gather(child("a"), child("b"))
+        return root
+
+    root = asyncio.run(main())
+    spans.flush()
+    children = [span for span in spans.exporter.spans if span.name != "root"]
+    assert len(children) == 2
+    assert all(span.trace_id == root.trace_id and span.parent_id == root.span_id for span in children)
+    assert root.parent_id is None
+
+
+def test_file_exporter_writes_otlp_json(tracer, tmp_path):
+    path = tmp_path / "traces.jsonl"
+    spans = tracer(OTLPJsonFileExporter(str(path), service_name="tests"))
+    with spans.start_span("root", {"count": 3, "ratio": 0.5, "ok": True, "name": "x"}) as root:
+        with spans.start_span("child") as child:
+            child.set_status(tracing.STATUS_ERROR, "boom")
+    spans.flush()
+    [line] = path.read_text().splitlines()
+    [resource_spans] = json.loads(line)["resourceSpans"]
+    assert resource_spans["resource"]["attributes"] == [{"key": "service.name", "value": {"stringValue": "tests"}}]
+    [scope_spans] = resource_spans["scopeSpans"]
+    by_name = {span["name"]: span for span in scope_spans["spans"]}
+    exported_root, exported_child = by_name["root"], by_name["child"]
+    assert exported_root["traceId"] == f"{root.trace_id:032x}" and len(exported_root["traceId"]) == 32
+    assert len(exported_root["spanId"]) == 16 and "parentSpanId" not in exported_root
+    assert exported_child["parentSpanId"] == exported_root["spanId"]
+    assert int(exported_root["endTimeUnixNano"]) >= int(exported_root["startTimeUnixNano"])
+    assert exported_root["attributes"] == [
+        {"key": "count", "value": {"intValue": "3"}},
+        {"key": "ratio", "value": {"doubleValue": 0.5}},
+        {"key": "ok", "value": {"boolValue": True}},
+        {"key": "name", "value": {"stringValue": "x"}},
+    ]
+    assert exported_child["status"] == {"code": tracing.STATUS_ERROR, "message": "boom"}
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from engine.retry import NO_RETRY
+from engine.task import task
+from engine.worker import Worker
+from engine.workflow import workflow
+
+from conftest import ROOT
+
+finished = {}
+
+
+@workflow("sleepy")
+async def sleepy(wf, job_id=None, seconds=0.0):
+    await asyncio.sleep(seconds)
+    finished[job_id] = time.monotonic()
+
+
+@workflow("quick")
+async def quick(wf, job_id=None):
+    finished[job_id] = time.monotonic()
+
+
+def test_limited_workflow_backlog_does_not_hold_global_slots(run):
+    worker = Worker(concurrency=4, limits={"sleepy": 1})
+    worker.register(sleepy)
+    worker.register(quick)
+
+    async def main():
+        started = time.monotonic()
+        for i in range(8):
+            await worker.submit("sleepy", f"a{i}", seconds=0.05)
+        await worker.submit("quick", "b")
+        worker.stop()
+        await worker.run()
+        return started
+
+    started = run(main())
+    assert finished["b"] - started < 0.05
+    assert sorted(finished[f"a{i}"] for i in range(8)) == [finished[f"a{i}"] for i in range(8)]
+    assert worker.stats.completed == 9
+
+
+@task(retry=NO_RETRY)
+async def broken():
+    raise ValueError("broken")
+
+
+@workflow("failing")
+async def failing(wf, job_id=None):
+    wf.add_task(broken)
+
+
+@workflow("slow", timeout=0.01)
+async def slow(wf, job_id=None):
+    wf.add_task(sleepy_task)
+
+
+@task(retry=NO_RETRY)
+async def sleepy_task():
+    await asyncio.sleep(1)
+
+
+def test_failed_and_timed_out_workflows_count_as_failed(run):
+    worker = Worker()
+    for registered in (quick, failing, slow):
+        worker.register(registered)
+
+    async def main():
+        await worker.submit("quick", "ok")
+        await worker.submit("failing", "failed")
+        await worker.submit("slow", "timed-out")
+        worker.stop()
+        await worker.run()
+
+    run(main())
+    assert worker.stats.completed == 1
+    assert worker.stats.failed == 2
+
+
+def test_stdin_worker_skips_bad_lines_and_exits_on_sigterm(tmp_path):
+    env = dict(os.environ, ENGINE_BACKEND="sqlite", ENGINE_SQLITE_PATH=str(tmp_path / "engine.db"),
+               PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "engine"), os.path.join(ROOT, "tests"), ROOT]))
+    process = subprocess.Popen([sys.executable, "-m", "engine.worker", "test_worker:quick"], cwd=tmp_path, env=env,
+                               stdin=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    process.stdin.write('not json\n{"workflow": "missing"}\n{"workflow": "quick", "job_id": "ok"}\n')
+    process.stdin.flush()
+    time.sleep(1.0)
+    assert process.poll() is None
+    # stdin stays open: the worker must not wait for it after draining.
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(5)
+    finally:
+        process.kill()
+        process.stdin.close()
+    stderr = process.stderr.read()
+    assert process.returncode == 0, stderr
+    assert stderr.count("Skipping job line") == 2
+    assert "Traceback" not in stderr
@@ -0,0 +1,84 @@
+import asyncio
+import uuid
+
+import pytest
+
+from engine.retry import NO_RETRY, RetryPolicy
+from engine.task import task
+from engine.workflow import Workflow
+
+calls = []
+
+
+@task()
+async def fetch(value):
+    calls.append("fetch")
+    return value * 2
+
+
+@task(retry=NO_RETRY)
+async def flaky(value):
+    calls.append("flaky")
+    if calls.count("flaky") == 1:
+        raise ValueError("first run fails")
+    return value + 1
+
+
+def test_resumed_run_keeps_restored_steps(run, backend):
+    calls.clear()
+    job_id = str(uuid.uuid4())
+
+    async def attempt():
+        workflow = Workflow("resume", job_id, checkpoint=True)
+        workflow.add_task(fetch, 20)
+        workflow.add_task(flaky)
+        await workflow.run()
+        return workflow.workflow_result
+
+    first = run(attempt())
+    first_fetch = backend.workflow_results[job_id]["tasks"][0]
+    assert first.state.name == "FAILED"
+    second = run(attempt())
+    assert second.state.name == "SUCCESS"
+    assert calls == ["fetch", "flaky", "flaky"]
+    tasks = backend.workflow_results[job_id]["tasks"]
+    assert [record["name"] for record in tasks] == ["fetch", "flaky"]
+    assert tasks[0]["restored"] is True
+    assert tasks[0]["id"] == first_fetch["id"]
+    assert tasks[0]["output_data"] == 40
+    assert tasks[1]["output_data"] == 41
+
+
+@task(retry=NO_RETRY)
+async def stall(value):
+    await asyncio.sleep(10)
+
+
+@task(retry=RetryPolicy.fixed(3, 5))
+async def backing_off(value):
+    raise ValueError("try again later")
+
+
+def test_deadline_reports_cancelled_tasks(run, backend):
+    job_id = str(uuid.uuid4())
+    workflow = Workflow("deadline", job_id, timeout=0.2)
+    workflow.add_task(fetch, 1, depends_on=[])
+    workflow.add_task(stall, 1, depends_on=[])
+    run(workflow.run())
+    assert workflow.workflow_result.state.name == "TIMED_OUT"
+    states = {record["name"]: record["state"] for record in backend.workflow_results[job_id]["tasks"]}
+    assert states == {"fetch": "SUCCESS", "stall": "TIMED_OUT"}
+    assert backend.task_results and all(record["state"] != "RUNNING" for record in backend.task_results.values())
+
+
+def test_cancel_during_backoff_records_outcome(run, backend):
+    async def main():
+        call = asyncio.ensure_future(backing_off(1))
+        await asyncio.sleep(0.1)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+
+    run(main())
+    [rollup] = [rollup for rollup in backend.rollups.values() if rollup.task == "backing_off"]
+    assert (rollup.count, rollup.failures, rollup.retries) == (1, 1, 1)
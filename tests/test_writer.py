@@ -0,0 +1,188 @@
+import asyncio
+import os
+
+from engine import writer
+from engine.task import TaskResult
+from engine.writer import WriteBehindQueue
+
+from benchmarks.fakes import MemoryBackend
+
+
+class FailingBackend(MemoryBackend):
+    # Fails the first `failures` write_batch calls, then behaves like MemoryBackend.
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.attempts = 0
+        # (batch id, rollup count) of every write_batch call.
+        self.sent = []
+
+    async def write_batch(self, task_results=(), statuses=None, workflow_results=(), checkpoints=(),
+                          rollups=(), batch_id=None):
+        self.attempts += 1
+        self.sent.append((batch_id, sum(rollup["count"] for rollup in rollups)))
+        if self.attempts <= self.failures:
+            raise ConnectionError("database unavailable")
+        await super().write_batch(task_results, statuses, workflow_results, checkpoints, rollups, batch_id)
+
+
+def record(id, state="RUNNING"):
+    return {"id": id, "state": state}
+
+
+def test_records_are_coalesced_by_key(run, backend):
+    async def main():
+        queue = WriteBehindQueue(flush_interval=60, spill_path=None)
+        queue.put_task_result(record("a"))
+        queue.put_task_result(record("a", "SUCCESS"))
+        queue.put_workflow_status("job", "RUNNING")
+        queue.put_workflow_status("job", "COMPLETED")
+        queue.put_checkpoint({"job_id": "job", "step": "s", "value": 1})
+        queue.put_checkpoint({"job_id": "job", "step": "s", "value": 2})
+        assert queue.pending() == 3
+        await queue.flush()
+        await queue.close()
+
+    run(main())
+    assert backend.batches == 1
+    assert backend.records == 3
+    assert backend.task_results["a"]["state"] == "SUCCESS"
+    assert backend.statuses["job"] == "COMPLETED"
+    assert backend.checkpoints[("job", "s")]["value"] == 2
+
+
+def test_a_full_batch_wakes_the_flusher(run, backend):
+    async def main():
+        queue = WriteBehindQueue(max_batch=3, flush_interval=60, spill_path=None)
+        for i in range(2):
+            queue.put_task_result(record(i))
+        await asyncio.sleep(0.05)
+        assert backend.batches == 0
+        queue.put_task_result(record(2))
+        await asyncio.sleep(0.05)
+        assert backend.batches == 1
+        assert queue.pending() == 0
+        await queue.close()
+
+    run(main())
+    assert len(backend.task_results) == 3
+
+
+def test_a_failed_flush_is_requeued_and_newer_writes_win(run, backend):
+    failing = FailingBackend(failures=1)
+
+    async def main():
+        from engine import db
+        db.set_backend(failing)
+        queue = WriteBehindQueue(flush_interval=60, spill_path=None)
+        queue.put_task_result(record("a"))
+        queue.put_task_result(record("b"))
+        try:
+            await queue.flush()
+        except ConnectionError:
+            pass
+        else:
+            raise AssertionError("flush should have failed")
+        assert queue.pending() == 2
+        queue.put_task_result(record("a", "SUCCESS"))
+        await queue.flush()
+        await queue.close()
+
+    run(main())
+    assert failing.attempts == 2
+    assert failing.task_results["a"]["state"] == "SUCCESS"
+    assert failing.task_results["b"]["state"] == "RUNNING"
+
+
+def outcome(name="fetch"):
+    task_result = TaskResult(name)
+    task_result.start({})
+    task_result.complete("done")
+    return task_result
+
+
+def test_a_failed_rollup_batch_is_resent_unchanged_under_its_id(run, backend):
+    failing = FailingBackend(failures=1)
+
+    async def main():
+        from engine import db
+        db.set_backend(failing)
+        queue = WriteBehindQueue(flush_interval=60, spill_path=None)
+        queue.put_outcome(outcome())
+        try:
+            await queue.flush()
+        except ConnectionError:
+            pass
+        queue.put_outcome(outcome())
+        await queue.flush()
+        await queue.close()
+
+    run(main())
+    (first, one), (resent, same), (newer, other) = failing.sent
+    assert resent == first and one == same == 1
+    assert newer != first and other == 1
+    assert sum(rollup.count for rollup in failing.rollups.values()) == 2
+
+
+def test_cancelling_the_flusher_drains_the_queue(run, backend):
+    async def main():
+        queue = WriteBehindQueue(flush_interval=60, spill_path=None)
+        queue.put_task_result(record("a"))
+        queue.put_workflow_status("job", "COMPLETED")
+        await asyncio.sleep(0)
+        assert backend.batches == 0
+        await queue.close()
+        assert queue.pending() == 0
+
+    run(main())
+    assert "a" in backend.task_results
+    assert backend.statuses["job"] == "COMPLETED"
+
+
+def test_unwritten_records_are_spilled_and_recovered(run, backend, tmp_path):
+    spill_path = str(tmp_path / "spill" / "queue.jsonl")
+    failing = FailingBackend(failures=100)
+
+    async def spill():
+        from engine import db
+        db.set_backend(failing)
+        queue = WriteBehindQueue(flush_interval=60, max_retries=2, retry_delay=0, spill_path=spill_path)
+        queue.put_task_result(record("a", "SUCCESS"))
+        queue.put_workflow_status("job", "COMPLETED")
+        queue.put_checkpoint({"job_id": "job", "step": "s", "value": 1})
+        await queue.close()
+        assert queue.pending() == 0
+
+    async def recover():
+        from engine import db
+        db.set_backend(backend)
+        queue = WriteBehindQueue(flush_interval=60, spill_path=spill_path)
+        queue.start()
+        assert queue.pending() == 3
+        await queue.close()
+
+    run(spill())
+    assert failing.attempts == 2
+    assert not failing.task_results
+    run(recover())
+    assert backend.task_results["a"]["state"] == "SUCCESS"
+    assert backend.statuses["job"] == "COMPLETED"
+    assert backend.checkpoints[("job", "s")]["value"] == 1
+    assert not (tmp_path / "spill" / "queue.jsonl").exists()
+
+
+def test_durable_writes_are_flushed_before_returning(run, backend):
+    async def main():
+        writer.configure_writer(flush_interval=60, spill_path=None)
+        await writer.persist_task_result(record("a"))
+        assert "a" not in backend.task_results
+        await writer.persist_task_result(record("b"), durable=True)
+        assert backend.task_results["b"]["state"] == "RUNNING"
+        assert "a" in backend.task_results
+
+    run(main())
+
+
+def test_default_spill_path_does_not_follow_the_working_directory():
+    assert writer.SPILL_PATH == writer.WriteBehindQueue.__init__.__defaults__[-1]
+    assert os.path.isabs(writer.SPILL_PATH)